@@ -13,4 +13,14 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after the setup done by get_asgi_application()
+from sugr_backend.event_stream import EVENTS_PATH, event_stream  # noqa: E402
+
+
+async def application(scope, receive, send):
+    """Django, except for the Server-Sent Events stream that needs a long-lived async response."""
+    if scope['type'] == 'http' and scope['path'] == EVENTS_PATH:
+        return await event_stream(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -145,16 +145,74 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'sugr_backend.authentication.CachedJWTAuthentication',
     )
 }
 
 AUTH_USER_MODEL = 'sugr_backend.User'
 
+# Content-addressed storage for uploaded file bytes (FileData keeps only the SHA-256, size and MIME type).
+# Use 'sugr_backend.storage.GridFSBlobStore' to keep the bytes chunked in MongoDB instead of on disk.
+BLOB_STORE = {
+    'BACKEND': 'sugr_backend.storage.FileSystemBlobStore',
+    'OPTIONS': {
+        'root': BASE_DIR / 'blobs',
+    },
+}
+
+# Resized patient photos, keyed by source hash and size; least recently used files are evicted past max_bytes.
+THUMBNAIL_CACHE = {
+    'root': BASE_DIR / 'thumbnail_cache',
+    'max_bytes': 256 * 1024 * 1024,
+}
+
+# Uploaded photos and scans are re-encoded in a process pool before they are stored
+IMAGE_INGEST = {
+    'max_dimension': 2048,
+    'format': 'JPEG',  # or 'WEBP'
+    'quality': 82,
+    'workers': 2,
+    'timeout': 30,  # seconds; the original upload is kept if encoding takes longer
+}
+
+# Change feed journal (GET /api/changes/); purge_change_events drops entries older than this
+CHANGE_JOURNAL_RETENTION_DAYS = 30
+
+# Server-Sent Events push of the change journal (GET /api/events/, served by backend/asgi.py only)
+EVENT_STREAM = {
+    'poll_interval': 1.0,  # seconds between journal polls per worker while streams are connected
+    'heartbeat': 15,
+    'access_refresh': 60,  # seconds between re-checks of a stream's token and reloads of its accessible patients
+    'queue_size': 1000,
+}
+
+# Per-process cache of authenticated users and their permission codes (sugr_backend/authentication.py)
+AUTH_USER_CACHE = {
+    'max_size': 1024,
+    'ttl': 60,  # seconds; bounds how long other processes keep a user changed elsewhere
+}
+
+# Tells the caches of every worker process when an entity changed (sugr_backend/invalidation.py):
+# 'local' (one process), 'file' (processes of one host) or 'mongo' (a capped collection, across hosts)
+INVALIDATION_BUS = {
+    'transport': 'local',
+}
+
+# Logged out and rotated tokens; each process reloads the revoked ids this often
+TOKEN_REVOCATION = {
+    'refresh_interval': 10,  # seconds
+}
+
+# Login and registration hash passwords in a few slots shared by the processes of a host (sugr_backend/passwords.py)
+PASSWORD_HASHING = {
+    'slots': 2,  # hashes at once on the host; below the gunicorn worker count (3), so one stays free
+    'retry_after': 2,  # no waiting for a slot: 503 with this Retry-After when all are taken
+}
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(days=1),     # Token is valid for 5 minutes
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),    # You can request a new access token using the refresh token within this time
-    'ROTATE_REFRESH_TOKENS': False,                 # Whether to issue a new refresh token on token refresh
+    'ROTATE_REFRESH_TOKENS': True,                  # refresh/ issues a new refresh token and revokes the old one
     'BLACKLIST_AFTER_ROTATION': True,               # Whether to blacklist the old tokens after rotation
 
     'ALGORITHM': 'HS256',                           # The signing algorithm to use when encoding tokens
@@ -165,7 +223,8 @@ SIMPLE_JWT = {
     'USER_ID_FIELD': 'id',                          # The field in the User model that is used as the user identifier
     'USER_ID_CLAIM': 'user_id',                     # The claim name for the user identifier
 
-    'AUTH_TOKEN_CLASSES': ('rest_framework_simplejwt.tokens.AccessToken',),  # Type of tokens issued
+    'AUTH_TOKEN_CLASSES': ('rest_framework_simplejwt.tokens.AccessToken',
+                           'rest_framework_simplejwt.tokens.SlidingToken'),  # Tokens accepted for authentication
     'TOKEN_TYPE_CLAIM': 'token_type',               # Field name for token type in payload
 
     'SLIDING_TOKEN_REFRESH_EXP_CLAIM': 'refresh_exp',  # Field name in sliding tokens for refresh expiration
@@ -196,4 +255,5 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'x-chunk-sha256',
 ]
@@ -16,4 +16,4 @@ python manage.py migrate
 python manage.py migrate --noinput
 
 echo "Starting Gunicorn..."
-exec gunicorn backend.wsgi:application --bind 0.0.0.0:8000 --workers 3 --timeout 90
\ No newline at end of file
+exec gunicorn backend.asgi:application -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000 --workers 3 --timeout 90
\ No newline at end of file
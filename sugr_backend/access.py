@@ -0,0 +1,44 @@
+"""Which patients a user can access, from the PatientAccess index.
+
+A user can access the patients they own and those they are in allowed_users of; staff can
+access every patient. PatientAccess holds one row per (user, patient) pair and is kept in
+sync by the signals in signals.py; rebuild_patient_access recreates it from scratch.
+"""
+from django.db import IntegrityError
+
+from .models import PatientAccess, PatientData
+
+
+def accessible_patient_pks(user):
+    """pks of the patients user can access, or None for staff (every patient)."""
+    if getattr(user, 'is_staff', False):
+        return None
+    return list(PatientAccess.objects.filter(user_pk=user.pk).values_list('patient_pk', flat=True))
+
+
+def get_accessible_patients_queryset(user):
+    """Patients the user can access: own, allowed_users, or all if staff."""
+    patient_pks = accessible_patient_pks(user)
+    if patient_pks is None:
+        return PatientData.objects.all()
+    return PatientData.objects.filter(pk__in=patient_pks)
+
+
+def patient_user_pks(patient):
+    user_pks = set(patient.allowed_users.values_list('pk', flat=True))
+    if patient.user_id:
+        user_pks.add(patient.user_id)
+    return user_pks
+
+
+def sync_patient_access(patient):
+    """Make the PatientAccess rows of patient match its owner and allowed_users."""
+    wanted = patient_user_pks(patient)
+    current = set(PatientAccess.objects.filter(patient_pk=patient.pk).values_list('user_pk', flat=True))
+    if current - wanted:
+        PatientAccess.objects.filter(patient_pk=patient.pk, user_pk__in=list(current - wanted)).delete()
+    for user_pk in wanted - current:
+        try:
+            PatientAccess.objects.create(user_pk=user_pk, patient_pk=patient.pk)
+        except IntegrityError:
+            pass  # Added by a concurrent sync
@@ -1,10 +1,53 @@
+from django import forms
 from django.contrib import admin
 from .models import FileData
+from .storage import get_blob_store, release_blob
 
 # Register your models here.
 
+
+class FileDataAdminForm(forms.ModelForm):
+    upload = forms.FileField(required=False, help_text='Yeni dosya yükle (mevcut içeriği değiştirir).')
+
+    class Meta:
+        model = FileData
+        exclude = ('blob_hash', 'file_size')
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not self.instance.blob_hash and not cleaned_data.get('upload'):
+            self.add_error('upload', 'A file is required.')
+        return cleaned_data
+
+
 @admin.register(FileData)
 class FileDataAdmin(admin.ModelAdmin):
-    list_display = ('file_id', 'file_name', 'patient_firstname', 'patient_lastname', 'file_category', 'uploaded_by', 'uploaded_date')
+    form = FileDataAdminForm
+    list_display = ('file_id', 'file_name', 'patient_firstname', 'patient_lastname', 'file_category', 'file_size', 'uploaded_by', 'uploaded_date')
     list_filter = ('file_category', 'uploaded_date')
-    search_fields = ('file_name', 'patient_firstname', 'patient_lastname', 'uploaded_by')
+    search_fields = ('file_name', 'patient_firstname', 'patient_lastname', 'uploaded_by', 'blob_hash')
+    readonly_fields = ('blob_hash', 'file_size')
+
+    def save_model(self, request, obj, form, change):
+        upload = form.cleaned_data.get('upload')
+        old_blob_hash = obj.blob_hash
+        if upload:
+            # Stream the upload into the blob store chunk by chunk instead of reading it whole.
+            obj.blob_hash, obj.file_size = get_blob_store().put_stream(upload.chunks())
+            if not change or 'file_type' not in form.changed_data:
+                obj.file_type = upload.content_type or obj.file_type or 'application/octet-stream'
+            if not obj.file_name:
+                obj.file_name = upload.name
+        super().save_model(request, obj, form, change)
+        if old_blob_hash and old_blob_hash != obj.blob_hash:
+            release_blob(old_blob_hash)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        release_blob(obj.blob_hash)
+
+    def delete_queryset(self, request, queryset):
+        blob_hashes = set(queryset.values_list('blob_hash', flat=True))
+        super().delete_queryset(request, queryset)
+        for blob_hash in blob_hashes:
+            release_blob(blob_hash)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class SugrBackendConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'sugr_backend'
+
+    def ready(self):
+        from . import signals  # noqa: F401 (connects the receivers)
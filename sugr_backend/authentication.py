@@ -0,0 +1,289 @@
+"""JWT authentication with a per-process cache of users and their permission codes.
+
+JWTAuthentication loads the User row on every request. CachedJWTAuthentication keeps
+recently seen users (with get_permission_codes() resolved) in a TTL+LRU cache keyed by
+user id. An entry is dropped when its user is saved in this process or a change of it
+arrives on the invalidation bus (see invalidation.py), and is reloaded when a token names a
+newer User.auth_version; AUTH_USER_CACHE['ttl'] bounds how long a missed message matters. Tokens naming an older auth_version were
+issued before an admin changed the user's permissions and are rejected (see permissions.py).
+
+Logged out and rotated tokens are stored as RevokedToken rows until they expire. Renewing a
+refresh or sliding token checks them in the database; authentication checks a per-process
+copy of the revoked ids, which other processes add to over the bus and which is reloaded
+every TOKEN_REVOCATION['refresh_interval'] seconds.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError
+from django.utils import timezone
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken, SlidingToken, Token
+
+from .changes import USER
+from .invalidation import ensure_listening, publish, subscribe
+from .models import RevokedToken
+from .permissions import AUTH_VERSION_CLAIM, add_permission_claims
+
+REVOKED_TOKEN = 'revoked_token'  # Invalidation bus entity, keyed by jti
+
+_DEFAULTS = {
+    'max_size': 1024,
+    'ttl': 60,  # seconds
+}
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire ttl seconds after they were set."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _cache_settings():
+    return {**_DEFAULTS, **getattr(settings, 'AUTH_USER_CACHE', {})}
+
+
+_options = _cache_settings()
+user_cache = TTLCache(_options['max_size'], _options['ttl'])
+
+
+def get_cached_user(user_id, min_version=None, fresh=False):
+    """The user with user_id (a copy, safe to modify), from the cache or the database; None if missing.
+
+    min_version is the auth_version the caller knows about, e.g. from a token claim; fresh
+    always reloads the user."""
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    ensure_listening()
+    user = None if fresh else user_cache.get(user_id)
+    if user is None or (min_version is not None and user.auth_version < min_version):
+        user = get_user_model().objects.filter(pk=user_id).first()
+        if user is None:
+            user_cache.delete(user_id)
+            return None
+        user._cached_permission_codes = tuple(user.get_permission_codes())
+        user_cache.set(user_id, user)
+    return copy.copy(user)
+
+
+def invalidate_user(user_id):
+    user_cache.delete(int(user_id))
+
+
+subscribe(USER, invalidate_user)
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that takes the user from the per-process user cache."""
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken("Token contained no recognizable user identification")
+        token_version = validated_token.get(AUTH_VERSION_CLAIM)
+        user = get_cached_user(user_id, token_version)
+        if user is None:
+            raise AuthenticationFailed("User not found", code="user_not_found")
+        if not user.is_active:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+        if is_revoked(validated_token.get(api_settings.JTI_CLAIM)):
+            raise AuthenticationFailed("Token was revoked", code="token_revoked")
+        if token_version is not None and token_version < user.auth_version:
+            raise AuthenticationFailed("Permissions changed, the token must be renewed", code="token_outdated")
+        return user
+
+
+def tokens_for_user(user):
+    """RefreshToken with the permission claims of user; its access_token carries them too."""
+    return add_permission_claims(RefreshToken.for_user(user), user)
+
+
+def sliding_token_for_user(user):
+    return add_permission_claims(SlidingToken.for_user(user), user)
+
+
+class _RevokedIds:
+    """Per-process copy of the ids of revoked, not yet expired tokens."""
+
+    def __init__(self):
+        self.jtis = frozenset()
+        self.loaded = None
+        self._lock = threading.Lock()
+
+    def refresh_interval(self):
+        return getattr(settings, 'TOKEN_REVOCATION', {}).get('refresh_interval', 10)
+
+    def get(self):
+        now = time.monotonic()
+        if self.loaded is None or now - self.loaded > self.refresh_interval():
+            with self._lock:
+                if self.loaded is None or now - self.loaded > self.refresh_interval():
+                    self.jtis = frozenset(RevokedToken.objects.filter(expires_at__gt=timezone.now())
+                                          .values_list('jti', flat=True))
+                    self.loaded = time.monotonic()
+        return self.jtis
+
+    def add(self, jti):
+        with self._lock:
+            self.jtis = self.jtis | {jti}
+
+    def clear(self):
+        with self._lock:
+            self.loaded = None
+
+
+revoked_ids = _RevokedIds()
+
+
+subscribe(REVOKED_TOKEN, revoked_ids.add)
+
+
+def is_revoked(jti):
+    ensure_listening()
+    return bool(jti) and jti in revoked_ids.get()
+
+
+def revoke_token(token):
+    """Store token as revoked; False if it was revoked already (e.g. a refresh token used twice)."""
+    jti = token[api_settings.JTI_CLAIM]
+    expires_at = datetime.fromtimestamp(token['exp'], tz=dt_timezone.utc)
+    if token.get(api_settings.TOKEN_TYPE_CLAIM) == SlidingToken.token_type:
+        # A sliding token is renewed until refresh_exp, with the same id
+        expires_at = datetime.fromtimestamp(token[api_settings.SLIDING_TOKEN_REFRESH_EXP_CLAIM], tz=dt_timezone.utc)
+    if not settings.USE_TZ:
+        expires_at = timezone.make_naive(expires_at, dt_timezone.utc)
+    try:
+        RevokedToken.objects.create(jti=jti, token_type=token.get(api_settings.TOKEN_TYPE_CLAIM) or '',
+                                    user_pk=token.get(api_settings.USER_ID_CLAIM), expires_at=expires_at)
+    except IntegrityError:
+        return False
+    finally:
+        publish(REVOKED_TOKEN, jti)
+    return True
+
+
+SESSION_JTI_CLAIM = 'session_jti'
+SESSION_EXP_CLAIM = 'session_exp'
+
+
+class StreamTicket(Token):
+    """Short-lived, single-use ticket to open the event stream (GET /api/events/?ticket=).
+
+    URLs end up in proxy and access logs, so they carry this rather than the access token.
+    It names the token it was issued for; the stream ends when that one expires or is revoked."""
+    token_type = 'stream'
+    lifetime = timedelta(seconds=30)
+
+
+def stream_ticket_for(user, token):
+    ticket = StreamTicket.for_user(user)
+    ticket[AUTH_VERSION_CLAIM] = user.auth_version
+    ticket[SESSION_JTI_CLAIM] = token.get(api_settings.JTI_CLAIM)
+    ticket[SESSION_EXP_CLAIM] = token['exp']
+    return ticket
+
+
+def token_session(token):
+    """What a long-lived connection has to re-check about the token that opened it."""
+    return {
+        'user_id': token.get(api_settings.USER_ID_CLAIM),
+        'auth_version': token.get(AUTH_VERSION_CLAIM),
+        'jti': token.get(SESSION_JTI_CLAIM, token.get(api_settings.JTI_CLAIM)),
+        'exp': token.get(SESSION_EXP_CLAIM, token.get('exp')),
+    }
+
+
+def check_session(session):
+    """The user of session, or AuthenticationFailed once its token expired or was revoked, or the
+    user was deactivated or had their permissions changed."""
+    if not session['exp'] or session['exp'] <= time.time():
+        raise AuthenticationFailed("Token expired", code="token_not_valid")
+    if is_revoked(session['jti']):
+        raise AuthenticationFailed("Token was revoked", code="token_revoked")
+    user = get_cached_user(session['user_id'], session['auth_version'])
+    if user is None or not user.is_active:
+        raise AuthenticationFailed("User not found or inactive", code="user_inactive")
+    if session['auth_version'] is not None and session['auth_version'] < user.auth_version:
+        raise AuthenticationFailed("Permissions changed, the token must be renewed", code="token_outdated")
+    return user
+
+
+def redeem_stream_ticket(raw_ticket):
+    """(user, session) of a stream ticket, which cannot be used again."""
+    ticket = StreamTicket(raw_ticket)
+    session = token_session(ticket)
+    user = check_session(session)
+    if not revoke_token(ticket):
+        raise TokenError("Ticket was used already")
+    return user, session
+
+
+def _renewable_user(token):
+    if RevokedToken.objects.filter(jti=token[api_settings.JTI_CLAIM]).exists():
+        raise TokenError("Token was revoked")
+    # Reloaded, so the new token carries the current permissions
+    user = get_cached_user(token.get(api_settings.USER_ID_CLAIM), fresh=True)
+    if user is None or not user.is_active:
+        raise AuthenticationFailed("User not found or inactive", code="user_inactive")
+    return user
+
+
+def rotate_refresh_token(raw_token):
+    """(new RefreshToken, user) for a refresh token, which is revoked so it cannot be used again."""
+    refresh = RefreshToken(raw_token)
+    user = _renewable_user(refresh)
+    if not revoke_token(refresh):
+        raise TokenError("Token was revoked")
+    return tokens_for_user(user), user
+
+
+def renew_sliding_token(raw_token):
+    """(renewed SlidingToken, user): a new expiry and current permission claims, until refresh_exp."""
+    token = SlidingToken(raw_token)
+    token.check_exp(api_settings.SLIDING_TOKEN_REFRESH_EXP_CLAIM)
+    user = _renewable_user(token)
+    token.set_exp(from_time=token.current_time)
+    token.set_iat(at_time=token.current_time)
+    return add_permission_claims(token, user), user
@@ -0,0 +1,138 @@
+"""Change journal and feed.
+
+Every mutating PatientAPI, FileAPI, MedicineAPI and admin operation appends a ChangeEvent
+with record_change(). GET changes/?since=<cursor> returns what changed after the cursor,
+limited to what the caller can see, so clients sync deltas instead of reloading everything.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .invalidation import publish
+from .models import ChangeEvent, PatientData
+
+PATIENT = 'patient'
+FILE = 'file'
+MEDICINE = 'medicine'
+USER = 'user'
+
+CREATED = 'created'
+UPDATED = 'updated'
+DELETED = 'deleted'
+REVOKED = 'revoked'  # The user (user_pk) lost access to the patient
+
+DEFAULT_CHANGES_LIMIT = 200
+MAX_CHANGES_LIMIT = 1000
+# Cursors are event pks, which are allocated before the insert; a concurrent write may still
+# insert a lower pk for a moment, so the feed only returns events older than this.
+SETTLE_TIME = timedelta(seconds=1)
+
+
+def retention_days():
+    return getattr(settings, 'CHANGE_JOURNAL_RETENTION_DAYS', 30)
+
+
+def record_change(entity, entity_id, action=UPDATED, paths=None, patient_pk=None, user_pk=None, version=None,
+                  changed_by=None):
+    """Append a change to the journal and publish it on the invalidation bus; a failure is
+    logged, the write it describes already happened.
+
+    Events with neither patient_pk nor user_pk are visible to everyone."""
+    publish(entity, str(entity_id))
+    try:
+        return ChangeEvent.objects.create(
+            entity=entity, entity_id=str(entity_id), action=action, paths=sorted(set(paths or [])),
+            patient_pk=patient_pk, user_pk=user_pk, version=version, changed_by=changed_by or '')
+    except Exception as e:
+        print(f"Error recording {action} of {entity} {entity_id}: {str(e)}")
+        return None
+
+
+def record_patient_change(patient, paths=None, action=UPDATED, user=None, patient_id=None):
+    return record_change(PATIENT, patient_id or patient.patient_id, action, paths, patient_pk=patient.pk,
+                         version=patient.version, changed_by=getattr(user, 'email', None))
+
+
+def record_file_change(file_id, patient_id, action=UPDATED, user_pk=None, changed_by=None):
+    """Journal a FileData change; it is visible to the uploader and, when patient_id is a
+    patient's, to everyone with access to that patient."""
+    patient_pk = PatientData.objects.filter(patient_id=patient_id).values_list('pk', flat=True).first() \
+        if patient_id else None
+    return record_change(FILE, file_id, action, patient_pk=patient_pk, user_pk=user_pk, changed_by=changed_by)
+
+
+def settled_before():
+    return timezone.now() - SETTLE_TIME
+
+
+def latest_cursor(before=None):
+    events = ChangeEvent.objects.all()
+    if before is not None:
+        events = events.filter(created_at__lte=before)
+    return events.order_by('-pk').values_list('pk', flat=True).first() or 0
+
+
+def visible_changes(user, accessible_pks=None):
+    """ChangeEvents user may see; accessible_pks None means every patient (staff)."""
+    events = ChangeEvent.objects.all()
+    if accessible_pks is None:
+        return events
+    return events.filter(Q(patient_pk__in=list(accessible_pks)) | Q(user_pk=user.pk)
+                         | Q(patient_pk__isnull=True, user_pk__isnull=True))
+
+
+def is_visible(event, user_pk, accessible_pks=None):
+    """Same rule as visible_changes, for one event."""
+    if accessible_pks is None:
+        return True
+    if event.patient_pk is None and event.user_pk is None:
+        return True
+    return event.patient_pk in accessible_pks or event.user_pk == user_pk
+
+
+def changes_access(event):
+    """Whether event may change which patients users can access."""
+    return event.entity == PATIENT and (event.action in (CREATED, REVOKED) or 'allowed_users' in event.paths)
+
+
+def change_to_dict(event):
+    return {
+        "cursor": event.pk,
+        "entity": event.entity,
+        "id": event.entity_id,
+        "action": event.action,
+        "paths": event.paths,
+        "version": event.version,
+        "changed_at": event.created_at.isoformat() if event.created_at else None,
+    }
+
+
+def is_expired(since):
+    """Whether events after since were purged already, so a delta sync would miss some."""
+    oldest = ChangeEvent.objects.order_by('pk').values_list('pk', flat=True).first()
+    return oldest is not None and since + 1 < oldest
+
+
+def coalesce_changes(events):
+    """One entry per changed entity, in order of its last change, with the union of the changed paths."""
+    changes = {}
+    for event in events:
+        key = (event.entity, event.entity_id)
+        change = changes.pop(key, None)
+        if change is None:
+            change = {"entity": event.entity, "id": event.entity_id, "paths": set(), "whole": False}
+        # An entity that was created, deleted or changed as a whole is reloaded completely
+        if not event.paths or event.action != UPDATED:
+            change["whole"] = True
+        change["paths"].update(event.paths)
+        change.update({"action": event.action, "version": event.version,
+                       "changed_at": event.created_at.isoformat() if event.created_at else None})
+        changes[key] = change
+    result = []
+    for change in changes.values():
+        whole = change.pop("whole")
+        change["paths"] = [] if whole else sorted(change["paths"])
+        result.append(change)
+    return result
@@ -0,0 +1,31 @@
+"""ETag helpers for API reads (If-None-Match -> 304 Not Modified).
+
+The ETags are computed from cheap version data (PatientData.version, update timestamps),
+so a matching request is answered before any JSON field is loaded or serialized.
+"""
+import hashlib
+import json
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+
+
+def compute_etag(*parts):
+    """Stable tag for JSON-serializable parts (versions, ids, query parameters)."""
+    raw = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+
+
+def not_modified_response(request, etag):
+    """304 response if the request's If-None-Match matches etag, else None."""
+    response = get_conditional_response(request, etag=quote_etag(etag))
+    if response is not None:
+        set_etag(response, etag)
+    return response
+
+
+def set_etag(response, etag):
+    response['ETag'] = quote_etag(etag)
+    # Let clients cache, but always revalidate
+    response['Cache-Control'] = 'private, no-cache'
+    return response
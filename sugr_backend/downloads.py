@@ -0,0 +1,153 @@
+import base64
+import hashlib
+import re
+from urllib.parse import quote
+
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+_WHITESPACE_RE = re.compile(r'\s')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range_header(header, size):
+    """Return (start, end) with end exclusive for a single "bytes=" range, or None to send the whole file.
+
+    Multiple ranges are answered with the full body, which RFC 7233 allows."""
+    if not header:
+        return None
+    match = _RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes, of which an empty file has none
+        length = int(last)
+        if length == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size
+    start = int(first)
+    if last and int(last) < start:
+        # Syntactically invalid (RFC 9110 14.1.1), so ignored like a missing header
+        return None
+    end = min(int(last) + 1, size) if last else size
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+class Base64Payload:
+    """Random access to the decoded bytes of a base64 string, decoding only the requested part.
+
+    Slices are taken on 4-character boundaries, so no full decoded copy is ever built."""
+
+    def __init__(self, value):
+        value = value.strip()
+        if _WHITESPACE_RE.search(value):
+            value = _WHITESPACE_RE.sub('', value)
+        self.value = value
+        # Skip a "data:<mime>;base64," prefix by offset instead of copying the string
+        self.offset = value.index(',') + 1 if value.startswith('data:') and ',' in value else 0
+        length = len(value) - self.offset
+        padding = len(value) - len(value.rstrip('=')) if length else 0
+        full_groups, remainder = divmod(length, 4)
+        if remainder == 1:
+            raise ValueError("Invalid base64 file data")
+        self.size = full_groups * 3 + {0: 0, 2: 1, 3: 2}[remainder] - (padding if not remainder else 0)
+
+    def iter_chunks(self, start=0, end=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        end = self.size if end is None else min(end, self.size)
+        group = start // 3
+        skip = start - group * 3
+        position = group * 3
+        chars_per_chunk = max(chunk_size // 3, 1) * 4
+        index = self.offset + group * 4
+        while position < end:
+            encoded = self.value[index:index + chars_per_chunk]
+            if not encoded:
+                break
+            index += len(encoded)
+            if len(encoded) % 4:
+                encoded += '=' * (-len(encoded) % 4)
+            decoded = base64.b64decode(encoded)
+            if skip:
+                decoded = decoded[skip:]
+                position += skip
+                skip = 0
+            if position + len(decoded) > end:
+                decoded = decoded[:end - position]
+            position += len(decoded)
+            if decoded:
+                yield decoded
+
+    def etag(self):
+        digest = hashlib.sha256()
+        for i in range(self.offset, len(self.value), 1024 * 1024):
+            digest.update(self.value[i:i + 1024 * 1024].encode('ascii', 'replace'))
+        return digest.hexdigest()
+
+
+def content_disposition(filename, disposition='inline'):
+    if not filename:
+        return disposition
+    try:
+        filename.encode('ascii')
+        return '%s; filename="%s"' % (disposition, filename.replace('\\', '\\\\').replace('"', r'\"'))
+    except UnicodeEncodeError:
+        return "%s; filename*=utf-8''%s" % (disposition, quote(filename))
+
+
+def streaming_file_response(request, size, iter_range, content_type, etag=None, last_modified=None,
+                            filename=None):
+    """Build a streaming download honouring If-None-Match/If-Modified-Since, Range and If-Range.
+
+    iter_range(start, end) must yield the bytes in [start, end)."""
+    etag = quote_etag(etag) if etag else None
+    last_modified_ts = int(last_modified.timestamp()) if last_modified else None
+
+    conditional = get_conditional_response(request, etag=etag, last_modified=last_modified_ts)
+    if conditional is not None:
+        _set_validators(conditional, etag, last_modified_ts)
+        return conditional
+
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    # Only honour Range when If-Range (if any) still matches the current representation
+    if not if_range or (etag and if_range.strip() == etag and not etag.startswith('W/')):
+        try:
+            byte_range = parse_range_header(request.META.get('HTTP_RANGE'), size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    if byte_range is None:
+        start, end = 0, size
+        response = StreamingHttpResponse(iter_range(0, size), content_type=content_type)
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(iter_range(start, end), content_type=content_type, status=206)
+        response['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+    response['Content-Length'] = str(end - start)
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = content_disposition(filename)
+    _set_validators(response, etag, last_modified_ts)
+    return response
+
+
+def _set_validators(response, etag, last_modified_ts):
+    if etag:
+        response['ETag'] = etag
+    if last_modified_ts is not None:
+        response['Last-Modified'] = http_date(last_modified_ts)
+    # Patient documents are private; caches may keep them but must revalidate
+    response['Cache-Control'] = 'private, no-cache'
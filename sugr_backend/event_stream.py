@@ -0,0 +1,246 @@
+"""Server-Sent Events push of the change journal (GET /api/events/), served by backend/asgi.py.
+
+Every ASGI worker process runs one EventBroker. While any stream is connected it polls the
+ChangeEvent journal (see changes.py) and fans each new event out to the streams of the
+process, so the journal doubles as the cross-worker bus: writes made by any worker, or by
+the WSGI workers, reach every connected client with one query per poll per process.
+
+Each stream only gets the events its user may see, with the same rule as changes/. The
+stream authenticates with the Authorization header, or with ?ticket= from POST
+events/ticket/ (EventSource cannot set headers, and an access token in the URL would end
+up in logs). Every access_refresh seconds the token is checked again; the stream ends with
+an "expired" event once it expired or was revoked, or the user was deactivated or had
+their permissions changed.
+A reconnecting client sends Last-Event-ID (or ?since=) and first gets what it missed; if
+that is no longer in the journal it gets a "reset" event and should reload everything.
+"""
+import asyncio
+import json
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .access import accessible_patient_pks
+from .changes import (
+    change_to_dict, changes_access, is_expired, is_visible, latest_cursor, settled_before, visible_changes,
+)
+from .models import ChangeEvent
+
+EVENTS_PATH = '/api/events/'
+REPLAY_LIMIT = 1000
+POLL_BATCH_SIZE = 500
+
+_DEFAULTS = {
+    'poll_interval': 1.0,  # seconds between journal polls while streams are connected
+    'heartbeat': 15,  # seconds; a comment line keeps proxies from closing idle streams
+    'access_refresh': 60,  # seconds between re-checks of a stream's token and reloads of its accessible patients
+    'queue_size': 1000,  # events buffered per stream; a stream that falls behind is closed
+}
+
+
+def _stream_settings():
+    return {**_DEFAULTS, **getattr(settings, 'EVENT_STREAM', {})}
+
+
+class EventBroker:
+    """Fans journal events out to the subscribers (connected streams) of this process."""
+
+    def __init__(self):
+        self.subscribers = set()
+        self.cursor = None
+        self.task = None
+
+    def subscribe(self, queue_size):
+        queue = asyncio.Queue(maxsize=queue_size)
+        self.subscribers.add(queue)
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._poll())
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    def publish(self, event):
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # The stream is not keeping up; it is closed and the client resumes from its last id
+                self.subscribers.discard(queue)
+                print(f"Event stream dropped after falling {queue.qsize()} events behind")
+
+    def _fetch(self, cursor):
+        return list(ChangeEvent.objects.filter(pk__gt=cursor, created_at__lte=settled_before())
+                    .order_by('pk')[:POLL_BATCH_SIZE])
+
+    async def _poll(self):
+        interval = _stream_settings()['poll_interval']
+        try:
+            if self.cursor is None:
+                self.cursor = await sync_to_async(latest_cursor)(settled_before())
+            while self.subscribers:
+                try:
+                    events = await sync_to_async(self._fetch)(self.cursor)
+                except Exception as e:
+                    print(f"Error polling the change journal: {str(e)}")
+                    events = []
+                for event in events:
+                    self.cursor = event.pk
+                    self.publish(event)
+                if len(events) < POLL_BATCH_SIZE:
+                    await asyncio.sleep(interval)
+        finally:
+            # Polling starts again from the latest event with the next subscriber
+            self.task = None
+            self.cursor = None
+
+
+broker = EventBroker()
+
+
+def _authenticate(raw_token=None, raw_ticket=None):
+    """(user, session) for a bearer token or a stream ticket, or (None, None)."""
+    from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken, TokenError
+
+    from .authentication import CachedJWTAuthentication, redeem_stream_ticket, token_session
+
+    try:
+        if raw_ticket:
+            return redeem_stream_ticket(raw_ticket)
+        authentication = CachedJWTAuthentication()
+        token = authentication.get_validated_token(raw_token)
+        return authentication.get_user(token), token_session(token)
+    except (InvalidToken, TokenError, AuthenticationFailed):
+        return None, None
+
+
+def _session_user(session):
+    """The user of a connected stream, or None once its token is no longer valid."""
+    from rest_framework_simplejwt.exceptions import AuthenticationFailed
+
+    from .authentication import check_session
+
+    try:
+        return check_session(session)
+    except AuthenticationFailed:
+        return None
+
+
+def _accessible_pks(user):
+    """Accessible patient pks of user, None for staff (everything)."""
+    patient_pks = accessible_patient_pks(user)
+    return None if patient_pks is None else set(patient_pks)
+
+
+def _missed_events(user, accessible_pks, since):
+    """Visible events after since, or None if some of them are gone or there are too many."""
+    if is_expired(since):
+        return None
+    events = list(visible_changes(user, accessible_pks).filter(pk__gt=since, created_at__lte=settled_before())
+                  .order_by('pk')[:REPLAY_LIMIT + 1])
+    return None if len(events) > REPLAY_LIMIT else events
+
+
+def _sse(event_name, data, event_id=None):
+    lines = [f'id: {event_id}'] if event_id is not None else []
+    lines += [f'event: {event_name}', f'data: {json.dumps(data, separators=(",", ":"))}']
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+
+async def _send_error(send, status_code, message):
+    body = json.dumps({"status": "failed", "error": message}).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status_code,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def event_stream(scope, receive, send):
+    """ASGI app for GET /api/events/."""
+    if scope['method'] != 'GET':
+        return await _send_error(send, 405, "Method not allowed")
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+    params = {key: values[-1] for key, values in parse_qs(scope.get('query_string', b'').decode('latin-1')).items()}
+
+    raw_token = None
+    authorization = headers.get('authorization', '')
+    if authorization.lower().startswith('bearer '):
+        raw_token = authorization[7:].strip()
+    raw_ticket = None if raw_token else params.get('ticket')
+    user, session = await sync_to_async(_authenticate)(raw_token, raw_ticket) \
+        if raw_token or raw_ticket else (None, None)
+    if user is None:
+        return await _send_error(send, 401, "Authentication credentials were not provided or are invalid")
+
+    since = headers.get('last-event-id') or params.get('since')
+    try:
+        since = int(since) if since else None
+    except ValueError:
+        return await _send_error(send, 400, "since must be a cursor from a previous event")
+
+    options = _stream_settings()
+    loop = asyncio.get_event_loop()
+    accessible_pks = await sync_to_async(_accessible_pks)(user)
+    checked = loop.time()
+    # Subscribe before replaying, so nothing falls between the replay and the live events
+    queue = broker.subscribe(options['queue_size'])
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),  # No buffering in nginx
+        ]})
+        last_sent = since or 0
+        if since is None:
+            await send({'type': 'http.response.body', 'more_body': True,
+                        'body': _sse('ready', {"cursor": await sync_to_async(latest_cursor)(settled_before())})})
+        else:
+            missed = await sync_to_async(_missed_events)(user, accessible_pks, since)
+            if missed is None:
+                await send({'type': 'http.response.body', 'more_body': True, 'body': _sse('reset', {})})
+            for event in missed or []:
+                await send({'type': 'http.response.body', 'more_body': True,
+                            'body': _sse('change', change_to_dict(event), event.pk)})
+                last_sent = event.pk
+
+        while not disconnected.done():
+            if queue not in broker.subscribers and queue.empty():
+                break  # Dropped for falling behind
+            if loop.time() - checked > options['access_refresh']:
+                user = await sync_to_async(_session_user)(session)
+                if user is None:
+                    await send({'type': 'http.response.body', 'more_body': True, 'body': _sse('expired', {})})
+                    break
+                accessible_pks = await sync_to_async(_accessible_pks)(user)
+                checked = loop.time()
+            getter = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({getter, disconnected}, timeout=options['heartbeat'],
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if getter not in done:
+                getter.cancel()
+                if disconnected.done():
+                    break
+                await send({'type': 'http.response.body', 'body': b': ping\n\n', 'more_body': True})
+                continue
+            event = getter.result()
+            if event.pk <= last_sent:
+                continue
+            if changes_access(event):
+                accessible_pks = await sync_to_async(_accessible_pks)(user)
+            if is_visible(event, user.pk, accessible_pks):
+                await send({'type': 'http.response.body', 'more_body': True,
+                            'body': _sse('change', change_to_dict(event), event.pk)})
+            last_sent = event.pk
+        if not disconnected.done():
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        broker.unsubscribe(queue)
+        disconnected.cancel()
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
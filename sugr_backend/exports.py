@@ -0,0 +1,140 @@
+"""Streaming ZIP archives of patient documents.
+
+The archive is produced by a generator: each file is read from the blob store (or decoded from
+inline base64) chunk by chunk, compressed and handed to the response as it goes, so memory use
+does not depend on the size of the archive.
+"""
+import os
+import zipfile
+
+from django.http import StreamingHttpResponse
+
+from .downloads import Base64Payload, content_disposition
+from .models import FileData
+from .patient_files import extract_files_from_patient_data, is_blob_ref
+from .storage import get_blob_store
+
+ZIP_COMPRESS_LEVEL = 1  # Most documents are PDF/JPEG and barely compress, so favour speed
+
+
+class _ZipStream:
+    """Write-only file object for ZipFile; written bytes are held until drained.
+
+    It has no tell()/seek(), so ZipFile writes data descriptors instead of seeking back
+    to patch the local headers."""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def _safe_name(value, default='file'):
+    value = str(value or '').replace('/', '_').replace('\\', '_').strip().strip('.')
+    return value or default
+
+
+class ExportEntry:
+    """One archive member; open_chunks() returns an iterator of bytes, or None to skip the file."""
+
+    def __init__(self, name, open_chunks):
+        self.name = name
+        self.open_chunks = open_chunks
+
+
+def stream_zip(entries):
+    """Yield a ZIP archive of entries piece by piece."""
+    buffer = _ZipStream()
+    used_names = set()
+    with zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESS_LEVEL,
+                         allowZip64=True) as archive:
+        for entry in entries:
+            chunks = entry.open_chunks()
+            if chunks is None:
+                continue
+            name = entry.name
+            base, extension = os.path.splitext(name)
+            counter = 2
+            while name in used_names:
+                name = f'{base} ({counter}){extension}'
+                counter += 1
+            used_names.add(name)
+
+            # Opened by name, so the member gets the compression settings of the archive
+            with archive.open(name, mode='w', force_zip64=True) as member:
+                for chunk in chunks:
+                    member.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            data = buffer.drain()
+            if data:
+                yield data
+    # Closing the archive writes the central directory
+    yield buffer.drain()
+
+
+def zip_response(entries, filename):
+    response = StreamingHttpResponse(stream_zip(entries), content_type='application/zip')
+    response['Content-Disposition'] = content_disposition(filename, 'attachment')
+    response['Cache-Control'] = 'private, no-store'
+    return response
+
+
+def _blob_chunks(blob_hash):
+    def open_chunks():
+        store = get_blob_store()
+        if not store.exists(blob_hash):
+            print(f"Blob {blob_hash} missing, left out of the export")
+            return None
+        return store.iter_chunks(blob_hash)
+    return open_chunks
+
+
+def _inline_chunks(value, label):
+    def open_chunks():
+        data = value.get('data') if isinstance(value, dict) else value
+        try:
+            return Base64Payload(data).iter_chunks()
+        except (AttributeError, ValueError):
+            print(f"Invalid base64 data for {label}, left out of the export")
+            return None
+    return open_chunks
+
+
+def patient_export_entries(patient_data, user, folder=''):
+    """Archive entries for the embedded files of a patient and the FileData uploads visible to user."""
+    personal_info = patient_data.patient_personal_info or {}
+    for file_dict in extract_files_from_patient_data(patient_data, user.email, include_data=False):
+        section_name, field = file_dict['field_path'].split('.')
+        value = (personal_info.get(section_name) or {}).get(field)
+        name = f"{folder}{_safe_name(file_dict['file_category'])}/{_safe_name(file_dict['file_name'])}"
+        if is_blob_ref(value):
+            yield ExportEntry(name, _blob_chunks(value['blob_hash']))
+        else:
+            yield ExportEntry(name, _inline_chunks(value, file_dict['file_id']))
+
+    uploads = FileData.objects.filter(patient_id=patient_data.patient_id)
+    if not user.is_staff:
+        uploads = uploads.filter(user=user)
+    for file_data in uploads.order_by('uploaded_date'):
+        if not file_data.blob_hash:
+            continue
+        name = f"{folder}{_safe_name(file_data.file_category)}/{_safe_name(file_data.file_name)}"
+        yield ExportEntry(name, _blob_chunks(file_data.blob_hash))
+
+
+def patient_folder_name(patient_data):
+    section_1 = (patient_data.patient_personal_info or {}).get('section_1') or {}
+    name = ' '.join(part for part in (section_1.get('firstname'), section_1.get('lastname')) if part)
+    return _safe_name(f"{patient_data.patient_id} {name}".strip(), patient_data.patient_id)
@@ -0,0 +1,252 @@
+"""Image normalization: uploads are re-encoded within max_dimension, without EXIF.
+
+Uploads are stored as received and the request returns at once. Saving a FileData row or a
+patient whose image was not normalized yet (FileData.original_size None, a ref without
+"original_size") schedules a job keyed by the blob hash, see signals.py. The job streams the
+blob to a temporary file, re-encodes it in a worker process and points every row and ref of
+that hash at the result; a job lost with its process runs again on the next save.
+"""
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from PIL import Image, ImageOps
+
+NORMALIZED_CONTENT_TYPES = {
+    'JPEG': 'image/jpeg',
+    'WEBP': 'image/webp',
+}
+# Tries of a patient write that races with another save
+PATIENT_SAVE_RETRIES = 3
+
+_executor = None
+_executor_lock = threading.Lock()
+_jobs = None
+_jobs_pid = None
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def _ingest_settings():
+    config = {
+        'max_dimension': 2048,
+        'format': 'JPEG',
+        'quality': 82,
+        'workers': 2,
+        'timeout': 30,
+        'max_input_bytes': 40 * 1024 * 1024,
+    }
+    config.update(getattr(settings, 'IMAGE_INGEST', {}))
+    return config
+
+
+def is_image(data):
+    return (data.startswith(b'\xff\xd8\xff') or data.startswith(b'\x89PNG\r\n\x1a\n')
+            or (data[:4] == b'RIFF' and data[8:12] == b'WEBP'))
+
+
+def normalize_image_file(source_path, output_path, max_dimension, output_format, quality):
+    """Re-encode the image at source_path into output_path. Runs in a worker process.
+
+    Returns the content type written, or None when re-encoding would only make the file bigger."""
+    image = Image.open(source_path)
+    has_exif = bool(image.info.get('exif'))
+    oversized = max(image.size) > max_dimension
+    image.draft('RGB', (max_dimension, max_dimension))
+    image = ImageOps.exif_transpose(image)
+    if output_format == 'WEBP':
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    elif image.mode != 'RGB':
+        if 'A' in image.getbands():
+            # JPEG has no alpha channel, flatten onto white
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.convert('RGBA').split()[-1])
+            image = background
+        else:
+            image = image.convert('RGB')
+    image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+    if output_format == 'WEBP':
+        image.save(output_path, format='WEBP', quality=quality, method=4)
+    else:
+        image.save(output_path, format='JPEG', quality=quality, optimize=True, progressive=True)
+    if os.path.getsize(output_path) >= os.path.getsize(source_path) and not has_exif and not oversized:
+        return None
+    return NORMALIZED_CONTENT_TYPES[output_format]
+
+
+def get_executor():
+    """Process pool for image encoding, created lazily in each (gunicorn worker) process."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=_ingest_settings()['workers'],
+                                            mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+def _needs_normalization(head, size):
+    return 0 < size <= _ingest_settings()['max_input_bytes'] and is_image(head)
+
+
+def ingest_bytes(data, content_type):
+    """Store upload bytes; returns (blob_hash, stored_size, content_type, original_size).
+
+    original_size is None for an image that still has to be normalized."""
+    from .storage import get_blob_store
+
+    blob_hash, size = get_blob_store().put(data)
+    return blob_hash, size, content_type, (None if _needs_normalization(data[:16], size) else size)
+
+
+def ingest_stored_blob(blob_hash, size, content_type):
+    """Like ingest_bytes, for a blob that is in the store already (chunked uploads are assembled first)."""
+    from .storage import get_blob_store
+
+    head = b''.join(get_blob_store().iter_chunks(blob_hash, 0, min(size, 16)))
+    return blob_hash, size, content_type, (None if _needs_normalization(head, size) else size)
+
+
+def is_pending_ref(ref):
+    """Whether a blob reference of patient_personal_info still waits for normalization."""
+    return 'original_size' not in ref and str(ref.get('content_type', '')).startswith('image/')
+
+
+def schedule_normalization(blob_hash):
+    """Normalize a stored blob in the background; a hash queued or running already is skipped."""
+    global _jobs, _jobs_pid
+    with _pending_lock:
+        if _jobs_pid != os.getpid():
+            # Forked workers do not inherit the thread of a preloading master
+            _jobs, _jobs_pid = ThreadPoolExecutor(max_workers=1, thread_name_prefix='image-normalization'), os.getpid()
+            _pending.clear()
+        if blob_hash in _pending:
+            return
+        _pending.add(blob_hash)
+        _jobs.submit(_run_normalization, blob_hash)
+
+
+def _run_normalization(blob_hash):
+    try:
+        normalize_blob(blob_hash)
+    except Exception as e:
+        print(f"Error normalizing blob {blob_hash}: {str(e)}")
+    finally:
+        with _pending_lock:
+            _pending.discard(blob_hash)
+
+
+def _encode(source_path, output_path):
+    """Run normalize_image_file in the process pool; None on any failure or timeout."""
+    global _executor
+    config = _ingest_settings()
+    future = None
+    try:
+        future = get_executor().submit(normalize_image_file, source_path, output_path, config['max_dimension'],
+                                       config['format'].upper(), config['quality'])
+        return future.result(timeout=config['timeout'])
+    except BrokenProcessPool as e:
+        print(f"Image worker pool died, keeping original: {str(e)}")
+        with _executor_lock:
+            _executor = None
+    except Exception as e:
+        print(f"Image normalization failed, keeping original: {str(e)}")
+        if future is not None:
+            future.cancel()
+    return None
+
+
+def _iter_file(path, chunk_size):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def normalize_blob(blob_hash):
+    """Re-encode a stored image and point every FileData row and patient ref of it at the result.
+
+    Without a smaller result they keep the blob and just get their original_size."""
+    from .storage import get_blob_store, release_blob
+
+    store = get_blob_store()
+    size = store.size(blob_hash)
+    new_hash, new_size, content_type = blob_hash, size, None
+    head = b''.join(store.iter_chunks(blob_hash, 0, min(size, 16)))
+    if _needs_normalization(head, size):
+        fd, source_path = tempfile.mkstemp(prefix='sugr-ingest-')
+        output_path = source_path + '.out'
+        try:
+            with os.fdopen(fd, 'wb') as source:
+                for chunk in store.iter_chunks(blob_hash):
+                    source.write(chunk)
+            content_type = _encode(source_path, output_path)
+            if content_type is not None:
+                new_hash, new_size = store.put_stream(_iter_file(output_path, store.chunk_size))
+        finally:
+            for path in (source_path, output_path):
+                if os.path.exists(path):
+                    os.remove(path)
+    if content_type is None:
+        new_hash, new_size = blob_hash, size
+    _replace_file_data_blob(blob_hash, size, new_hash, new_size, content_type)
+    _replace_patient_refs(blob_hash, size, new_hash, new_size, content_type)
+    if new_hash != blob_hash:
+        release_blob(blob_hash)
+        release_blob(new_hash)  # If every reference went away in the meantime
+
+
+def _replace_file_data_blob(blob_hash, size, new_hash, new_size, content_type):
+    from .changes import record_file_change
+    from .models import FileData
+
+    for file_data in FileData.objects.filter(blob_hash=blob_hash, original_size__isnull=True):
+        file_data.original_size = size
+        update_fields = ['original_size']
+        if new_hash != blob_hash:
+            file_data.blob_hash, file_data.file_size, file_data.file_type = new_hash, new_size, content_type
+            update_fields += ['blob_hash', 'file_size', 'file_type']
+        file_data.save(update_fields=update_fields)
+        if new_hash != blob_hash:
+            record_file_change(file_data.file_id, file_data.patient_id, user_pk=file_data.user_id)
+
+
+def _replace_patient_refs(blob_hash, size, new_hash, new_size, content_type):
+    from .changes import record_patient_change
+    from .models import PatientData
+    from .mongo import get_collection
+    from .patient_files import PATIENT_FILE_FIELD_PATHS, is_blob_ref
+
+    query = {'$or': [{f'patient_personal_info.{field_path}.blob_hash': blob_hash}
+                     for field_path in PATIENT_FILE_FIELD_PATHS]}
+    patient_pks = [document['id'] for document in get_collection(PatientData).find(query, {'id': 1})]
+    for patient_pk in patient_pks:
+        for _ in range(PATIENT_SAVE_RETRIES):
+            patient = PatientData.objects.filter(pk=patient_pk).first()
+            if patient is None:
+                break
+            personal_info = patient.patient_personal_info or {}
+            paths = []
+            for field_path in PATIENT_FILE_FIELD_PATHS:
+                section_name, field = field_path.split('.')
+                section = personal_info.get(section_name)
+                ref = section.get(field) if isinstance(section, dict) else None
+                if not is_blob_ref(ref) or ref['blob_hash'] != blob_hash or not is_pending_ref(ref):
+                    continue
+                ref['original_size'] = size
+                if new_hash != blob_hash:
+                    ref.update({'blob_hash': new_hash, 'size': new_size, 'content_type': content_type,
+                                'original_hash': blob_hash})
+                paths.append(field_path)
+            if not paths:
+                break
+            if patient.save_if_version(patient.version, ['patient_personal_info']):
+                record_patient_change(patient, paths=paths)
+                break
@@ -0,0 +1,241 @@
+"""Cache invalidation bus across worker processes.
+
+In-process caches (authentication.py's users and revoked token ids, and whatever comes
+next) subscribe to an entity with subscribe(); write paths publish(entity, key) when it
+changed. record_change() publishes every journaled change of PatientAPI, MedicineAPI,
+FileAPI and the admin views, so those need no calls of their own.
+
+publish() runs the subscribers of this process at once and hands the message to the
+transport, and a listener thread in every other process runs theirs when it arrives. Every
+process runs the same code and so has the same subscriptions; an entity nobody subscribes
+to is not sent at all.
+
+- 'local': nothing leaves the process (runserver, tests, a single worker).
+- 'file': processes of one host append to and tail a shared file (INVALIDATION_BUS['path']),
+  moved to path + '.1' once it grows past 'max_bytes'.
+- 'mongo': a capped collection that every process tails, across hosts.
+
+Delivery is best effort; a message lost while a listener reconnects is covered by the TTL
+of the caches.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+_DEFAULTS = {
+    'transport': 'local',
+    'path': '/tmp/sugr-invalidation.log',  # file transport
+    'max_bytes': 1024 * 1024,  # file transport, size at which the file is rotated
+    'collection': 'cache_invalidations',  # mongo transport
+    'collection_size': 1024 * 1024,  # bytes of the capped collection
+    'poll_interval': 0.5,  # seconds between checks of the file, or retries after a mongo error
+}
+
+
+def _bus_settings():
+    return {**_DEFAULTS, **getattr(settings, 'INVALIDATION_BUS', {})}
+
+
+class LocalTransport:
+    """Only this process: publish() already ran the local subscribers."""
+
+    def send(self, message):
+        pass
+
+    def listen(self, deliver):
+        pass
+
+
+class FileTransport:
+    """Messages appended as JSON lines to a file shared by the processes of one host."""
+
+    def __init__(self, path, poll_interval, max_bytes):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.max_bytes = max_bytes
+
+    def send(self, message):
+        line = (json.dumps(message, separators=(',', ':')) + '\n').encode('utf-8')
+        while True:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            # Writers take turns, so lines do not interleave and only one of them rotates
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if self._is_current(fd):
+                break
+            os.close(fd)  # Rotated while waiting for the lock
+        try:
+            os.write(fd, line)
+            if os.fstat(fd).st_size > self.max_bytes:
+                os.replace(self.path, self.path + '.1')
+        finally:
+            os.close(fd)
+
+    def _is_current(self, fd):
+        """Whether fd is still the file at self.path, and not one rotated away meanwhile."""
+        try:
+            return os.stat(self.path).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError:
+            return False
+
+    def _open(self, at_end):
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return None
+        if at_end:
+            f.seek(0, os.SEEK_END)
+        return f
+
+    def listen(self, deliver):
+        f = self._open(at_end=True)
+        buffer = b''
+        while True:
+            if f is None:
+                f = self._open(at_end=False)
+            rotated = f is not None and not self._is_current(f.fileno())
+            chunk = f.read() if f is not None else b''
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                try:
+                    deliver(json.loads(line))
+                except ValueError:
+                    continue
+            if rotated:
+                # Nothing is written to a rotated file, and it was read to its end now
+                f.close()
+                f, buffer = self._open(at_end=False), b''
+            elif not chunk:
+                time.sleep(self.poll_interval)
+
+
+class MongoTransport:
+    """A capped collection tailed by every process, so messages reach other hosts too."""
+
+    def __init__(self, collection_name, collection_size, poll_interval):
+        self.collection_name = collection_name
+        self.collection_size = collection_size
+        self.poll_interval = poll_interval
+        self.collection = None
+
+    def _collection(self):
+        """The capped collection, created on first use; the handle is kept for the process."""
+        from pymongo.errors import CollectionInvalid
+
+        from .mongo import get_database
+
+        if self.collection is None:
+            database = get_database()
+            try:
+                database.create_collection(self.collection_name, capped=True, size=self.collection_size)
+            except CollectionInvalid:
+                pass  # Exists already
+            self.collection = database[self.collection_name]
+        return self.collection
+
+    def send(self, message):
+        self._collection().insert_one(dict(message))
+
+    def listen(self, deliver):
+        from pymongo import CursorType
+
+        last_id = None
+        while True:
+            try:
+                collection = self._collection()
+                if last_id is None:
+                    latest = collection.find_one(sort=[('$natural', -1)], projection={'_id': 1})
+                    # Start after the newest message; a capped collection needs one to tail
+                    last_id = latest['_id'] if latest else collection.insert_one({'origin': None}).inserted_id
+                # Tail in insertion order and skip up to the last message seen: ObjectIds made on
+                # other hosts are not ordered by insertion, so "_id > last_id" would miss some.
+                # If the last one was overwritten meanwhile, everything left is delivered.
+                skipping = collection.find_one({'_id': last_id}, {'_id': 1}) is not None
+                cursor = collection.find({}, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    for document in cursor:
+                        if skipping:
+                            skipping = document['_id'] != last_id
+                            continue
+                        last_id = document['_id']
+                        document.pop('_id')
+                        deliver(document)
+            except Exception as e:
+                print(f"Error tailing the invalidation bus: {str(e)}")
+            time.sleep(self.poll_interval)
+
+
+def _make_transport(options):
+    if options['transport'] == 'file':
+        return FileTransport(options['path'], options['poll_interval'], options['max_bytes'])
+    if options['transport'] == 'mongo':
+        return MongoTransport(options['collection'], options['collection_size'], options['poll_interval'])
+    return LocalTransport()
+
+
+class InvalidationBus:
+    def __init__(self, transport=None):
+        self.transport = transport
+        self.subscribers = {}
+        self.origin = None
+        self.pid = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, entity, callback):
+        """Call callback(key) whenever entity changed; key None means every entry of it."""
+        self.subscribers.setdefault(entity, []).append(callback)
+
+    def publish(self, entity, key=None):
+        if entity not in self.subscribers:
+            return
+        self.ensure_listening()
+        self._dispatch(entity, key)
+        try:
+            self.transport.send({'entity': entity, 'key': key, 'origin': self.origin})
+        except Exception as e:
+            print(f"Error publishing invalidation of {entity} {key}: {str(e)}")
+
+    def ensure_listening(self):
+        """Start the listener of this process; a cheap check once it runs.
+
+        Called from publish() and the cache reads rather than at startup, so management
+        commands never connect, and a worker forked from a preloading master starts its own."""
+        if self.pid == os.getpid():
+            return
+        with self._lock:
+            if self.pid == os.getpid():
+                return
+            if self.transport is None:
+                self.transport = _make_transport(_bus_settings())
+            self.origin = uuid.uuid4().hex
+            self.pid = os.getpid()
+            threading.Thread(target=self._listen, name='invalidation-bus', daemon=True).start()
+
+    def _listen(self):
+        try:
+            self.transport.listen(self._deliver)
+        except Exception as e:
+            print(f"Invalidation bus listener stopped: {str(e)}")
+
+    def _deliver(self, message):
+        if message.get('origin') in (None, self.origin):
+            return  # Ran locally when it was published
+        self._dispatch(message.get('entity'), message.get('key'))
+
+    def _dispatch(self, entity, key):
+        for callback in self.subscribers.get(entity, []):
+            try:
+                callback(key)
+            except Exception as e:
+                print(f"Error invalidating {entity} {key}: {str(e)}")
+
+
+bus = InvalidationBus()
+subscribe = bus.subscribe
+publish = bus.publish
+ensure_listening = bus.ensure_listening
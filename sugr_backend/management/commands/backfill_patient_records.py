@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from sugr_backend.models import PatientData
+from sugr_backend.mongo import get_collection
+from sugr_backend.patient_records import split_patient_records
+
+
+class Command(BaseCommand):
+    help = ('Move patient_medicines, patient_vitals, patient_notes and patient_signed_hc of every patient '
+            'to their own models. Safe to run while the API is serving; patients already moved are skipped, '
+            'interrupted moves are redone.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Patients loaded per batch (default 100).')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        collection = get_collection(PatientData)
+        moved = 0
+        skipped = 0
+        last_pk = 0
+        while True:
+            batch = list(collection.find({'id': {'$gt': last_pk}, 'records_split': {'$ne': True}}, {'_id': 0, 'id': 1})
+                         .sort('id', 1).limit(batch_size))
+            if not batch:
+                break
+            for document in batch:
+                last_pk = document['id']
+                if split_patient_records(document['id']):
+                    moved += 1
+                else:
+                    skipped += 1  # Being moved by a request right now
+            self.stdout.write(f"Moved the records of {moved} patients...")
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Records moved for {moved} patients ({skipped} were being moved by a request; run again to check).'))
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+
+from sugr_backend.models import PatientData
+from sugr_backend.patient_files import (
+    PATIENT_FILE_FIELD_PATHS, InvalidBlobRef, externalize_patient_files, is_blob_ref,
+)
+
+
+class Command(BaseCommand):
+    help = ('Move base64 files embedded in patient_personal_info (section_1.image and the section_4 '
+            'documents) into the blob store, leaving blob references in place.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50, help='Patients loaded per batch (default 50).')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would change without writing.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+        last_pk = 0
+        scanned = converted = 0
+        while True:
+            batch = list(PatientData.objects.filter(pk__gt=last_pk).order_by('pk')
+                         .only('pk', 'patient_id', 'patient_personal_info')[:batch_size])
+            if not batch:
+                break
+            for patient in batch:
+                last_pk = patient.pk
+                scanned += 1
+                personal_info = patient.patient_personal_info
+                if dry_run:
+                    changed = list(self._inline_file_paths(personal_info))
+                else:
+                    try:
+                        # The references already stored are what the check compares against
+                        changed = externalize_patient_files(personal_info, personal_info)
+                    except InvalidBlobRef as e:
+                        self.stderr.write(f"{patient.patient_id}: {str(e)}")
+                        continue
+                    if changed:
+                        patient.patient_personal_info = personal_info
+                        patient.save(update_fields=['patient_personal_info'])
+                if changed:
+                    converted += 1
+                    self.stdout.write(f"{patient.patient_id}: {', '.join(changed)}")
+            self.stdout.write(f"Scanned {scanned} patients...")
+        verb = 'Would convert' if dry_run else 'Converted'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {converted} of {scanned} patients.'))
+
+    def _inline_file_paths(self, personal_info):
+        if not isinstance(personal_info, dict):
+            return
+        for field_path in PATIENT_FILE_FIELD_PATHS:
+            section_name, field = field_path.split('.')
+            section = personal_info.get(section_name)
+            if isinstance(section, dict) and section.get(field) and not is_blob_ref(section[field]):
+                yield field_path
@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from sugr_backend.changes import retention_days
+from sugr_backend.models import ChangeEvent
+
+
+class Command(BaseCommand):
+    help = 'Delete change journal entries older than the retention; clients behind it get 410 and reload.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Age after which entries are deleted (default CHANGE_JOURNAL_RETENTION_DAYS).')
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else retention_days()
+        cutoff = timezone.now() - timedelta(days=days)
+        count, _ = ChangeEvent.objects.filter(created_at__lt=cutoff).delete()
+        self.stdout.write(self.style.SUCCESS(f'Purged {count} change events older than {days} days.'))
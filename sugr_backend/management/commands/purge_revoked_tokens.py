@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from sugr_backend.models import RevokedToken
+
+
+class Command(BaseCommand):
+    help = 'Delete revoked tokens that have expired anyway.'
+
+    def handle(self, *args, **options):
+        count, _ = RevokedToken.objects.filter(expires_at__lte=timezone.now()).delete()
+        self.stdout.write(self.style.SUCCESS(f'Purged {count} expired revoked tokens.'))
@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from sugr_backend.models import FileUpload
+from sugr_backend.storage import get_blob_store
+
+
+class Command(BaseCommand):
+    help = 'Delete chunked uploads that were never committed, together with their staged chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24, help='Age after which an upload is stale (default 24).')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        store = get_blob_store()
+        count = 0
+        for upload in FileUpload.objects.filter(created_date__lt=cutoff):
+            store.discard_staged(upload.upload_id)
+            upload.delete()
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f'Purged {count} stale uploads.'))
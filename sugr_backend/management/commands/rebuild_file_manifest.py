@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from sugr_backend.models import FileData, FileManifestEntry, PatientData
+from sugr_backend.patient_files import sync_file_data_manifest, sync_patient_file_manifest
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the file manifest from PatientData and FileData, e.g. after a failed write or a restore.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50, help='Patients loaded per batch (default 50).')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        patient_pks = set()
+        last_pk = 0
+        while True:
+            batch = list(PatientData.objects.filter(pk__gt=last_pk).order_by('pk')
+                         .only('pk', 'patient_id', 'user', 'patient_personal_info')[:batch_size])
+            if not batch:
+                break
+            for patient in batch:
+                last_pk = patient.pk
+                patient_pks.add(patient.pk)
+                sync_patient_file_manifest(patient)
+            self.stdout.write(f"Synced {len(patient_pks)} patients...")
+
+        file_ids = set()
+        for file_data in FileData.objects.all().iterator():
+            file_ids.add(file_data.file_id)
+            sync_file_data_manifest(file_data)
+
+        # Drop entries whose patient or upload no longer exists
+        orphans = [entry.file_id for entry in FileManifestEntry.objects.only('file_id', 'source', 'patient_pk')
+                   if (entry.source == 'patient_data' and entry.patient_pk not in patient_pks)
+                   or (entry.source == 'file_data' and entry.file_id not in file_ids)]
+        if orphans:
+            FileManifestEntry.objects.filter(file_id__in=orphans).delete()
+        self.stdout.write(self.style.SUCCESS(
+            f'Manifest rebuilt for {len(patient_pks)} patients and {len(file_ids)} uploads '
+            f'({len(orphans)} orphaned entries removed).'))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from sugr_backend.models import PatientAccess, PatientData
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the PatientAccess index from the patient owners and allowed_users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Patients loaded per batch (default 100).')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        wanted = set()
+        count = 0
+        last_pk = 0
+        while True:
+            batch = list(PatientData.objects.filter(pk__gt=last_pk).order_by('pk')
+                         .only('pk', 'user').prefetch_related('allowed_users')[:batch_size])
+            if not batch:
+                break
+            for patient in batch:
+                last_pk = patient.pk
+                count += 1
+                wanted.update((user.pk, patient.pk) for user in patient.allowed_users.all())
+                if patient.user_id:
+                    wanted.add((patient.user_id, patient.pk))
+            self.stdout.write(f"Read the access of {count} patients...")
+
+        current = {(row.user_pk, row.patient_pk): row.pk for row in PatientAccess.objects.all()}
+        stale = [pk for key, pk in current.items() if key not in wanted]
+        if stale:
+            PatientAccess.objects.filter(pk__in=stale).delete()
+        missing = [PatientAccess(user_pk=user_pk, patient_pk=patient_pk)
+                   for user_pk, patient_pk in wanted if (user_pk, patient_pk) not in current]
+        PatientAccess.objects.bulk_create(missing, batch_size=500)
+        self.stdout.write(self.style.SUCCESS(
+            f'Access index rebuilt: {len(missing)} rows added, {len(stale)} stale rows removed.'))
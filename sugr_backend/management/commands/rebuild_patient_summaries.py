@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from sugr_backend.models import PatientData, PatientSummary
+from sugr_backend.roster import sync_patient_summary
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the patient roster summaries from PatientData, e.g. after deploying or a restore.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Patients loaded per batch (default 100).')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        patient_pks = set()
+        last_pk = 0
+        while True:
+            batch = list(PatientData.objects.filter(pk__gt=last_pk).order_by('pk')
+                         .only('pk', 'patient_id', 'patient_personal_info', 'exit_info')[:batch_size])
+            if not batch:
+                break
+            for patient in batch:
+                last_pk = patient.pk
+                patient_pks.add(patient.pk)
+                sync_patient_summary(patient)
+            self.stdout.write(f"Synced {len(patient_pks)} patients...")
+
+        orphans = [pk for pk in PatientSummary.objects.values_list('patient_pk', flat=True) if pk not in patient_pks]
+        if orphans:
+            PatientSummary.objects.filter(patient_pk__in=orphans).delete()
+        self.stdout.write(self.style.SUCCESS(
+            f'Summaries rebuilt for {len(patient_pks)} patients ({len(orphans)} orphaned summaries removed).'))
@@ -0,0 +1,17 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from sugr_backend.storage import sweep_released_blobs
+
+
+class Command(BaseCommand):
+    help = 'Delete released blobs that are still unreferenced after the grace period.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24, help='Grace period after a release (default 24).')
+
+    def handle(self, *args, **options):
+        count = sweep_released_blobs(timezone.now() - timedelta(hours=options['hours']))
+        self.stdout.write(self.style.SUCCESS(f'Deleted {count} released blobs.'))
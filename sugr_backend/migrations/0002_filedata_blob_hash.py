@@ -0,0 +1,53 @@
+import base64
+
+from django.db import migrations, models
+
+
+def move_file_data_to_blob_store(apps, schema_editor):
+    from sugr_backend.storage import store_base64
+
+    FileData = apps.get_model('sugr_backend', 'FileData')
+    for file_data in FileData.objects.all().iterator():
+        if file_data.blob_hash or not file_data.file_data:
+            continue
+        try:
+            blob_hash, size = store_base64(file_data.file_data)
+        except ValueError as e:
+            print(f"Skipping file {file_data.file_id}: {e}")
+            continue
+        FileData.objects.filter(file_id=file_data.file_id).update(blob_hash=blob_hash, file_size=size)
+
+
+def move_blob_store_to_file_data(apps, schema_editor):
+    from sugr_backend.storage import get_blob_store
+
+    FileData = apps.get_model('sugr_backend', 'FileData')
+    store = get_blob_store()
+    for file_data in FileData.objects.exclude(blob_hash='').iterator():
+        encoded = base64.b64encode(store.read(file_data.blob_hash)).decode('ascii')
+        FileData.objects.filter(file_id=file_data.file_id).update(file_data=encoded)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sugr_backend', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filedata',
+            name='blob_hash',
+            field=models.CharField(db_index=True, default='', max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='filedata',
+            name='file_data',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.RunPython(move_file_data_to_blob_store, move_blob_store_to_file_data),
+        migrations.RemoveField(
+            model_name='filedata',
+            name='file_data',
+        ),
+    ]
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sugr_backend', '0002_filedata_blob_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileUpload',
+            fields=[
+                ('upload_id', models.CharField(max_length=255, primary_key=True, serialize=False, unique=True)),
+                ('patient_id', models.CharField(max_length=255)),
+                ('patient_firstname', models.CharField(blank=True, max_length=255)),
+                ('patient_lastname', models.CharField(blank=True, max_length=255)),
+                ('file_name', models.CharField(max_length=255)),
+                ('file_category', models.CharField(blank=True, max_length=255)),
+                ('file_type', models.CharField(max_length=255)),
+                ('file_size', models.BigIntegerField()),
+                ('chunk_size', models.IntegerField()),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='file_uploads', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+from sugr_backend.patient_files import extract_files_from_patient_data, file_data_manifest_values, manifest_values
+
+BATCH_SIZE = 50
+
+
+def build_file_manifest(apps, schema_editor):
+    # The metadata listing of FileAPI reads only the manifest, so the files stored so far need entries now
+    PatientData = apps.get_model('sugr_backend', 'PatientData')
+    FileData = apps.get_model('sugr_backend', 'FileData')
+    FileManifestEntry = apps.get_model('sugr_backend', 'FileManifestEntry')
+    User = apps.get_model('sugr_backend', 'User')
+    emails = dict(User.objects.values_list('pk', 'email'))
+    existing = set(FileManifestEntry.objects.values_list('file_id', flat=True))
+    last_pk = 0
+    while True:
+        batch = list(PatientData.objects.filter(pk__gt=last_pk).order_by('pk')
+                     .only('pk', 'patient_id', 'user', 'patient_personal_info')[:BATCH_SIZE])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        FileManifestEntry.objects.bulk_create([
+            FileManifestEntry(file_id=file_dict["file_id"], source="patient_data", patient_pk=patient.pk,
+                              **manifest_values(file_dict))
+            for patient in batch
+            for file_dict in extract_files_from_patient_data(patient, emails.get(patient.user_id, ''),
+                                                             include_data=False)
+            if file_dict["file_id"] not in existing
+        ])
+    FileManifestEntry.objects.bulk_create([
+        FileManifestEntry(file_id=file_data.file_id, **file_data_manifest_values(file_data))
+        for file_data in FileData.objects.all().iterator() if file_data.file_id not in existing
+    ], batch_size=500)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sugr_backend', '0003_fileupload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileManifestEntry',
+            fields=[
+                ('file_id', models.CharField(max_length=255, primary_key=True, serialize=False, unique=True)),
+                ('source', models.CharField(max_length=32)),
+                ('patient_pk', models.BigIntegerField(blank=True, db_index=True, null=True)),
+                ('patient_id', models.CharField(db_index=True, max_length=255)),
+                ('field_path', models.CharField(blank=True, max_length=255, null=True)),
+                ('patient_firstname', models.CharField(blank=True, max_length=255)),
+                ('patient_lastname', models.CharField(blank=True, max_length=255)),
+                ('file_name', models.CharField(max_length=255)),
+                ('file_category', models.CharField(db_index=True, max_length=255)),
+                ('file_size', models.BigIntegerField(default=0)),
+                ('file_type', models.CharField(max_length=255)),
+                ('uploaded_by', models.CharField(blank=True, max_length=255)),
+                ('uploaded_date', models.DateTimeField(blank=True, null=True)),
+                ('blob_hash', models.CharField(blank=True, default='', max_length=64)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='file_manifest_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(build_file_manifest, migrations.RunPython.noop),
+    ]
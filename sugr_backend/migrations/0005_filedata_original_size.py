@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sugr_backend', '0004_filemanifestentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filedata',
+            name='original_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
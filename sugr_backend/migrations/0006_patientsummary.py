@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sugr_backend', '0005_filedata_original_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientSummary',
+            fields=[
+                ('patient_pk', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('patient_id', models.CharField(db_index=True, max_length=255)),
+                ('firstname', models.CharField(blank=True, max_length=255)),
+                ('lastname', models.CharField(blank=True, max_length=255)),
+                ('sort_name', models.CharField(blank=True, db_index=True, max_length=512)),
+                ('room', models.CharField(blank=True, db_index=True, max_length=255)),
+                ('care_type', models.CharField(blank=True, max_length=255)),
+                ('gender', models.CharField(blank=True, max_length=64)),
+                ('photo_hash', models.CharField(blank=True, default='', max_length=64)),
+                ('active', models.BooleanField(db_index=True, default=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
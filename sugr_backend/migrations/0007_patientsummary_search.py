@@ -0,0 +1,57 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:46
+
+from django.db import migrations, models
+import djongo.models.fields
+
+
+SEARCH_ARRAY_FIELDS = ['search_prefixes', 'search_trigrams']
+
+
+def create_search_indexes(apps, schema_editor):
+    # Multikey indexes on the array fields; Django has no way to declare these for djongo
+    if schema_editor.connection.vendor != 'djongo':
+        return
+    PatientSummary = apps.get_model('sugr_backend', 'PatientSummary')
+    collection = schema_editor.connection.connection[PatientSummary._meta.db_table]
+    for field in SEARCH_ARRAY_FIELDS:
+        collection.create_index(field, name=f'patientsummary_{field}')
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'djongo':
+        return
+    PatientSummary = apps.get_model('sugr_backend', 'PatientSummary')
+    collection = schema_editor.connection.connection[PatientSummary._meta.db_table]
+    for field in SEARCH_ARRAY_FIELDS:
+        collection.drop_index(f'patientsummary_{field}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sugr_backend', '0006_patientsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patientsummary',
+            name='citizen_id',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='patientsummary',
+            name='room_number',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='patientsummary',
+            name='search_prefixes',
+            field=djongo.models.fields.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='patientsummary',
+            name='search_trigrams',
+            field=djongo.models.fields.JSONField(blank=True, default=list),
+        ),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:47
+
+from django.db import migrations, models
+
+from sugr_backend.roster import summary_values
+
+BATCH_SIZE = 100
+
+
+def build_patient_summaries(apps, schema_editor):
+    # The roster, its facets and search read only PatientSummary, so existing patients need theirs now
+    PatientData = apps.get_model('sugr_backend', 'PatientData')
+    PatientSummary = apps.get_model('sugr_backend', 'PatientSummary')
+    existing = set(PatientSummary.objects.values_list('patient_pk', flat=True))
+    last_pk = 0
+    while True:
+        batch = list(PatientData.objects.filter(pk__gt=last_pk).order_by('pk')
+                     .only('pk', 'patient_id', 'patient_personal_info', 'exit_info')[:BATCH_SIZE])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        PatientSummary.objects.bulk_create([PatientSummary(patient_pk=patient.pk, **summary_values(patient))
+                                            for patient in batch if patient.pk not in existing])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sugr_backend', '0007_patientsummary_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patientsummary',
+            name='blood_type',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='patientsummary',
+            name='insurance',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='patientsummary',
+            name='room_no',
+            field=models.IntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='patientsummary',
+            name='care_type',
+            field=models.CharField(blank=True, db_index=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='patientsummary',
+            name='gender',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.RunPython(build_patient_summaries, migrations.RunPython.noop),
+    ]
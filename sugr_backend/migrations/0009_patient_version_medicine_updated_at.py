@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sugr_backend', '0008_patientsummary_facets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='medicinedata',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='patientdata',
+            name='version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
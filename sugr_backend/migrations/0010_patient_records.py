@@ -0,0 +1,96 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:58
+
+from django.db import migrations, models
+import djongo.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sugr_backend', '0009_patient_version_medicine_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VitalReading',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('patient_pk', models.BigIntegerField(db_index=True)),
+                ('vital_type', models.CharField(db_index=True, max_length=32)),
+                ('value', models.FloatField(blank=True, null=True)),
+                ('date_key', models.CharField(blank=True, default='', max_length=32)),
+                ('timestamp', models.CharField(blank=True, default='', max_length=255)),
+                ('recorded_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='patientdata',
+            name='records_split',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='SignedHCEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('patient_pk', models.BigIntegerField(db_index=True)),
+                ('date_key', models.CharField(db_index=True, max_length=32)),
+                ('hc_type', models.CharField(max_length=255)),
+                ('position', models.IntegerField(default=0)),
+                ('signed_hc_id', models.CharField(blank=True, default='', max_length=255)),
+                ('signed_hc_data', djongo.models.fields.JSONField(blank=True, default=dict)),
+                ('created_by', models.CharField(blank=True, default='', max_length=255)),
+                ('insert_ts', models.CharField(blank=True, default='', max_length=255)),
+            ],
+            options={
+                'unique_together': {('patient_pk', 'date_key', 'hc_type', 'position')},
+            },
+        ),
+        migrations.CreateModel(
+            name='PatientNote',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('patient_pk', models.BigIntegerField(db_index=True)),
+                ('note_id', models.CharField(db_index=True, max_length=255)),
+                ('note_title', models.TextField(blank=True, default='')),
+                ('note_data', models.TextField(blank=True, default='')),
+                ('note_date', models.CharField(blank=True, default='', max_length=64)),
+                ('created_by', models.CharField(blank=True, default='', max_length=255)),
+                ('timestamp', models.CharField(blank=True, default='', max_length=255)),
+                ('updated_at', models.CharField(blank=True, default='', max_length=255)),
+            ],
+            options={
+                'unique_together': {('patient_pk', 'note_id')},
+            },
+        ),
+        migrations.CreateModel(
+            name='MedicationOrder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('patient_pk', models.BigIntegerField(db_index=True)),
+                ('medicine_id', models.CharField(db_index=True, max_length=255)),
+                ('medicine_data', djongo.models.fields.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('patient_pk', 'medicine_id')},
+            },
+        ),
+        migrations.CreateModel(
+            name='MedicationAdministration',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('patient_pk', models.BigIntegerField(db_index=True)),
+                ('medicine_id', models.CharField(db_index=True, max_length=255)),
+                ('kind', models.CharField(max_length=16)),
+                ('period', models.CharField(blank=True, default='', max_length=32)),
+                ('date_key', models.CharField(db_index=True, max_length=32)),
+                ('given', models.BooleanField(default=True)),
+                ('timestamp', models.CharField(blank=True, default='', max_length=255)),
+                ('recorded_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('patient_pk', 'medicine_id', 'kind', 'period', 'date_key')},
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:00
+
+from django.db import migrations, models
+import djongo.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sugr_backend', '0010_patient_records'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entity', models.CharField(max_length=32)),
+                ('entity_id', models.CharField(max_length=255)),
+                ('action', models.CharField(max_length=16)),
+                ('paths', djongo.models.fields.JSONField(blank=True, default=list)),
+                ('patient_pk', models.BigIntegerField(blank=True, db_index=True, null=True)),
+                ('user_pk', models.BigIntegerField(blank=True, db_index=True, null=True)),
+                ('version', models.BigIntegerField(blank=True, null=True)),
+                ('changed_by', models.CharField(blank=True, default='', max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
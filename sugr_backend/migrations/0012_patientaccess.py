@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:02
+
+from django.db import migrations, models
+
+
+def build_patient_access(apps, schema_editor):
+    # The access checks read only PatientAccess from now on, so it must be complete right away
+    PatientData = apps.get_model('sugr_backend', 'PatientData')
+    PatientAccess = apps.get_model('sugr_backend', 'PatientAccess')
+    rows = {(user_pk, patient_pk) for patient_pk, user_pk in PatientData.objects.values_list('pk', 'user_id')
+            if user_pk}
+    rows.update((user_pk, patient_pk) for patient_pk, user_pk
+                in PatientData.allowed_users.through.objects.values_list('patientdata_id', 'user_id'))
+    PatientAccess.objects.bulk_create([PatientAccess(user_pk=user_pk, patient_pk=patient_pk)
+                                       for user_pk, patient_pk in rows], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sugr_backend', '0011_changeevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientAccess',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_pk', models.BigIntegerField(db_index=True)),
+                ('patient_pk', models.BigIntegerField(db_index=True)),
+            ],
+            options={
+                'unique_together': {('user_pk', 'patient_pk')},
+            },
+        ),
+        migrations.RunPython(build_patient_access, migrations.RunPython.noop),
+    ]
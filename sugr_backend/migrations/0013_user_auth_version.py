@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sugr_backend', '0012_patientaccess'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='auth_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sugr_backend', '0014_revokedtoken'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patientdata',
+            name='records_moving',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
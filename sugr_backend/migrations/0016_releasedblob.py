@@ -0,0 +1,20 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sugr_backend', '0015_patientdata_records_moving'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReleasedBlob',
+            fields=[
+                ('blob_hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('released_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -10,6 +10,7 @@ class MedicineData(models.Model):
     medicine_id = models.CharField(primary_key=True, max_length=255, unique=True)
     # models.AutoField(primary_key=True, unique=True)
     medicine_data = JSONField()
+    updated_at = models.DateTimeField(auto_now=True, null=True)
 
     REQUIRED_FIELDS = ['medicine_data']
 
@@ -32,9 +33,39 @@ class PatientData(models.Model):
     patient_vitals = JSONField(default=dict)
     patient_notes = JSONField(default=dict)
     exit_info = JSONField(default=dict, null=True, blank=True)
+    version = models.BigIntegerField(default=0)  # Incremented on every save, used as the ETag
+    # True once the four fields above were moved to their own models (see patient_records.py)
+    records_split = models.BooleanField(default=False)
+    # Set while a request moves them (readers keep using the JSON fields until records_split) or replaces their rows
+    records_moving = models.DateTimeField(null=True, blank=True)
 
     REQUIRED_FIELDS = ['user', 'patient_id', 'patient_personal_info', 'patient_medicines',
                        'patient_signed_hc']
+
+    def save(self, *args, **kwargs):
+        self.version = (self.version or 0) + 1
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {'version'}
+        super().save(*args, **kwargs)
+
+    def save_if_version(self, expected_version, update_fields):
+        """Compare-and-swap save: write update_fields only if the stored version is still expected_version.
+
+        Returns False, without writing, when someone else saved the patient in the meantime."""
+        from django.db.models.signals import post_save
+
+        values = {field: getattr(self, field) for field in update_fields}
+        updated = PatientData.objects.filter(pk=self.pk, version=expected_version) \
+            .update(version=expected_version + 1, **values)
+        if not updated:
+            return False
+        self.version = expected_version + 1
+        # QuerySet.update() sends no signals; the manifest and roster listen to post_save
+        post_save.send(sender=PatientData, instance=self, created=False, raw=False, using=self._state.db,
+                       update_fields=frozenset(update_fields) | {'version'})
+        return True
+
     def __str__(self):
         return self.patient_id
 
@@ -48,17 +79,173 @@ class FileData(models.Model):
     file_name = models.CharField(max_length=255)
     file_category = models.CharField(max_length=255)
     file_size = models.IntegerField()
+    original_size = models.BigIntegerField(null=True, blank=True)  # Size as uploaded, before image normalization
     uploaded_by = models.CharField(max_length=255)
     uploaded_date = models.DateTimeField(auto_now_add=True)
-    file_data = models.TextField()  # Base64 encoded file data
-    file_type = models.CharField(max_length=255)
+    blob_hash = models.CharField(max_length=64, db_index=True, default='')  # SHA-256 of the bytes in the blob store
+    file_type = models.CharField(max_length=255)  # MIME type
+
+    REQUIRED_FIELDS = ['user', 'patient_id', 'file_name', 'file_category', 'blob_hash']
+
+    def __str__(self):
+        return self.file_id
+
+
+class FileManifestEntry(models.Model):
+    """Listing index of every file: FileData uploads and files embedded in patient_personal_info.
 
-    REQUIRED_FIELDS = ['user', 'patient_id', 'file_name', 'file_category', 'file_data']
+    Kept in sync from the PatientData/FileData signals, so file listings are one indexed
+    query instead of a scan of all patient documents."""
+    file_id = models.CharField(primary_key=True, max_length=255, unique=True)
+    source = models.CharField(max_length=32)  # "file_data" or "patient_data"
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, blank=True,
+                             related_name='file_manifest_entries')  # Uploader, for FileData entries only
+    patient_pk = models.BigIntegerField(null=True, blank=True, db_index=True)  # PatientData.pk, for embedded files only
+    patient_id = models.CharField(max_length=255, db_index=True)
+    field_path = models.CharField(max_length=255, null=True, blank=True)
+    patient_firstname = models.CharField(max_length=255, blank=True)
+    patient_lastname = models.CharField(max_length=255, blank=True)
+    file_name = models.CharField(max_length=255)
+    file_category = models.CharField(max_length=255, db_index=True)
+    file_size = models.BigIntegerField(default=0)
+    file_type = models.CharField(max_length=255)
+    uploaded_by = models.CharField(max_length=255, blank=True)
+    uploaded_date = models.DateTimeField(null=True, blank=True)
+    blob_hash = models.CharField(max_length=64, blank=True, default='')
 
     def __str__(self):
         return self.file_id
 
 
+class PatientSummary(models.Model):
+    """Compact per-patient card for the roster, kept in sync from the PatientData signals."""
+    patient_pk = models.BigIntegerField(primary_key=True)  # PatientData.pk
+    patient_id = models.CharField(max_length=255, db_index=True)
+    firstname = models.CharField(max_length=255, blank=True)
+    lastname = models.CharField(max_length=255, blank=True)
+    sort_name = models.CharField(max_length=512, db_index=True, blank=True)  # Collation key of "lastname firstname"
+    room = models.CharField(max_length=255, db_index=True, blank=True)
+    room_no = models.IntegerField(null=True, blank=True, db_index=True)  # Numeric part of room, for range filters
+    care_type = models.CharField(max_length=255, db_index=True, blank=True)
+    gender = models.CharField(max_length=64, db_index=True, blank=True)
+    insurance = models.CharField(max_length=255, db_index=True, blank=True, default='')
+    blood_type = models.CharField(max_length=16, db_index=True, blank=True, default='')
+    photo_hash = models.CharField(max_length=64, blank=True, default='')
+    active = models.BooleanField(default=True, db_index=True)  # False once the patient has exited
+    # Search index, see search.py (the array fields get multikey indexes in migration 0007)
+    citizen_id = models.CharField(max_length=64, db_index=True, blank=True, default='')
+    room_number = models.CharField(max_length=32, db_index=True, blank=True, default='')
+    search_prefixes = JSONField(default=list, blank=True)
+    search_trigrams = JSONField(default=list, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.patient_id
+
+
+class MedicationOrder(models.Model):
+    """A medicine scheduled for a patient (an entry of the former PatientData.patient_medicines)."""
+    patient_pk = models.BigIntegerField(db_index=True)  # PatientData.pk
+    medicine_id = models.CharField(max_length=255, db_index=True)
+    medicine_data = JSONField(default=dict)  # Without prepared_dates/given_dates, see MedicationAdministration
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [('patient_pk', 'medicine_id')]
+
+    def __str__(self):
+        return self.medicine_id
+
+
+class MedicationAdministration(models.Model):
+    """A scheduled medicine prepared for a day, or given in one period of a day."""
+    PREPARED = 'prepared'
+    GIVEN = 'given'
+
+    patient_pk = models.BigIntegerField(db_index=True)
+    medicine_id = models.CharField(max_length=255, db_index=True)
+    kind = models.CharField(max_length=16)  # PREPARED or GIVEN
+    period = models.CharField(max_length=32, blank=True, default='')  # morning/noon/evening, for GIVEN only
+    date_key = models.CharField(max_length=32, db_index=True)  # dd-mm-yy
+    given = models.BooleanField(default=True)
+    timestamp = models.CharField(max_length=255, blank=True, default='')  # Client date string, if sent
+    recorded_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [('patient_pk', 'medicine_id', 'kind', 'period', 'date_key')]
+
+
+class VitalReading(models.Model):
+    patient_pk = models.BigIntegerField(db_index=True)
+    vital_type = models.CharField(max_length=32, db_index=True)
+    value = models.FloatField(null=True, blank=True)
+    date_key = models.CharField(max_length=32, blank=True, default='')  # dd-mm-yy
+    timestamp = models.CharField(max_length=255, blank=True, default='')
+    recorded_at = models.DateTimeField(auto_now_add=True)
+
+
+class PatientNote(models.Model):
+    patient_pk = models.BigIntegerField(db_index=True)
+    note_id = models.CharField(max_length=255, db_index=True)
+    note_title = models.TextField(blank=True, default='')
+    note_data = models.TextField(blank=True, default='')
+    note_date = models.CharField(max_length=64, blank=True, default='')  # dd-mm-yy HH:MM:SS
+    created_by = models.CharField(max_length=255, blank=True, default='')
+    timestamp = models.CharField(max_length=255, blank=True, default='')
+    updated_at = models.CharField(max_length=255, blank=True, default='')  # Client date string of the last edit
+
+    class Meta:
+        unique_together = [('patient_pk', 'note_id')]
+
+    def __str__(self):
+        return self.note_id
+
+
+class SignedHCEntry(models.Model):
+    """One signature of a health care form type on a day; later signatures of the same form are updates."""
+    patient_pk = models.BigIntegerField(db_index=True)
+    date_key = models.CharField(max_length=32, db_index=True)  # dd-mm-yy
+    hc_type = models.CharField(max_length=255)
+    position = models.IntegerField(default=0)  # 0 for the first signature of the day
+    signed_hc_id = models.CharField(max_length=255, blank=True, default='')
+    signed_hc_data = JSONField(default=dict, blank=True)  # Other values are wrapped, see patient_records.py
+    created_by = models.CharField(max_length=255, blank=True, default='')
+    insert_ts = models.CharField(max_length=255, blank=True, default='')
+
+    class Meta:
+        unique_together = [('patient_pk', 'date_key', 'hc_type', 'position')]
+
+
+class FileUpload(models.Model):
+    """A resumable chunked upload in progress; chunks are staged in the blob store until commit."""
+    upload_id = models.CharField(primary_key=True, max_length=255, unique=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='file_uploads')
+    patient_id = models.CharField(max_length=255)
+    patient_firstname = models.CharField(max_length=255, blank=True)
+    patient_lastname = models.CharField(max_length=255, blank=True)
+    file_name = models.CharField(max_length=255)
+    file_category = models.CharField(max_length=255, blank=True)
+    file_type = models.CharField(max_length=255)  # MIME type
+    file_size = models.BigIntegerField()  # Total size announced by the client
+    chunk_size = models.IntegerField()
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    REQUIRED_FIELDS = ['user', 'patient_id', 'file_name', 'file_size', 'chunk_size']
+
+    @property
+    def chunk_count(self):
+        return max((self.file_size + self.chunk_size - 1) // self.chunk_size, 1)
+
+    def expected_chunk_size(self, index):
+        if index < self.chunk_count - 1:
+            return self.chunk_size
+        return self.file_size - self.chunk_size * (self.chunk_count - 1)
+
+    def __str__(self):
+        return self.upload_id
+
+
 def default_permission_codes():
     return [
         "view_dashboard", "view_patients", "view_drugs", "view_files",
@@ -69,17 +256,33 @@ def default_permission_codes():
     ]
 
 
+class ReleasedBlob(models.Model):
+    """A blob whose last reference went away; sweep_released_blobs deletes it after a grace
+    period if nothing references it by then (a write in between may share it again)."""
+    blob_hash = models.CharField(primary_key=True, max_length=64)
+    released_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.blob_hash
+
+
 class User(AbstractUser):
     first_name = models.CharField(max_length=255)
     last_name = models.CharField(max_length=255)
     email = models.EmailField(unique=True)
     password = models.CharField(max_length=255)
     permission_codes = models.JSONField(default=default_permission_codes, blank=True)
+    # Bumped whenever permission_codes or is_staff change; cached users of an older version are reloaded
+    auth_version = models.IntegerField(default=0)
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['first_name', 'last_name', 'password']
 
     def get_permission_codes(self):
+        # Resolved once for users from the authentication cache
+        cached = getattr(self, '_cached_permission_codes', None)
+        if cached is not None:
+            return list(cached)
         # Staff (admin) always get full permissions so they can see and manage everything.
         if self.is_staff:
             base = list(default_permission_codes())
@@ -90,3 +293,39 @@ class User(AbstractUser):
         if self.permission_codes is None:
             return default_permission_codes()
         return self.permission_codes
+
+
+class ChangeEvent(models.Model):
+    """Append-only journal of writes, read by the change feed (see changes.py); the pk is the cursor."""
+    entity = models.CharField(max_length=32)  # patient, file, medicine or user
+    entity_id = models.CharField(max_length=255)
+    action = models.CharField(max_length=16)  # created, updated, deleted or revoked
+    paths = JSONField(default=list, blank=True)  # Changed field paths; empty when the whole entity changed
+    patient_pk = models.BigIntegerField(null=True, blank=True, db_index=True)  # Visible to who can access it
+    user_pk = models.BigIntegerField(null=True, blank=True, db_index=True)  # Visible to this user
+    version = models.BigIntegerField(null=True, blank=True)  # Patient version after the change
+    changed_by = models.CharField(max_length=255, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+class PatientAccess(models.Model):
+    """Materialized access index: one row per user that can access a patient (owner or allowed_users).
+
+    Kept in sync from the PatientData/allowed_users signals (see access.py), so the access
+    check of every request is one indexed lookup instead of a join over the M2M table."""
+    user_pk = models.BigIntegerField(db_index=True)
+    patient_pk = models.BigIntegerField(db_index=True)
+
+    class Meta:
+        unique_together = [('user_pk', 'patient_pk')]
+
+
+class RevokedToken(models.Model):
+    """A refresh, sliding or access token that was logged out or rotated; see authentication.py.
+
+    Rows are only needed until the token expires (purge_revoked_tokens)."""
+    jti = models.CharField(max_length=255, unique=True)
+    token_type = models.CharField(max_length=16)
+    user_pk = models.BigIntegerField(null=True, blank=True)
+    expires_at = models.DateTimeField(db_index=True)
+    revoked_at = models.DateTimeField(auto_now_add=True)
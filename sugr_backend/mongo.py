@@ -0,0 +1,13 @@
+from django.db import connections
+
+
+def get_database(using='default'):
+    """Return the pymongo Database behind the djongo connection."""
+    connection = connections[using]
+    connection.ensure_connection()
+    return connection.connection
+
+
+def get_collection(model, using='default'):
+    """Return the pymongo Collection that stores the given Django model."""
+    return get_database(using)[model._meta.db_table]
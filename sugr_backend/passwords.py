@@ -0,0 +1,60 @@
+"""Password hashing limited across the worker processes of a host.
+
+PBKDF2 takes a noticeable amount of CPU per call, and at shift change many staff log in at
+once. A limit per process does not help with a few sync workers: each of them would still
+spend itself on hashing. So a hash first takes one of PASSWORD_HASHING['slots'] lock files
+(flock, shared by every process of the host and released if a process dies); keep 'slots'
+below the worker count, so a worker stays free for the API traffic. A caller that finds every
+slot taken gets PasswordHashingBusy right away (503 with Retry-After from the views) rather
+than waiting for one, which would hold its worker just the same.
+"""
+import fcntl
+import os
+
+from django.conf import settings
+
+_DEFAULTS = {
+    'slots': 2,  # hashes running at once on the host, below the worker count
+    'retry_after': 2,  # seconds clients are told to wait when every slot is taken
+    'lock_dir': '/tmp/sugr-password-hashing',
+}
+
+
+class PasswordHashingBusy(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Every password hashing slot is taken, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+def _hashing_settings():
+    return {**_DEFAULTS, **getattr(settings, 'PASSWORD_HASHING', {})}
+
+
+def _try_slot(options):
+    """File descriptor of a slot lock that was free, or None."""
+    os.makedirs(options['lock_dir'], exist_ok=True)
+    for slot in range(options['slots']):
+        fd = os.open(os.path.join(options['lock_dir'], f'slot-{slot}.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            os.close(fd)
+    return None
+
+
+def run_password_hashing(function, *args, **kwargs):
+    """Run function (which hashes a password) in a free slot and return its result."""
+    options = _hashing_settings()
+    fd = _try_slot(options)
+    if fd is None:
+        raise PasswordHashingBusy(options['retry_after'])
+    try:
+        return function(*args, **kwargs)
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def check_password(user, password):
+    return run_password_hashing(user.check_password, password)
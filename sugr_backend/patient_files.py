@@ -0,0 +1,432 @@
+"""Files embedded in PatientData.patient_personal_info (the photo and the section_4 documents).
+
+On write the base64 payloads are moved into the blob store and replaced by a small reference:
+    {"blob_hash": "<sha256>", "size": 1234, "content_type": "application/pdf", "filename": "moca.pdf"}
+so patient reads and writes no longer carry the attachment bytes. Images are normalized after
+the save (see ingest.py); the ref then also carries "original_size", the size of the upload as
+received, and "original_hash" if the blob was replaced.
+"""
+from datetime import datetime
+
+from django.utils.dateparse import parse_datetime
+
+from .ingest import ingest_bytes
+from .storage import BlobNotFound, check_blob_hash, decode_base64_payload, read_base64
+
+PATIENT_FILE_FIELD_PATHS = ['section_1.image'] + [f'section_4.{field}' for field in (
+    'psychiatricMedPrescriptionFile',
+    'depressionScaleFile',
+    'mocaFile',
+    'miniCogFile',
+    'socialReportFile',
+)]
+
+DEFAULT_CONTENT_TYPES = {
+    'section_1': 'image/jpeg',
+    'section_4': 'application/pdf',
+}
+
+
+class InvalidBlobRef(ValueError):
+    pass
+
+
+def is_blob_ref(value):
+    return isinstance(value, dict) and bool(value.get('blob_hash'))
+
+
+def _file_field(personal_info, field_path):
+    """(section dict, field name) of a file field path, section None if personal_info lacks it."""
+    section_name, field = field_path.split('.')
+    section = personal_info.get(section_name) if isinstance(personal_info, dict) else None
+    return (section if isinstance(section, dict) else None), field
+
+
+def check_blob_refs(personal_info, current_info=None):
+    """Make sure every blob reference in personal_info is the one stored at that field already.
+
+    Clients only send references back unchanged; any other one could point at a blob of
+    someone else. A reference read before its image was normalized still matches by its
+    original_hash. Matching references are replaced (in place) by the stored ones, so the
+    client cannot change their size or type either. Raises InvalidBlobRef otherwise."""
+    for field_path in PATIENT_FILE_FIELD_PATHS:
+        section, field = _file_field(personal_info, field_path)
+        value = section.get(field) if section is not None else None
+        if not is_blob_ref(value):
+            continue
+        current_section, _ = _file_field(current_info, field_path)
+        stored = current_section.get(field) if current_section is not None else None
+        try:
+            check_blob_hash(value['blob_hash'])
+        except BlobNotFound:
+            raise InvalidBlobRef(f"Invalid file reference in {field_path}")
+        if not is_blob_ref(stored) or value['blob_hash'] not in (stored['blob_hash'], stored.get('original_hash')):
+            raise InvalidBlobRef(f"File reference in {field_path} does not match the stored file")
+        section[field] = dict(stored)
+
+
+def read_ref_base64(ref):
+    """Base64 of a referenced blob, for responses that still embed the file bytes."""
+    try:
+        return read_base64(ref['blob_hash'])
+    except BlobNotFound:
+        print(f"Blob {ref['blob_hash']} missing from the blob store")
+        return ""
+
+
+def make_blob_ref(blob_hash, size, content_type, filename=None, original_size=None):
+    ref = {"blob_hash": blob_hash, "size": size, "content_type": content_type}
+    if filename:
+        ref["filename"] = filename
+    if original_size is not None:
+        ref["original_size"] = original_size
+    return ref
+
+
+def guess_content_type(data, default):
+    if data.startswith(b'%PDF'):
+        return 'application/pdf'
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return default
+
+
+def _data_url_content_type(value):
+    if value.startswith('data:') and ';base64,' in value[:100]:
+        return value[5:value.index(';base64,')] or None
+    return None
+
+
+def store_patient_file(value, section, filename=None):
+    """Move one embedded base64 payload (string or {data, filename} dict) into the blob store.
+
+    Returns the blob reference, or None if the value holds no decodable file data."""
+    if isinstance(value, dict):
+        filename = value.get('filename') or filename
+        value = value.get('data')
+    if not isinstance(value, str) or not value.strip():
+        return None
+    try:
+        data = decode_base64_payload(value)
+    except ValueError:
+        return None
+    if not data:
+        return None
+    content_type = _data_url_content_type(value.strip()) or guess_content_type(
+        data, DEFAULT_CONTENT_TYPES.get(section, 'application/octet-stream'))
+    blob_hash, size, content_type, original_size = ingest_bytes(data, content_type)
+    return make_blob_ref(blob_hash, size, content_type, filename, original_size)
+
+
+def externalize_patient_files(personal_info, current_info=None):
+    """Replace inline base64 files in personal_info (in place) with blob references.
+
+    current_info is the stored personal_info of the patient (None for a new one); references
+    in personal_info must match it, see check_blob_refs. Returns the field paths that received
+    new content."""
+    changed = []
+    if not isinstance(personal_info, dict):
+        return changed
+    check_blob_refs(personal_info, current_info)
+    for field_path in PATIENT_FILE_FIELD_PATHS:
+        section_name, field = field_path.split('.')
+        section = personal_info.get(section_name)
+        if not isinstance(section, dict):
+            continue
+        value = section.get(field)
+        if not value or is_blob_ref(value):
+            continue
+        ref = store_patient_file(value, section_name)
+        if ref:
+            section[field] = ref
+            changed.append(field_path)
+    return changed
+
+
+def collect_blob_hashes(personal_info):
+    """Blob hashes referenced by the file fields of personal_info."""
+    hashes = set()
+    if not isinstance(personal_info, dict):
+        return hashes
+    for field_path in PATIENT_FILE_FIELD_PATHS:
+        section_name, field = field_path.split('.')
+        section = personal_info.get(section_name)
+        if isinstance(section, dict) and is_blob_ref(section.get(field)):
+            hashes.add(section[field]['blob_hash'])
+    return hashes
+
+
+def release_unreferenced(old_hashes, new_hashes):
+    """Release blobs that an update dropped (they may still be shared with other records)."""
+    from .storage import release_blob
+
+    for blob_hash in set(old_hashes) - set(new_hashes):
+        release_blob(blob_hash)
+
+
+def extract_files_from_patient_data(patient_data, user_email, include_data=True):
+    """Extract files from PatientData and normalize them (without the file bytes if include_data is False)"""
+    files = []
+    patient_id = patient_data.patient_id
+    personal_info = patient_data.patient_personal_info or {}
+    section_1 = personal_info.get('section_1', {})
+    section_2 = personal_info.get('section_2', {})
+    section_3 = personal_info.get('section_3', {})
+    section_4 = personal_info.get('section_4', {})
+    
+    patient_firstname = section_1.get('firstname', '')
+    patient_lastname = section_1.get('lastname', '')
+    
+    # Helper to get uploaded_by from metadata or fallback to user_email
+    def get_uploaded_by(section, field_name):
+        metadata = section.get('_file_metadata', {})
+        field_metadata = metadata.get(field_name, {})
+        return field_metadata.get('last_updated_by', user_email)
+    
+    def extract_file_data(file_value):
+        """Helper to extract file data from various formats"""
+        if not file_value:
+            return None, None
+        
+        # Handle dict format: {data: "...", filename: "..."}
+        if isinstance(file_value, dict):
+            file_data = file_value.get('data', '')
+            filename = file_value.get('filename', '')
+            if file_data and isinstance(file_data, str):
+                cleaned_data = file_data.strip()
+                if cleaned_data:  # Only return if not empty after strip
+                    return cleaned_data, filename
+            return None, None
+        
+        # Handle string format (direct base64 string)
+        if isinstance(file_value, str):
+            cleaned_data = file_value.strip()
+            if cleaned_data:  # Only return if not empty after strip
+                return cleaned_data, None
+            return None, None
+        
+        return None, None
+    
+    def is_base64_string(s):
+        """Check if string looks like base64 data"""
+        if not isinstance(s, str):
+            return False
+        # Remove whitespace
+        s = s.strip()
+        if len(s) < 50:  # Reduced minimum length
+            return False
+        # Base64 strings are typically long and contain only base64 characters
+        import re
+        base64_pattern = re.compile(r'^[A-Za-z0-9+/=\s]+$')
+        # Allow some whitespace and check if it's mostly base64
+        cleaned = re.sub(r'\s+', '', s)
+        if len(cleaned) < 50:
+            return False
+        return base64_pattern.match(cleaned) is not None
+    
+    # Extract image from section_1 (a blob reference, or legacy inline base64)
+    image_data = section_1.get('image')
+    image_ref = image_data if is_blob_ref(image_data) else None
+    file_data, _ = (None, None) if image_ref else extract_file_data(image_data)
+    if image_ref or (file_data and len(file_data) >= 50):  # Relaxed validation for images too
+        # Get uploaded_by from metadata if available
+        section_1_metadata = section_1.get('_file_metadata', {})
+        image_metadata = section_1_metadata.get('image', {})
+        uploaded_by = image_metadata.get('last_updated_by', user_email)
+        uploaded_date = image_metadata.get('last_updated_date')
+        
+        image_file = {
+            "file_id": f"patient_{patient_id}_image",
+            "source": "patient_data",
+            "source_id": patient_id,
+            "field_path": "section_1.image",
+            "patient_id": patient_id,
+            "patient_firstname": patient_firstname,
+            "patient_lastname": patient_lastname,
+            "file_name": f"{patient_firstname}_{patient_lastname}_photo.jpg",
+            "file_category": "Özlük Dokümanları",
+            "file_size": image_ref["size"] if image_ref else len(file_data) * 3 // 4,  # Approximate base64 size
+            "uploaded_by": uploaded_by,
+            "uploaded_date": uploaded_date,
+            "file_type": image_ref.get("content_type", "image/jpeg") if image_ref else "image/jpeg"
+        }
+        if image_ref:
+            image_file["blob_hash"] = image_ref["blob_hash"]
+        if include_data:
+            image_file["file_data"] = read_ref_base64(image_ref) if image_ref else file_data
+        files.append(image_file)
+    
+    # Extract files from section_4 - all known file fields
+    file_fields = [
+        ('psychiatricMedPrescriptionFile', 'psychiatricMedPrescriptionFileName', 'Sağlık Dosyaları'),
+        ('depressionScaleFile', 'depressionScaleFileName', 'Sağlık Dosyaları'),
+        ('mocaFile', 'mocaFileName', 'Sağlık Dosyaları'),
+        ('miniCogFile', 'miniCogFileName', 'Sağlık Dosyaları'),
+        ('socialReportFile', 'socialReportFileName', 'Sağlık Dosyaları'),
+    ]
+    
+    for file_field, filename_field, category in file_fields:
+        file_value = section_4.get(file_field)
+        
+        file_ref = file_value if is_blob_ref(file_value) else None
+        if file_ref:
+            file_data, filename_from_dict = None, file_ref.get('filename')
+        else:
+            file_data, filename_from_dict = extract_file_data(file_value)
+        
+        # Add file if we have data (relaxed validation - trust that if it's in the field, it's valid)
+        if file_ref or file_data:
+            # Get filename - prefer from dict, then from filename_field, then default
+            if filename_from_dict:
+                filename = filename_from_dict
+            else:
+                filename = section_4.get(filename_field, '')
+            
+            if not filename:
+                filename = f"{file_field}.pdf"
+            
+            # Accept any non-empty data (very relaxed validation)
+            
+            # Get uploaded_by from metadata if available
+            section_4_metadata = section_4.get('_file_metadata', {})
+            field_metadata = section_4_metadata.get(file_field, {})
+            uploaded_by = field_metadata.get('last_updated_by', user_email)
+            uploaded_date = field_metadata.get('last_updated_date')
+            
+            section_file = {
+                "file_id": f"patient_{patient_id}_{file_field}",
+                "source": "patient_data",
+                "source_id": patient_id,
+                "field_path": f"section_4.{file_field}",
+                "patient_id": patient_id,
+                "patient_firstname": patient_firstname,
+                "patient_lastname": patient_lastname,
+                "file_name": filename,
+                "file_category": category,
+                "file_size": file_ref["size"] if file_ref else len(file_data) * 3 // 4,  # Approximate base64 size
+                "uploaded_by": uploaded_by,
+                "uploaded_date": uploaded_date,
+                "file_type": file_ref.get("content_type", "application/pdf") if file_ref else "application/pdf"  # Default to PDF
+            }
+            if file_ref:
+                section_file["blob_hash"] = file_ref["blob_hash"]
+            if include_data:
+                section_file["file_data"] = read_ref_base64(file_ref) if file_ref else file_data
+            files.append(section_file)
+    
+    return files
+
+
+def parse_patient_file_id(file_id):
+    """Split an embedded file id ("patient_<patient_id>_<field>") into (patient_id, field_path)."""
+    if not file_id or not file_id.startswith("patient_"):
+        return None, None
+    for field_path in PATIENT_FILE_FIELD_PATHS:
+        suffix = "_" + field_path.split('.')[1]
+        if file_id.endswith(suffix) and len(file_id) > len("patient_") + len(suffix):
+            return file_id[len("patient_"):-len(suffix)], field_path
+    return None, None
+
+
+def parse_uploaded_date(value):
+    """The datetime of a "last_updated_date" from file metadata, None when missing or invalid.
+
+    The metadata comes from clients, so a bad value must not fail the request."""
+    if not isinstance(value, str):
+        return None
+    try:
+        return parse_datetime(value)
+    except ValueError:
+        return None
+
+
+def manifest_values(file_dict):
+    uploaded_date = file_dict.get("uploaded_date")
+    if not isinstance(uploaded_date, datetime):
+        uploaded_date = parse_uploaded_date(uploaded_date)
+    return {
+        "patient_id": file_dict["patient_id"],
+        "field_path": file_dict.get("field_path"),
+        "patient_firstname": file_dict.get("patient_firstname") or "",
+        "patient_lastname": file_dict.get("patient_lastname") or "",
+        "file_name": file_dict.get("file_name") or "",
+        "file_category": file_dict.get("file_category") or "",
+        "file_size": file_dict.get("file_size") or 0,
+        "file_type": file_dict.get("file_type") or "",
+        "uploaded_by": file_dict.get("uploaded_by") or "",
+        "uploaded_date": uploaded_date,
+        "blob_hash": file_dict.get("blob_hash") or "",
+    }
+
+
+def sync_patient_file_manifest(patient):
+    """Update the manifest entries of one patient's embedded files, writing only what changed."""
+    from django.contrib.auth import get_user_model
+    from .models import FileManifestEntry
+
+    owner_email = ''
+    if patient.user_id:
+        owner_email = get_user_model().objects.filter(pk=patient.user_id).values_list('email', flat=True).first() or ''
+    wanted = {}
+    for file_dict in extract_files_from_patient_data(patient, owner_email, include_data=False):
+        values = manifest_values(file_dict)
+        values.update({"source": "patient_data", "patient_pk": patient.pk, "user_id": None})
+        wanted[file_dict["file_id"]] = values
+
+    existing = {entry.file_id: entry for entry in FileManifestEntry.objects.filter(patient_pk=patient.pk)}
+    stale = [file_id for file_id in existing if file_id not in wanted]
+    if stale:
+        FileManifestEntry.objects.filter(file_id__in=stale).delete()
+    for file_id, values in wanted.items():
+        entry = existing.get(file_id)
+        if entry and all(getattr(entry, key) == value for key, value in values.items()):
+            continue
+        FileManifestEntry.objects.update_or_create(file_id=file_id, defaults=values)
+
+
+def file_data_manifest_values(file_data):
+    return {
+        "source": "file_data",
+        "user_id": file_data.user_id,
+        "patient_pk": None,
+        "patient_id": file_data.patient_id,
+        "field_path": None,
+        "patient_firstname": file_data.patient_firstname,
+        "patient_lastname": file_data.patient_lastname,
+        "file_name": file_data.file_name,
+        "file_category": file_data.file_category,
+        "file_size": file_data.file_size,
+        "file_type": file_data.file_type,
+        "uploaded_by": file_data.uploaded_by,
+        "uploaded_date": file_data.uploaded_date,
+        "blob_hash": file_data.blob_hash,
+    }
+
+
+def sync_file_data_manifest(file_data):
+    from .models import FileManifestEntry
+
+    FileManifestEntry.objects.update_or_create(file_id=file_data.file_id, defaults=file_data_manifest_values(file_data))
+
+
+def manifest_entry_to_dict(entry):
+    """Same shape as the metadata entries of extract_files_from_patient_data"""
+    return {
+        "file_id": entry.file_id,
+        "source": entry.source,
+        "source_id": entry.patient_id if entry.source == "patient_data" else entry.file_id,
+        "field_path": entry.field_path,
+        "patient_id": entry.patient_id,
+        "patient_firstname": entry.patient_firstname,
+        "patient_lastname": entry.patient_lastname,
+        "file_name": entry.file_name,
+        "file_category": entry.file_category,
+        "file_size": entry.file_size,
+        "uploaded_by": entry.uploaded_by,
+        "uploaded_date": entry.uploaded_date.isoformat() if entry.uploaded_date else None,
+        "file_type": entry.file_type,
+    }
@@ -0,0 +1,344 @@
+"""Medicines, vitals, notes and signed HC of a patient, stored as rows of their own models.
+
+These used to be JSON objects on PatientData (patient_medicines, patient_vitals,
+patient_notes, patient_signed_hc) that grew with every dose, reading and signature and
+were rewritten as a whole on every change. They are now MedicationOrder,
+MedicationAdministration, VitalReading, PatientNote and SignedHCEntry rows keyed by
+patient_pk; the API still sends the old JSON shapes, rebuilt by load_patient_records().
+
+PatientData.records_split tells whether a patient's JSON fields were moved already. Until
+then they are read as they are; the first write to the records (or the
+backfill_patient_records command) moves them, see split_patient_records().
+
+PatientData.records_moving claims the records while a request moves them or replaces a
+field's rows (update_patient). Record writes that find it set raise RecordsMoving, for a
+retryable 503, instead of waiting for it or landing between a delete and a recreate.
+"""
+from datetime import timedelta
+
+from django.utils import timezone
+from pymongo import ReturnDocument
+
+from .models import (
+    PatientData, MedicationOrder, MedicationAdministration, VitalReading, PatientNote, SignedHCEntry,
+)
+from .mongo import get_collection
+
+RECORD_FIELDS = ['patient_medicines', 'patient_signed_hc', 'patient_vitals', 'patient_notes']
+RECORD_MODELS = {
+    'patient_medicines': [MedicationOrder, MedicationAdministration],
+    'patient_signed_hc': [SignedHCEntry],
+    'patient_vitals': [VitalReading],
+    'patient_notes': [PatientNote],
+}
+VITAL_TYPES = ["heart_beat", "oxygen", "stress", "sleep", "vitality"]
+GIVEN_PERIODS = ["morning", "noon", "evening"]
+BULK_CREATE_BATCH_SIZE = 500
+# SignedHCEntry.signed_hc_data only holds objects and arrays; other values are stored under this key
+WRAPPED_VALUE_KEY = '__value__'
+# A claim taken longer ago than this was interrupted; a move is redone by the next caller
+MOVE_TIMEOUT = timedelta(minutes=5)
+
+
+class RecordsMoving(Exception):
+    """The records of the patient are being moved or replaced by another request; retry later."""
+
+
+def _items(value):
+    return value.items() if isinstance(value, dict) else []
+
+
+def administration_rows(patient_pk, medicine_id, prepared_dates=None, given_dates=None):
+    """MedicationAdministration rows for the legacy prepared_dates/given_dates of one medicine."""
+    rows = []
+    for date_key, _ in _items(prepared_dates):
+        rows.append(MedicationAdministration(patient_pk=patient_pk, medicine_id=medicine_id,
+                                             kind=MedicationAdministration.PREPARED, date_key=date_key))
+    for period, dates in _items(given_dates):
+        for date_key, entry in _items(dates):
+            # Older entries are a bare True, newer ones {"timestamp": ..., "given": ...}
+            given, timestamp = (bool(entry.get("given", True)), str(entry.get("timestamp") or '')) \
+                if isinstance(entry, dict) else (bool(entry), '')
+            rows.append(MedicationAdministration(patient_pk=patient_pk, medicine_id=medicine_id,
+                                                 kind=MedicationAdministration.GIVEN, period=period,
+                                                 date_key=date_key, given=given, timestamp=timestamp))
+    return rows
+
+
+def split_medicine_data(medicine_data):
+    """(order data, prepared_dates, given_dates) of a legacy medicine_data object."""
+    order_data = dict(medicine_data) if isinstance(medicine_data, dict) else {}
+    return order_data, order_data.pop("prepared_dates", None), order_data.pop("given_dates", None)
+
+
+def vital_reading(patient_pk, vital_type, entry):
+    try:
+        value = float(entry.get("value"))
+    except (TypeError, ValueError):
+        value = None
+    return VitalReading(patient_pk=patient_pk, vital_type=vital_type, value=value,
+                        date_key=str(entry.get("date") or ''), timestamp=str(entry.get("timestamp") or ''))
+
+
+def patient_note(patient_pk, note):
+    return PatientNote(patient_pk=patient_pk, note_id=note["note_id"],
+                       note_title=note.get("note_title") or '', note_data=note.get("note_data") or '',
+                       note_date=note.get("note_date") or '', created_by=note.get("created_by") or '',
+                       timestamp=note.get("timestamp") or '', updated_at=note.get("updated_at") or '')
+
+
+def signed_hc_entry(patient_pk, date_key, hc_type, position, signed_hc):
+    signed_hc_data = signed_hc.get("signed_hc_data")
+    if not isinstance(signed_hc_data, (dict, list)):
+        signed_hc_data = {WRAPPED_VALUE_KEY: signed_hc_data}
+    return SignedHCEntry(patient_pk=patient_pk, date_key=date_key, hc_type=hc_type, position=position,
+                         signed_hc_id=signed_hc.get("signed_hc_id") or '',
+                         signed_hc_data=signed_hc_data,
+                         created_by=signed_hc.get("created_by") or '', insert_ts=signed_hc.get("insert_ts") or '')
+
+
+def legacy_rows(patient_pk, field, value):
+    """Unsaved rows for the legacy JSON value of one of RECORD_FIELDS."""
+    rows = []
+    if field == 'patient_medicines':
+        for medicine_id, medicine in _items(value):
+            if not isinstance(medicine, dict):
+                continue
+            order_data, prepared_dates, given_dates = split_medicine_data(medicine.get("medicine_data"))
+            rows.append(MedicationOrder(patient_pk=patient_pk, medicine_id=medicine_id, medicine_data=order_data))
+            rows.extend(administration_rows(patient_pk, medicine_id, prepared_dates, given_dates))
+    elif field == 'patient_vitals':
+        for vital_type, entries in _items(value):
+            rows.extend(vital_reading(patient_pk, vital_type, entry)
+                        for entry in entries or [] if isinstance(entry, dict))
+    elif field == 'patient_notes':
+        rows.extend(patient_note(patient_pk, dict(note, note_id=note_id))
+                    for note_id, note in _items(value) if isinstance(note, dict))
+    elif field == 'patient_signed_hc':
+        for date_key, types in _items(value):
+            for hc_type, entries in _items(types):
+                rows.extend(signed_hc_entry(patient_pk, date_key, hc_type, position, signed_hc)
+                            for position, signed_hc in enumerate(entries or []) if isinstance(signed_hc, dict))
+    return rows
+
+
+def create_rows(rows):
+    by_model = {}
+    for row in rows:
+        by_model.setdefault(type(row), []).append(row)
+    for model, model_rows in by_model.items():
+        model.objects.bulk_create(model_rows, batch_size=BULK_CREATE_BATCH_SIZE)
+
+
+def assemble_medicines(orders, administrations):
+    medicines = {}
+    for order in orders:
+        medicine_data = dict(order.medicine_data or {})
+        medicine_data["prepared_dates"] = {}
+        medicine_data["given_dates"] = {period: {} for period in GIVEN_PERIODS}
+        medicines[order.medicine_id] = {"medicine_id": order.medicine_id, "medicine_data": medicine_data}
+    for row in administrations:
+        medicine = medicines.get(row.medicine_id)
+        if medicine is None:
+            continue
+        medicine_data = medicine["medicine_data"]
+        if row.kind == MedicationAdministration.PREPARED:
+            medicine_data["prepared_dates"][row.date_key] = True
+        else:
+            entry = {"timestamp": row.timestamp, "given": row.given} if row.timestamp else row.given
+            medicine_data["given_dates"].setdefault(row.period, {})[row.date_key] = entry
+    return medicines
+
+
+def assemble_vitals(readings):
+    vitals = {vital_type: [] for vital_type in VITAL_TYPES}
+    for reading in readings:
+        vitals.setdefault(reading.vital_type, []).append(
+            {"value": reading.value, "date": reading.date_key, "timestamp": reading.timestamp})
+    return vitals
+
+
+def note_to_dict(note):
+    data = {
+        "note_id": note.note_id,
+        "note_title": note.note_title,
+        "note_data": note.note_data,
+        "note_date": note.note_date,
+        "created_by": note.created_by,
+        "timestamp": note.timestamp,
+    }
+    if note.updated_at:
+        data["updated_at"] = note.updated_at
+    return data
+
+
+def assemble_notes(notes):
+    return {note.note_id: note_to_dict(note) for note in notes}
+
+
+def assemble_signed_hc(entries):
+    signed_hc = {}
+    for entry in sorted(entries, key=lambda entry: entry.position):
+        signed_hc_data = entry.signed_hc_data
+        if isinstance(signed_hc_data, dict) and set(signed_hc_data) == {WRAPPED_VALUE_KEY}:
+            signed_hc_data = signed_hc_data[WRAPPED_VALUE_KEY]
+        signed_hc.setdefault(entry.date_key, {}).setdefault(entry.hc_type, []).append({
+            "signed_hc_id": entry.signed_hc_id,
+            "signed_hc_data": signed_hc_data,
+            "created_by": entry.created_by,
+            "insert_ts": entry.insert_ts,
+        })
+    return signed_hc
+
+
+def _rows_by_patient(model, patient_pks):
+    rows = {}
+    for row in model.objects.filter(patient_pk__in=patient_pks).order_by('pk'):
+        rows.setdefault(row.patient_pk, []).append(row)
+    return rows
+
+
+def load_patient_records(patient_pks, fields=RECORD_FIELDS):
+    """{patient pk: {field: legacy JSON value}} for split patients, with one query per model."""
+    patient_pks = list(patient_pks)
+    records = {pk: {} for pk in patient_pks}
+    if not patient_pks:
+        return records
+    if 'patient_medicines' in fields:
+        orders = _rows_by_patient(MedicationOrder, patient_pks)
+        administrations = _rows_by_patient(MedicationAdministration, patient_pks)
+        for pk in patient_pks:
+            records[pk]['patient_medicines'] = assemble_medicines(orders.get(pk, []), administrations.get(pk, []))
+    assemblers = [
+        ('patient_signed_hc', SignedHCEntry, assemble_signed_hc),
+        ('patient_vitals', VitalReading, assemble_vitals),
+        ('patient_notes', PatientNote, assemble_notes),
+    ]
+    for field, model, assemble in assemblers:
+        if field in fields:
+            rows = _rows_by_patient(model, patient_pks)
+            for pk in patient_pks:
+                records[pk][field] = assemble(rows.get(pk, []))
+    return records
+
+
+def attach_patient_records(patients):
+    """Preload .records of the split patients, for serializing many patients at once."""
+    split = [patient for patient in patients if patient.records_split]
+    records = load_patient_records([patient.pk for patient in split])
+    for patient in split:
+        patient.records = records[patient.pk]
+    return patients
+
+
+def _claim_time():
+    now = timezone.now()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)  # MongoDB keeps milliseconds
+
+
+def _unclaimed(now):
+    """Query for patients whose records are not claimed, or by an interrupted request."""
+    return {'$or': [{'records_moving': None}, {'records_moving': {'$lt': now - MOVE_TIMEOUT}}]}
+
+
+def claim_patient_records(patient_pk, expected_version):
+    """Claim the records of a split patient for replace_patient_records, if its version is
+    still expected_version. Returns the claim, or None if the version changed or they are claimed."""
+    claimed_at = _claim_time()
+    result = get_collection(PatientData).update_one(
+        {'id': patient_pk, 'version': expected_version, **_unclaimed(claimed_at)},
+        {'$set': {'records_moving': claimed_at}})
+    return claimed_at if result.matched_count else None
+
+
+def release_patient_records(patient_pk, claimed_at, changed=True):
+    """Release a claim of claim_patient_records; with changed, bump the version for the new rows.
+
+    Returns the new version, or None if the claim was lost or nothing changed."""
+    update = {'$set': {'records_moving': None}}
+    if changed:
+        update['$inc'] = {'version': 1}
+    document = get_collection(PatientData).find_one_and_update(
+        {'id': patient_pk, 'records_moving': claimed_at}, update,
+        projection={'_id': 0, 'version': 1}, return_document=ReturnDocument.AFTER)
+    return document['version'] if document and changed else None
+
+
+def replace_patient_records(patient_pk, field, value):
+    """Replace all rows behind field with the given legacy JSON value (update_patient).
+
+    The caller holds the claim of claim_patient_records, so no record write lands in between."""
+    for model in RECORD_MODELS[field]:
+        model.objects.filter(patient_pk=patient_pk).delete()
+    create_rows(legacy_rows(patient_pk, field, value))
+
+
+def delete_patient_records(patient_pk):
+    for models in RECORD_MODELS.values():
+        for model in models:
+            model.objects.filter(patient_pk=patient_pk).delete()
+
+
+def bump_patient_version(patient_pk):
+    """Increment the patient version after a write to its records; the new version.
+
+    Raises RecordsMoving if the records were claimed since ensure_patient_records: the write
+    may have been replaced, so the client should retry."""
+    document = get_collection(PatientData).find_one_and_update(
+        {'id': patient_pk, **_unclaimed(timezone.now())}, {'$inc': {'version': 1}},
+        projection={'_id': 0, 'version': 1}, return_document=ReturnDocument.AFTER)
+    if document is None:
+        raise RecordsMoving()
+    return document['version']
+
+
+def split_patient_records(patient_pk):
+    """Move the legacy JSON fields of a patient to rows. Returns False if they were moved
+    already, or another caller is moving them.
+
+    The move is claimed with records_moving, in the same atomic update that reads the fields;
+    readers go on using the fields meanwhile, and record writes get RecordsMoving.
+    records_split is set and the fields cleared together, once the rows exist. The version
+    stays: the patient reads the same, and an update based on it (If-Match) must still apply.
+    A claim older than MOVE_TIMEOUT was interrupted and is taken over, starting again from
+    the fields."""
+    collection = get_collection(PatientData)
+    claimed_at = _claim_time()
+    document = collection.find_one_and_update(
+        {'id': patient_pk, 'records_split': {'$ne': True}, **_unclaimed(claimed_at)},
+        {'$set': {'records_moving': claimed_at}}, projection={'_id': 0, **{field: 1 for field in RECORD_FIELDS}},
+        return_document=ReturnDocument.BEFORE)
+    if document is None:
+        return False
+    # Rows of an interrupted move
+    delete_patient_records(patient_pk)
+    rows = []
+    for field in RECORD_FIELDS:
+        rows.extend(legacy_rows(patient_pk, field, document.get(field)))
+    create_rows(rows)
+    result = collection.update_one(
+        {'id': patient_pk, 'records_moving': claimed_at},
+        {'$set': {'records_split': True, 'records_moving': None, **{field: {} for field in RECORD_FIELDS}}})
+    return bool(result.matched_count)
+
+
+def ensure_patient_records(patient):
+    """Make sure the records of patient live in the row models, and are not claimed, before writing them.
+
+    Raises RecordsMoving, without waiting, if another request is moving or replacing them."""
+    if not patient.records_split:
+        split_patient_records(patient.pk)
+    if not get_collection(PatientData).count_documents(
+            {'id': patient.pk, 'records_split': True, **_unclaimed(timezone.now())}, limit=1):
+        raise RecordsMoving()
+    patient.records_split = True
+
+
+def patient_records(patient, fields=RECORD_FIELDS):
+    """{field: legacy JSON value} of patient, from the rows or the not yet moved JSON fields."""
+    if not patient.records_split:
+        return {field: getattr(patient, field) for field in fields}
+    records = getattr(patient, 'records', None)
+    if records is None:
+        records = load_patient_records([patient.pk], fields)[patient.pk]
+    return {field: records[field] for field in fields}
@@ -0,0 +1,100 @@
+"""RFC 7396 merge patches of a patient document, written as $set/$unset of the changed paths.
+
+The medicine, vitals, note and signed HC updates of PatientAPI write their own rows,
+see patient_records.py.
+"""
+from .models import PatientData
+from .mongo import get_collection
+
+
+def is_safe_key(value):
+    """Whether value can be used as one component of a MongoDB field path."""
+    return isinstance(value, str) and bool(value) and '.' not in value and not value.startswith('$') \
+        and '\x00' not in value
+
+
+def _strip_nulls(value):
+    if isinstance(value, dict):
+        return {key: _strip_nulls(item) for key, item in value.items() if item is not None}
+    return value
+
+
+def _merge(target, patch, path, set_paths, unset_paths):
+    result = dict(target) if isinstance(target, dict) else {}
+    whole_object = not isinstance(target, dict)
+    for key, value in patch.items():
+        child = path + (key,)
+        if not is_safe_key(key):
+            # Cannot be addressed as a field path, so write the enclosing object instead
+            whole_object = True
+        if value is None:
+            if key in result:
+                del result[key]
+                unset_paths.add(child)
+        elif isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = _merge(result[key], value, child, set_paths, unset_paths)
+        else:
+            result[key] = _strip_nulls(value)
+            set_paths.add(child)
+    if whole_object:
+        set_paths.add(path)
+    return result
+
+
+def _minimal_paths(set_paths, unset_paths):
+    """Drop paths covered by a shorter path that is set anyway (MongoDB rejects overlapping paths)."""
+    kept = []
+    for path in sorted(set_paths, key=len):
+        if not any(path[:len(parent)] == parent for parent in kept):
+            kept.append(path)
+    unsets = [path for path in unset_paths if not any(path[:len(parent)] == parent for parent in kept)]
+    return kept, unsets
+
+
+def apply_merge_patch(document, patch):
+    """RFC 7396 merge patch of document (top-level field -> value) with the changed paths.
+
+    Returns (merged document, set paths, unset paths); paths are tuples of keys. The
+    input document is not modified."""
+    set_paths, unset_paths = set(), set()
+    merged = dict(document)
+    for field, value in patch.items():
+        if value is None:
+            merged[field] = {}
+            set_paths.add((field,))
+        elif isinstance(value, dict):
+            merged[field] = _merge(document.get(field), value, (field,), set_paths, unset_paths)
+        else:
+            merged[field] = value
+            set_paths.add((field,))
+    return merged, set_paths, unset_paths
+
+
+def _value_at(document, path):
+    value = document
+    for key in path:
+        value = value[key]
+    return value
+
+
+def save_merge_patch(patient, expected_version, merged, set_paths, unset_paths):
+    """Write only the changed paths of patient, if its version is still expected_version.
+
+    On success the merged fields are copied onto patient and post_save is sent."""
+    from django.db.models.signals import post_save
+
+    set_paths, unset_paths = _minimal_paths(set_paths, unset_paths)
+    update = {'$inc': {'version': 1}}
+    if set_paths:
+        update['$set'] = {'.'.join(path): _value_at(merged, path) for path in set_paths}
+    if unset_paths:
+        update['$unset'] = {'.'.join(path): '' for path in unset_paths}
+    result = get_collection(PatientData).update_one({'id': patient.pk, 'version': expected_version}, update)
+    if not result.matched_count:
+        return False
+    for field, value in merged.items():
+        setattr(patient, field, value)
+    patient.version = expected_version + 1
+    post_save.send(sender=PatientData, instance=patient, created=False, raw=False, using=patient._state.db,
+                   update_fields=frozenset(merged) | {'version'})
+    return True
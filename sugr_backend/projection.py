@@ -0,0 +1,93 @@
+"""Field projection for patient reads.
+
+PatientAPI.get normally serializes every JSON field of PatientData. With ?fields= and/or
+?sections= only the requested fields (or sections of patient_personal_info) are fetched,
+using a MongoDB projection so the rest of the document never leaves the database.
+"""
+import re
+
+from .models import PatientData
+from .mongo import get_collection
+from .patient_records import RECORD_FIELDS, load_patient_records
+
+PATIENT_JSON_FIELDS = [
+    'patient_personal_info',
+    'patient_medicines',
+    'patient_signed_hc',
+    'patient_vitals',
+    'patient_notes',
+    'exit_info',
+]
+
+# Short names accepted in ?fields= / ?sections=
+PATIENT_FIELD_ALIASES = {
+    'personal_info': 'patient_personal_info',
+    'medicines': 'patient_medicines',
+    'signed_hc': 'patient_signed_hc',
+    'hc': 'patient_signed_hc',
+    'vitals': 'patient_vitals',
+    'notes': 'patient_notes',
+}
+
+_SECTION_RE = re.compile(r'^section_\d+$')
+
+
+def split_param(value):
+    return [part.strip() for part in (value or '').split(',') if part.strip()]
+
+
+def build_patient_projection(fields=None, sections=None):
+    """MongoDB projection for the requested names, or None when nothing was requested.
+
+    Names can be PatientData JSON fields, their short aliases or personal info sections
+    (section_1, ...). Raises ValueError for anything else."""
+    names = split_param(fields) + split_param(sections)
+    if not names:
+        return None
+    projection = {'_id': 0, 'id': 1, 'user_id': 1, 'patient_id': 1}
+    for name in names:
+        if name in PATIENT_JSON_FIELDS:
+            projection[name] = 1
+        elif name in PATIENT_FIELD_ALIASES:
+            projection[PATIENT_FIELD_ALIASES[name]] = 1
+        elif _SECTION_RE.match(name):
+            projection[f'patient_personal_info.{name}'] = 1
+        elif name not in ('id', 'user', 'patient_id'):
+            raise ValueError(f"Unknown field or section: {name}")
+    if 'patient_personal_info' in projection:
+        # MongoDB rejects a field together with one of its sub-paths
+        projection = {key: value for key, value in projection.items()
+                      if not key.startswith('patient_personal_info.')}
+    return projection
+
+
+def projected_patient_to_dict(document):
+    """Same keys as PatientDataSerializer output, limited to what was projected"""
+    data = {
+        "id": document.get('id'),
+        "user": document.get('user_id'),
+        "patient_id": document.get('patient_id'),
+    }
+    for field in PATIENT_JSON_FIELDS:
+        if field in document:
+            data[field] = document[field]
+    return data
+
+
+def find_projected_patients(queryset, projection, patient_ids=None):
+    """Projected documents for the patients in queryset (already filtered by access)."""
+    query = {}
+    if queryset.query.where:
+        query['id'] = {'$in': list(queryset.values_list('pk', flat=True))}
+    if patient_ids:
+        query['patient_id'] = {'$in': list(patient_ids)}
+    record_fields = [field for field in RECORD_FIELDS if any(key.split('.')[0] == field for key in projection)]
+    if record_fields:
+        projection = dict(projection, records_split=1)
+    documents = list(get_collection(PatientData).find(query, projection).sort('id', 1))
+    # Moved records come from their own models
+    split_pks = [document['id'] for document in documents if record_fields and document.get('records_split')]
+    records = load_patient_records(split_pks, record_fields)
+    for document in documents:
+        document.update(records.get(document['id'], {}))
+    return [projected_patient_to_dict(document) for document in documents]
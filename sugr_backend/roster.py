@@ -0,0 +1,205 @@
+"""Patient roster: the PatientSummary card of every patient, for the patient list screen."""
+import unicodedata
+
+from django.urls import reverse
+
+from .patient_files import is_blob_ref
+from .search import search_index_values
+
+ROSTER_SORTS = {
+    'name': 'sort_name',
+    'room': 'room',
+}
+
+# Query parameter -> PatientSummary field, for the value filters and their counts
+ROSTER_FACETS = {
+    'gender': 'gender',
+    'care_type': 'care_type',
+    'insurance': 'insurance',
+    'blood_type': 'blood_type',
+}
+
+ROSTER_STATUSES = {
+    'active': True,
+    'exited': False,
+    'all': None,
+}
+
+ROOM_BUCKET_SIZE = 100
+
+# Turkish letters sort right after their base letter (c < ç < d, h < ı < i, ...)
+_TURKISH_COLLATION = str.maketrans({
+    'ç': 'c~', 'ğ': 'g~', 'ı': 'h~', 'ö': 'o~', 'ş': 's~', 'ü': 'u~',
+})
+
+
+def turkish_lower(value):
+    return str(value or '').replace('I', 'ı').replace('İ', 'i').lower()
+
+
+def collation_key(value):
+    """Sort key that orders Turkish text alphabetically with plain string comparison."""
+    value = turkish_lower(value).strip().translate(_TURKISH_COLLATION)
+    # Drop accents of any other letters (â -> a)
+    value = ''.join(char for char in unicodedata.normalize('NFKD', value) if not unicodedata.combining(char))
+    return ' '.join(value.split())
+
+
+def summary_values(patient):
+    personal_info = patient.patient_personal_info or {}
+    section_1 = personal_info.get('section_1') or {}
+    section_3 = personal_info.get('section_3') or {}
+    firstname = str(section_1.get('firstname') or '')
+    lastname = str(section_1.get('lastname') or '')
+    image = section_1.get('image')
+    room = str(section_1.get('patientRoom') or '')
+    values = search_index_values(firstname, lastname, section_1.get('citizenID'), room)
+    values.update({
+        "patient_id": str(patient.patient_id),
+        "firstname": firstname,
+        "lastname": lastname,
+        "sort_name": collation_key(f"{lastname} {firstname}"),
+        "room": room,
+        "room_no": int(values["room_number"]) if values["room_number"] else None,
+        "care_type": str(section_3.get('onGoingCare') or ''),
+        "gender": str(section_1.get('patientGender') or ''),
+        "insurance": str(section_1.get('insurance') or ''),
+        "blood_type": str(section_1.get('bloodType') or ''),
+        "photo_hash": image['blob_hash'] if is_blob_ref(image) else '',
+        # Deleted patients keep their record with section_1 cleared and exit_info set
+        "active": bool(section_1) and not patient.exit_info,
+    })
+    return values
+
+
+def sync_patient_summary(patient):
+    """Create or update the summary of one patient, writing only when something changed."""
+    from .models import PatientSummary
+
+    values = summary_values(patient)
+    summary = PatientSummary.objects.filter(patient_pk=patient.pk).first()
+    if summary and all(getattr(summary, key) == value for key, value in values.items()):
+        return summary
+    summary, _ = PatientSummary.objects.update_or_create(patient_pk=patient.pk, defaults=values)
+    return summary
+
+
+def parse_roster_filters(params):
+    """Roster filters from query params: facet values (repeatable), room_min/room_max and status.
+
+    Raises ValueError for invalid values."""
+    filters = {}
+    for name in ROSTER_FACETS:
+        values = [value for value in params.getlist(name) if value != '']
+        if values:
+            filters[name] = values
+    for bound in ('room_min', 'room_max'):
+        if params.get(bound) not in (None, ''):
+            try:
+                filters[bound] = int(params.get(bound))
+            except ValueError:
+                raise ValueError(f"{bound} must be an integer")
+    roster_status = params.get('status', 'active')
+    if roster_status not in ROSTER_STATUSES:
+        raise ValueError("status must be one of active, exited, all")
+    filters['status'] = roster_status
+    return filters
+
+
+def filter_summaries(queryset, filters):
+    for name, field in ROSTER_FACETS.items():
+        if name in filters:
+            queryset = queryset.filter(**{f'{field}__in': filters[name]})
+    if 'room_min' in filters:
+        queryset = queryset.filter(room_no__gte=filters['room_min'])
+    if 'room_max' in filters:
+        queryset = queryset.filter(room_no__lte=filters['room_max'])
+    active = ROSTER_STATUSES[filters['status']]
+    if active is not None:
+        queryset = queryset.filter(active=active)
+    return queryset
+
+
+def _facet_match(filters, skip=None):
+    """MongoDB match for filters, leaving out the filter of the facet being counted."""
+    match = {}
+    for name, field in ROSTER_FACETS.items():
+        if name in filters and name != skip:
+            match[field] = {'$in': filters[name]}
+    if skip != 'room':
+        room = {}
+        if 'room_min' in filters:
+            room['$gte'] = filters['room_min']
+        if 'room_max' in filters:
+            room['$lte'] = filters['room_max']
+        if room:
+            match['room_no'] = room
+    active = ROSTER_STATUSES[filters['status']]
+    if skip != 'status' and active is not None:
+        match['active'] = active
+    return match
+
+
+def facet_counts(filters, accessible_pks=None):
+    """Per-value counts for every facet in one $facet aggregation.
+
+    Each facet is counted with all the other filters applied but not its own, so the
+    client can show how many patients every alternative value would give."""
+    from .models import PatientSummary
+    from .mongo import get_collection
+
+    def count_by(expression, skip):
+        return [
+            {'$match': _facet_match(filters, skip)},
+            {'$group': {'_id': expression, 'count': {'$sum': 1}}},
+            {'$sort': {'count': -1, '_id': 1}},
+        ]
+
+    facets = {name: count_by(f'${field}', name) for name, field in ROSTER_FACETS.items()}
+    facets['room'] = count_by(
+        {'$multiply': [{'$floor': {'$divide': ['$room_no', ROOM_BUCKET_SIZE]}}, ROOM_BUCKET_SIZE]}, 'room')
+    facets['status'] = count_by('$active', 'status')
+    facets['total'] = [{'$match': _facet_match(filters)}, {'$count': 'count'}]
+
+    base = {} if accessible_pks is None else {'patient_pk': {'$in': list(accessible_pks)}}
+    result = next(get_collection(PatientSummary).aggregate([{'$match': base}, {'$facet': facets}]), {})
+
+    counts = {name: [{"value": row['_id'] or '', "count": row['count']} for row in result.get(name, [])]
+              for name in ROSTER_FACETS}
+    counts['room'] = [{"value": f"{int(row['_id'])}-{int(row['_id']) + ROOM_BUCKET_SIZE - 1}"
+                       if row['_id'] is not None else '', "count": row['count']} for row in result.get('room', [])]
+    counts['status'] = [{"value": 'active' if row['_id'] else 'exited', "count": row['count']}
+                        for row in result.get('status', [])]
+    total = result.get('total') or [{'count': 0}]
+    return counts, total[0]['count']
+
+
+def roster_fingerprint(accessible_pks=None):
+    """(count, latest updated_at) of the visible summaries; changes whenever any card changes."""
+    from .models import PatientSummary
+    from .mongo import get_collection
+
+    base = {} if accessible_pks is None else {'patient_pk': {'$in': list(accessible_pks)}}
+    stats = next(get_collection(PatientSummary).aggregate([
+        {'$match': base},
+        {'$group': {'_id': None, 'count': {'$sum': 1}, 'latest': {'$max': '$updated_at'}}},
+    ]), {})
+    return stats.get('count', 0), stats.get('latest')
+
+
+def summary_to_card(summary):
+    thumbnail = None
+    if summary.photo_hash:
+        thumbnail = f"{reverse('patient-photo', args=[summary.patient_id])}?size=64&v={summary.photo_hash}"
+    return {
+        "patient_id": summary.patient_id,
+        "firstname": summary.firstname,
+        "lastname": summary.lastname,
+        "room": summary.room,
+        "care_type": summary.care_type,
+        "gender": summary.gender,
+        "insurance": summary.insurance,
+        "blood_type": summary.blood_type,
+        "active": summary.active,
+        "thumbnail": thumbnail,
+    }
@@ -0,0 +1,108 @@
+"""Patient search over the PatientSummary index.
+
+Names are folded to plain lowercase ASCII with Turkish casing rules (İ -> i, I -> ı -> i,
+Ş -> s, Ğ -> g, ...) and stored as word prefixes and trigrams on the summary, so a search
+is a couple of indexed array lookups plus a ranking stage in MongoDB.
+"""
+import re
+import unicodedata
+
+from .models import PatientSummary
+from .mongo import get_collection
+
+MAX_PREFIX_LENGTH = 15
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 50
+MIN_TRIGRAM_SIMILARITY = 0.5
+
+_FOLD = str.maketrans({'ç': 'c', 'ğ': 'g', 'ı': 'i', 'ö': 'o', 'ş': 's', 'ü': 'u'})
+_NON_WORD_RE = re.compile(r'[^a-z0-9]+')
+_DIGITS_RE = re.compile(r'\d+')
+
+# Score weights; an exact ID hit always ranks above any name match
+SCORE_CITIZEN_ID = 100
+SCORE_ROOM = 50
+SCORE_PREFIX = 20
+SCORE_TRIGRAM = 10
+
+
+def search_fold(value):
+    """Lowercase ASCII form of value for matching ("İLKAY Işık" -> "ilkay isik")."""
+    value = str(value or '').replace('I', 'ı').replace('İ', 'i').lower().translate(_FOLD)
+    value = ''.join(char for char in unicodedata.normalize('NFKD', value) if not unicodedata.combining(char))
+    return ' '.join(_NON_WORD_RE.sub(' ', value).split())
+
+
+def name_tokens(*names):
+    return [token for name in names for token in search_fold(name).split()]
+
+
+def token_prefixes(tokens):
+    return sorted({token[:length] for token in tokens for length in range(1, min(len(token), MAX_PREFIX_LENGTH) + 1)})
+
+
+def token_trigrams(tokens):
+    trigrams = set()
+    for token in tokens:
+        padded = f'  {token} '
+        trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return sorted(trigrams)
+
+
+def room_number(room):
+    """Digits of a room label ("Oda - 204" -> "204")."""
+    return ''.join(_DIGITS_RE.findall(str(room or '')))
+
+
+def search_index_values(firstname, lastname, citizen_id, room):
+    tokens = name_tokens(firstname, lastname)
+    return {
+        "citizen_id": str(citizen_id or '').strip(),
+        "room_number": room_number(room),
+        "search_prefixes": token_prefixes(tokens),
+        "search_trigrams": token_trigrams(tokens),
+    }
+
+
+def search_patients(query, accessible_pks=None, limit=SEARCH_DEFAULT_LIMIT):
+    """Ranked PatientSummary objects matching query; accessible_pks None means no access restriction."""
+    raw = query.strip()
+    tokens = name_tokens(raw)
+    if not tokens:
+        return []
+    trigrams = token_trigrams(tokens)
+    digits = raw if raw.isdigit() else None
+
+    matches = [{'search_prefixes': {'$all': tokens}},
+               {'search_trigrams': {'$in': trigrams}}]
+    if digits:
+        matches += [{'citizen_id': digits}, {'room_number': digits}]
+    match = {'$or': matches}
+    if accessible_pks is not None:
+        match = {'$and': [{'patient_pk': {'$in': list(accessible_pks)}}, match]}
+
+    similarity = {'$divide': [{'$size': {'$setIntersection': [{'$ifNull': ['$search_trigrams', []]}, trigrams]}},
+                              len(trigrams)]}
+    score = [
+        {'$cond': [{'$setIsSubset': [tokens, {'$ifNull': ['$search_prefixes', []]}]}, SCORE_PREFIX, 0]},
+        {'$multiply': [similarity, SCORE_TRIGRAM]},
+    ]
+    if digits:
+        score += [{'$cond': [{'$eq': ['$citizen_id', digits]}, SCORE_CITIZEN_ID, 0]},
+                  {'$cond': [{'$eq': ['$room_number', digits]}, SCORE_ROOM, 0]}]
+    pipeline = [
+        {'$match': match},
+        {'$addFields': {'score': {'$add': score}}},
+        # Trigram-only candidates must share enough trigrams to count as a (misspelled) match
+        {'$match': {'score': {'$gte': MIN_TRIGRAM_SIMILARITY * SCORE_TRIGRAM}}},
+        {'$sort': {'score': -1, 'sort_name': 1, 'patient_pk': 1}},
+        {'$limit': limit},
+        {'$project': {'_id': 0, 'search_prefixes': 0, 'search_trigrams': 0}},
+    ]
+    field_names = {field.attname for field in PatientSummary._meta.concrete_fields}
+    results = []
+    for document in get_collection(PatientSummary).aggregate(pipeline):
+        summary = PatientSummary(**{key: value for key, value in document.items() if key in field_names})
+        summary.score = document['score']
+        results.append(summary)
+    return results
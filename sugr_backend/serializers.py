@@ -7,6 +7,7 @@ from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from django.core.files.uploadedfile import SimpleUploadedFile
 from sugr_backend.models import PatientData, MedicineData, FileData, default_permission_codes
+from sugr_backend.patient_records import RECORD_FIELDS, create_rows, legacy_rows, patient_records
 from io import BytesIO
 from PIL import Image
 import base64
@@ -125,13 +126,22 @@ class PatientDataSerializer(serializers.ModelSerializer):
             user=validated_data['user'],
             patient_id=validated_data['patient_id'],
             patient_personal_info=validated_data['patient_personal_info'],
-            patient_medicines=validated_data['patient_medicines'],
-            patient_signed_hc=validated_data['patient_signed_hc'],
-            patient_vitals=validated_data.get('patient_vitals', {}),
-            patient_notes=validated_data.get('patient_notes', {})
+            patient_medicines={},
+            patient_signed_hc={},
+            patient_vitals={},
+            patient_notes={},
+            records_split=True,
         )
+        # Medicines, signed HC, vitals and notes are stored as rows of their own models
+        create_rows([row for field in RECORD_FIELDS
+                     for row in legacy_rows(patient.pk, field, validated_data.get(field))])
         return patient
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        data.update(patient_records(instance))
+        return data
+
 
 class MedicineDataSerializer(serializers.ModelSerializer):
     medicine_data = serializers.JSONField(required=True, allow_null=True)
@@ -163,8 +173,9 @@ class FileDataSerializer(serializers.ModelSerializer):
             file_name=validated_data['file_name'],
             file_category=validated_data['file_category'],
             file_size=validated_data['file_size'],
+            original_size=validated_data.get('original_size'),
             uploaded_by=validated_data['uploaded_by'],
-            file_data=validated_data['file_data'],
+            blob_hash=validated_data['blob_hash'],
             file_type=validated_data['file_type']
         )
         return file
@@ -0,0 +1,87 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from . import authentication  # noqa: F401 (subscribes the user and revoked token caches in every process)
+from .access import sync_patient_access
+from .changes import USER
+from .ingest import is_pending_ref, schedule_normalization
+from .invalidation import publish
+from .models import FileData, FileManifestEntry, PatientAccess, PatientData, PatientSummary
+from .patient_files import PATIENT_FILE_FIELD_PATHS, is_blob_ref, sync_file_data_manifest, sync_patient_file_manifest
+from .patient_records import delete_patient_records
+from .roster import sync_patient_summary
+
+
+@receiver(post_save, sender=PatientData)
+def patient_saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw:
+        return
+    if update_fields is None or {'patient_id', 'patient_personal_info', 'user'} & set(update_fields):
+        sync_patient_file_manifest(instance)
+    if update_fields is None or 'patient_personal_info' in update_fields:
+        schedule_pending_refs(instance)
+    if update_fields is None or {'patient_id', 'patient_personal_info', 'exit_info'} & set(update_fields):
+        sync_patient_summary(instance)
+    if update_fields is None or 'user' in update_fields:
+        sync_patient_access(instance)
+
+
+def schedule_pending_refs(patient):
+    personal_info = patient.patient_personal_info if isinstance(patient.patient_personal_info, dict) else {}
+    for field_path in PATIENT_FILE_FIELD_PATHS:
+        section_name, field = field_path.split('.')
+        section = personal_info.get(section_name)
+        ref = section.get(field) if isinstance(section, dict) else None
+        if is_blob_ref(ref) and is_pending_ref(ref):
+            schedule_normalization(ref['blob_hash'])
+
+
+@receiver(post_delete, sender=PatientData)
+def patient_deleted(sender, instance, **kwargs):
+    FileManifestEntry.objects.filter(patient_pk=instance.pk).delete()
+    PatientSummary.objects.filter(patient_pk=instance.pk).delete()
+    PatientAccess.objects.filter(patient_pk=instance.pk).delete()
+    delete_patient_records(instance.pk)
+
+
+@receiver(m2m_changed, sender=PatientData.allowed_users.through)
+def allowed_users_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        sync_patient_access(instance)
+        return
+    # Changed from the user side (user.accessible_patients); pk_set is None after a clear
+    patients = PatientData.objects.filter(pk__in=pk_set) if pk_set is not None else \
+        PatientData.objects.filter(pk__in=list(PatientAccess.objects.filter(user_pk=instance.pk)
+                                               .values_list('patient_pk', flat=True)))
+    for patient in patients.only('pk', 'user'):
+        sync_patient_access(patient)
+
+
+@receiver(post_save, sender=get_user_model())
+def user_saved(sender, instance, **kwargs):
+    # Every process caches users, not just this one (publish() also runs invalidate_user here)
+    publish(USER, str(instance.pk))
+
+
+@receiver(post_delete, sender=get_user_model())
+def user_deleted(sender, instance, **kwargs):
+    # The M2M rows go away without m2m_changed
+    PatientAccess.objects.filter(user_pk=instance.pk).delete()
+    publish(USER, str(instance.pk))
+
+
+@receiver(post_save, sender=FileData)
+def file_data_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    sync_file_data_manifest(instance)
+    if instance.original_size is None and instance.blob_hash:
+        schedule_normalization(instance.blob_hash)
+
+
+@receiver(post_delete, sender=FileData)
+def file_data_deleted(sender, instance, **kwargs):
+    FileManifestEntry.objects.filter(file_id=instance.file_id).delete()
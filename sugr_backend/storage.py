@@ -0,0 +1,434 @@
+import base64
+import binascii
+import hashlib
+import os
+import re
+import uuid
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+_BLOB_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+_UPLOAD_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,128}$')
+
+
+class BlobNotFound(Exception):
+    pass
+
+
+def check_blob_hash(blob_hash):
+    """Blob hashes end up in file paths and queries, so only accept lowercase SHA-256 hex."""
+    if not isinstance(blob_hash, str) or not _BLOB_HASH_RE.match(blob_hash):
+        raise BlobNotFound(blob_hash)
+    return blob_hash
+
+
+def check_upload_id(upload_id):
+    if not isinstance(upload_id, str) or not _UPLOAD_ID_RE.match(upload_id):
+        raise ValueError("Invalid upload id")
+    return upload_id
+
+
+class BlobStore:
+    """Content-addressed storage: every blob is stored once, keyed by the SHA-256 of its bytes."""
+    chunk_size = DEFAULT_CHUNK_SIZE
+
+    def put(self, data):
+        """Store bytes and return (blob_hash, size)."""
+        return self.put_stream([data])
+
+    def put_stream(self, chunks):
+        """Store an iterable of byte chunks without joining them and return (blob_hash, size)."""
+        raise NotImplementedError
+
+    def iter_chunks(self, blob_hash, start=0, end=None):
+        """Yield the bytes in [start, end) of a blob, chunk_size at a time."""
+        raise NotImplementedError
+
+    def size(self, blob_hash):
+        raise NotImplementedError
+
+    def exists(self, blob_hash):
+        raise NotImplementedError
+
+    def delete(self, blob_hash):
+        raise NotImplementedError
+
+    def read(self, blob_hash):
+        return b''.join(self.iter_chunks(blob_hash))
+
+    # Staging area for resumable uploads: chunks are kept per upload until they are
+    # committed into a single blob with put_stream(iter_staged(...)).
+
+    def stage_chunk(self, upload_id, index, chunks):
+        """Store (or replace) chunk number index of an upload and return (size, sha256 hex)."""
+        raise NotImplementedError
+
+    def staged_chunks(self, upload_id):
+        """Return {index: size} for the chunks received so far."""
+        raise NotImplementedError
+
+    def iter_staged(self, upload_id, indexes):
+        """Yield the bytes of the given staged chunks in order."""
+        raise NotImplementedError
+
+    def discard_staged(self, upload_id, indexes=None):
+        """Drop the given staged chunks, or all of them."""
+        raise NotImplementedError
+
+
+class FileSystemBlobStore(BlobStore):
+    """Blobs as plain files under root, fanned out as ab/cd/<hash>."""
+
+    def __init__(self, root, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.root = str(root)
+        self.chunk_size = chunk_size
+
+    def _path(self, blob_hash):
+        check_blob_hash(blob_hash)
+        return os.path.join(self.root, blob_hash[:2], blob_hash[2:4], blob_hash)
+
+    def _tmp_dir(self):
+        path = os.path.join(self.root, 'tmp')
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def put_stream(self, chunks):
+        digest = hashlib.sha256()
+        size = 0
+        tmp_path = os.path.join(self._tmp_dir(), uuid.uuid4().hex)
+        try:
+            with open(tmp_path, 'wb') as tmp:
+                for chunk in chunks:
+                    if not chunk:
+                        continue
+                    digest.update(chunk)
+                    size += len(chunk)
+                    tmp.write(chunk)
+            blob_hash = digest.hexdigest()
+            path = self._path(blob_hash)
+            if os.path.exists(path):
+                # Identical content is already stored, keep the existing copy.
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return blob_hash, size
+
+    def iter_chunks(self, blob_hash, start=0, end=None):
+        try:
+            handle = open(self._path(blob_hash), 'rb')
+        except FileNotFoundError:
+            raise BlobNotFound(blob_hash)
+        with handle:
+            handle.seek(start)
+            remaining = None if end is None else max(end - start, 0)
+            while remaining is None or remaining > 0:
+                to_read = self.chunk_size if remaining is None else min(self.chunk_size, remaining)
+                chunk = handle.read(to_read)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def size(self, blob_hash):
+        try:
+            return os.path.getsize(self._path(blob_hash))
+        except FileNotFoundError:
+            raise BlobNotFound(blob_hash)
+
+    def exists(self, blob_hash):
+        try:
+            return os.path.exists(self._path(blob_hash))
+        except BlobNotFound:
+            return False
+
+    def delete(self, blob_hash):
+        try:
+            os.remove(self._path(blob_hash))
+        except (FileNotFoundError, BlobNotFound):
+            pass
+
+    def _upload_dir(self, upload_id):
+        return os.path.join(self.root, 'uploads', check_upload_id(upload_id))
+
+    def stage_chunk(self, upload_id, index, chunks):
+        upload_dir = self._upload_dir(upload_id)
+        os.makedirs(upload_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        tmp_path = os.path.join(self._tmp_dir(), uuid.uuid4().hex)
+        try:
+            with open(tmp_path, 'wb') as tmp:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    tmp.write(chunk)
+            # Rename into place so a half-written chunk is never visible as received
+            os.replace(tmp_path, os.path.join(upload_dir, str(int(index))))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return size, digest.hexdigest()
+
+    def staged_chunks(self, upload_id):
+        upload_dir = self._upload_dir(upload_id)
+        if not os.path.isdir(upload_dir):
+            return {}
+        return {int(name): os.path.getsize(os.path.join(upload_dir, name))
+                for name in os.listdir(upload_dir) if name.isdigit()}
+
+    def iter_staged(self, upload_id, indexes):
+        upload_dir = self._upload_dir(upload_id)
+        for index in indexes:
+            with open(os.path.join(upload_dir, str(int(index))), 'rb') as handle:
+                while True:
+                    chunk = handle.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+
+    def discard_staged(self, upload_id, indexes=None):
+        upload_dir = self._upload_dir(upload_id)
+        if not os.path.isdir(upload_dir):
+            return
+        names = os.listdir(upload_dir) if indexes is None else [str(int(index)) for index in indexes]
+        for name in names:
+            try:
+                os.remove(os.path.join(upload_dir, name))
+            except FileNotFoundError:
+                pass
+        if indexes is None:
+            try:
+                os.rmdir(upload_dir)
+            except OSError:
+                pass
+
+
+class GridFSBlobStore(BlobStore):
+    """Blobs as GridFS files in the application database, stored in fixed-size chunks."""
+
+    def __init__(self, bucket_name='blobs', chunk_size=DEFAULT_CHUNK_SIZE, using='default'):
+        self.bucket_name = bucket_name
+        self.chunk_size = chunk_size
+        self.using = using
+
+    def _bucket(self):
+        import gridfs
+        from .mongo import get_database
+        return gridfs.GridFSBucket(get_database(self.using), bucket_name=self.bucket_name,
+                                   chunk_size_bytes=self.chunk_size)
+
+    def _files(self):
+        from .mongo import get_database
+        return get_database(self.using)[f'{self.bucket_name}.files']
+
+    def _find(self, blob_hash):
+        check_blob_hash(blob_hash)
+        return self._files().find_one({'filename': blob_hash}, {'_id': 1, 'length': 1})
+
+    def put_stream(self, chunks):
+        bucket = self._bucket()
+        digest = hashlib.sha256()
+        size = 0
+        # The hash is only known once all chunks are written, so upload under a
+        # temporary name and rename (or drop, if the content already exists) afterwards.
+        grid_in = bucket.open_upload_stream(f'tmp-{uuid.uuid4().hex}')
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                digest.update(chunk)
+                size += len(chunk)
+                grid_in.write(chunk)
+            grid_in.close()
+        except BaseException:
+            grid_in.abort()
+            raise
+        blob_hash = digest.hexdigest()
+        if self._find(blob_hash):
+            bucket.delete(grid_in._id)
+        else:
+            bucket.rename(grid_in._id, blob_hash)
+        return blob_hash, size
+
+    def iter_chunks(self, blob_hash, start=0, end=None):
+        doc = self._find(blob_hash)
+        if not doc:
+            raise BlobNotFound(blob_hash)
+        grid_out = self._bucket().open_download_stream(doc['_id'])
+        try:
+            grid_out.seek(start)
+            remaining = None if end is None else max(end - start, 0)
+            while remaining is None or remaining > 0:
+                to_read = self.chunk_size if remaining is None else min(self.chunk_size, remaining)
+                chunk = grid_out.read(to_read)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+        finally:
+            grid_out.close()
+
+    def size(self, blob_hash):
+        doc = self._find(blob_hash)
+        if not doc:
+            raise BlobNotFound(blob_hash)
+        return doc['length']
+
+    def exists(self, blob_hash):
+        try:
+            return self._find(blob_hash) is not None
+        except BlobNotFound:
+            return False
+
+    def delete(self, blob_hash):
+        try:
+            check_blob_hash(blob_hash)
+        except BlobNotFound:
+            return
+        bucket = self._bucket()
+        for doc in self._files().find({'filename': blob_hash}, {'_id': 1}):
+            bucket.delete(doc['_id'])
+
+    def _staged_name(self, upload_id, index):
+        return f'upload-{check_upload_id(upload_id)}-{int(index)}'
+
+    def stage_chunk(self, upload_id, index, chunks):
+        bucket = self._bucket()
+        digest = hashlib.sha256()
+        size = 0
+        grid_in = bucket.open_upload_stream(f'tmp-{uuid.uuid4().hex}',
+                                            metadata={'upload_id': upload_id, 'index': int(index)})
+        try:
+            for chunk in chunks:
+                digest.update(chunk)
+                size += len(chunk)
+                grid_in.write(chunk)
+            grid_in.close()
+        except BaseException:
+            grid_in.abort()
+            raise
+        name = self._staged_name(upload_id, index)
+        for doc in self._files().find({'filename': name}, {'_id': 1}):
+            bucket.delete(doc['_id'])
+        bucket.rename(grid_in._id, name)
+        return size, digest.hexdigest()
+
+    def staged_chunks(self, upload_id):
+        check_upload_id(upload_id)
+        docs = self._files().find({'metadata.upload_id': upload_id, 'filename': {'$regex': '^upload-'}},
+                                  {'metadata.index': 1, 'length': 1})
+        return {doc['metadata']['index']: doc['length'] for doc in docs}
+
+    def iter_staged(self, upload_id, indexes):
+        bucket = self._bucket()
+        for index in indexes:
+            grid_out = bucket.open_download_stream_by_name(self._staged_name(upload_id, index))
+            try:
+                while True:
+                    chunk = grid_out.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                grid_out.close()
+
+    def discard_staged(self, upload_id, indexes=None):
+        check_upload_id(upload_id)
+        query = {'metadata.upload_id': upload_id}
+        if indexes is not None:
+            query['metadata.index'] = {'$in': [int(index) for index in indexes]}
+        bucket = self._bucket()
+        for doc in self._files().find(query, {'_id': 1}):
+            bucket.delete(doc['_id'])
+
+
+_blob_store = None
+
+
+def get_blob_store():
+    """Return the blob store configured by settings.BLOB_STORE (created once per process)."""
+    global _blob_store
+    if _blob_store is None:
+        config = getattr(settings, 'BLOB_STORE', {})
+        backend = import_string(config.get('BACKEND', 'sugr_backend.storage.FileSystemBlobStore'))
+        options = dict(config.get('OPTIONS', {}))
+        if backend is FileSystemBlobStore:
+            options.setdefault('root', os.path.join(settings.BASE_DIR, 'blobs'))
+        _blob_store = backend(**options)
+    return _blob_store
+
+
+def decode_base64_payload(value):
+    """Decode a base64 string as sent by the frontend, with or without a data: URL prefix."""
+    if not isinstance(value, str):
+        raise ValueError("File data must be a base64 string")
+    value = value.strip()
+    if value.startswith('data:') and ',' in value:
+        value = value.split(',', 1)[1]
+    try:
+        return base64.b64decode(value)
+    except (binascii.Error, ValueError) as e:
+        raise ValueError(f"Invalid base64 file data: {e}")
+
+
+def store_base64(value):
+    """Decode a base64 payload into the blob store and return (blob_hash, size)."""
+    return get_blob_store().put(decode_base64_payload(value))
+
+
+def read_base64(blob_hash):
+    """Read a blob back as a base64 string, for responses that still embed file bytes."""
+    return base64.b64encode(get_blob_store().read(blob_hash)).decode('ascii')
+
+
+def is_blob_referenced(blob_hash):
+    """Whether a FileData row or a patient file field refers to the blob."""
+    from .models import FileData, PatientData
+    from .mongo import get_collection
+    from .patient_files import PATIENT_FILE_FIELD_PATHS
+
+    if FileData.objects.filter(blob_hash=blob_hash).exists():
+        return True
+    patient_refs = {'$or': [{f'patient_personal_info.{field_path}.blob_hash': blob_hash}
+                            for field_path in PATIENT_FILE_FIELD_PATHS]}
+    return get_collection(PatientData).find_one(patient_refs, {'_id': 1}) is not None
+
+
+def release_blob(blob_hash):
+    """Mark a blob for deletion once nothing references it any more (blobs are shared by identical uploads).
+
+    Deleting it right away would race with a write that shares the same bytes again between
+    the check and the delete; sweep_released_blobs deletes it after a grace period instead."""
+    from .models import ReleasedBlob
+
+    if not blob_hash or is_blob_referenced(blob_hash):
+        return False
+    ReleasedBlob.objects.update_or_create(blob_hash=blob_hash, defaults={'released_at': timezone.now()})
+    return True
+
+
+def sweep_released_blobs(released_before):
+    """Delete the blobs released before released_before that are still unreferenced; returns how many."""
+    from .models import ReleasedBlob
+
+    store = get_blob_store()
+    count = 0
+    for released in ReleasedBlob.objects.filter(released_at__lt=released_before):
+        if not is_blob_referenced(released.blob_hash):
+            store.delete(released.blob_hash)
+            count += 1
+        # Only this mark; a newer release of the same blob keeps its own grace period
+        ReleasedBlob.objects.filter(blob_hash=released.blob_hash, released_at=released.released_at).delete()
+    return count
@@ -1,3 +1,359 @@
-from django.test import TestCase
+import uuid
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.test import RequestFactory, TestCase, override_settings
+from rest_framework.test import APIClient
+
+from .access import accessible_patient_pks
+from .authentication import tokens_for_user
+from .changes import FILE, PATIENT, record_change, record_file_change, visible_changes
+from .downloads import RangeNotSatisfiable, parse_range_header
+from .models import ChangeEvent, PatientData, SignedHCEntry
+from .patient_files import InvalidBlobRef, check_blob_refs
+from .patient_records import (
+    RECORD_FIELDS, RecordsMoving, assemble_medicines, assemble_notes, assemble_signed_hc, assemble_vitals,
+    bump_patient_version, claim_patient_records, ensure_patient_records, legacy_rows, patient_records,
+    release_patient_records, replace_patient_records, split_patient_records,
+)
+from .patient_updates import _minimal_paths, apply_merge_patch
+from .permissions import HasPermissionCodes, has_type_permission
+
+BLOB_A = 'a' * 64
+BLOB_B = 'b' * 64
+
+
+def make_user(**fields):
+    email = f"{uuid.uuid4().hex}@example.com"
+    return get_user_model().objects.create_user(username=email, email=email, password='secret',
+                                                first_name='Test', last_name='User', **fields)
+
+
+def make_patient(user, **fields):
+    values = {
+        'patient_personal_info': {'section_1': {'firstname': 'Ayşe', 'lastname': 'Yılmaz'}, 'section_2': {}},
+        'patient_medicines': {},
+        'patient_signed_hc': {},
+    }
+    values.update(fields)
+    return PatientData.objects.create(user=user, patient_id=uuid.uuid4().hex, **values)
+
+
+def auth_client(user):
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f"Bearer {tokens_for_user(user).access_token}")
+    return client
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PatientVersionTests(TestCase):
+    def setUp(self):
+        self.user = make_user()
+        self.patient = make_patient(self.user)
+
+    def test_save_if_version_writes_only_the_expected_version(self):
+        version = self.patient.version
+        self.patient.exit_info = {'reason': 'discharged'}
+        self.assertTrue(self.patient.save_if_version(version, ['exit_info']))
+        self.assertEqual(self.patient.version, version + 1)
+
+        stale = PatientData.objects.get(pk=self.patient.pk)
+        stale.exit_info = {'reason': 'lost update'}
+        self.assertFalse(stale.save_if_version(version, ['exit_info']))
+        stored = PatientData.objects.get(pk=self.patient.pk)
+        self.assertEqual(stored.exit_info, {'reason': 'discharged'})
+        self.assertEqual(stored.version, version + 1)
+
+    def test_update_with_stale_if_match_is_a_conflict(self):
+        response = auth_client(self.user).put(
+            '/api/patients/', {'type': 'update_patient', 'patient_id': self.patient.patient_id,
+                               'patch': {'exit_info': {'reason': 'x'}}},
+            format='json', HTTP_IF_MATCH=f'"{self.patient.version - 1}"')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['version'], self.patient.version)
+
+    def test_projections_of_a_patient_have_their_own_etag(self):
+        client = auth_client(self.user)
+        url = f'/api/patients/?patient_id={self.patient.patient_id}'
+        full = client.get(url)['ETag']
+        projected = client.get(f'{url}&sections=section_1')['ETag']
+        self.assertEqual(full, f'"{self.patient.version}"')
+        self.assertNotEqual(projected, full)
+        self.assertEqual(client.get(f'{url}&sections=section_1', HTTP_IF_NONE_MATCH=full).status_code, 200)
+        self.assertEqual(client.get(f'{url}&sections=section_1', HTTP_IF_NONE_MATCH=projected).status_code, 304)
+
+        # The projected ETag is as good as the version for If-Match
+        response = client.put('/api/patients/', {'type': 'update_patient', 'patient_id': self.patient.patient_id,
+                                                  'patch': {'exit_info': {'reason': 'x'}}},
+                              format='json', HTTP_IF_MATCH=projected)
+        self.assertEqual(response.status_code, 200)
+
+
+class MergePatchTests(TestCase):
+    def test_nested_set_and_unset(self):
+        document = {'patient_personal_info': {'section_1': {'firstname': 'A', 'room': '12'}, 'section_2': {'x': 1}}}
+        merged, set_paths, unset_paths = apply_merge_patch(
+            document, {'patient_personal_info': {'section_1': {'firstname': 'B', 'room': None}}})
+        self.assertEqual(merged['patient_personal_info'],
+                         {'section_1': {'firstname': 'B'}, 'section_2': {'x': 1}})
+        self.assertEqual(set_paths, {('patient_personal_info', 'section_1', 'firstname')})
+        self.assertEqual(unset_paths, {('patient_personal_info', 'section_1', 'room')})
+        self.assertEqual(document['patient_personal_info']['section_1'], {'firstname': 'A', 'room': '12'})
+
+    def test_keys_that_are_not_field_paths_write_the_enclosing_object(self):
+        merged, set_paths, unset_paths = apply_merge_patch(
+            {'patient_notes': {'a': 1}}, {'patient_notes': {'b.c': 2, '$d': 3}})
+        self.assertEqual(merged['patient_notes'], {'a': 1, 'b.c': 2, '$d': 3})
+        self.assertEqual(_minimal_paths(set_paths, unset_paths), ([('patient_notes',)], []))
+
+    def test_top_level_null_clears_the_field(self):
+        merged, set_paths, _ = apply_merge_patch({'exit_info': {'reason': 'x'}}, {'exit_info': None})
+        self.assertEqual(merged['exit_info'], {})
+        self.assertEqual(set_paths, {('exit_info',)})
+
+    @override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+    def test_patch_only_changes_the_patched_paths(self):
+        user = make_user()
+        patient = make_patient(user, patient_personal_info={'section_1': {'firstname': 'A'}, 'section_2': {'x': 1}})
+        response = auth_client(user).put(
+            '/api/patients/', {'type': 'update_patient', 'patient_id': patient.patient_id,
+                               'patch': {'patient_personal_info': {'section_2': {'x': None, 'y': 2}}}},
+            format='json', HTTP_IF_MATCH=f'"{patient.version}"')
+        self.assertEqual(response.status_code, 200)
+        stored = PatientData.objects.get(pk=patient.pk)
+        self.assertEqual(stored.patient_personal_info, {'section_1': {'firstname': 'A'}, 'section_2': {'y': 2}})
+        self.assertEqual(stored.version, patient.version + 1)
+
+
+# In the shapes load_patient_records() rebuilds, so they must survive a move unchanged
+LEGACY_RECORDS = {
+    'patient_medicines': {
+        'med-1': {'medicine_id': 'med-1', 'medicine_data': {
+            'name': 'Parol', 'dose': '500mg',
+            'prepared_dates': {'01-02-24': True},
+            'given_dates': {'morning': {'01-02-24': {'timestamp': '1706770800', 'given': True}},
+                            'noon': {}, 'evening': {'01-02-24': False}},
+        }},
+    },
+    'patient_vitals': {'heart_beat': [{'value': 72.0, 'date': '01-02-24', 'timestamp': '1706770800'}],
+                       'oxygen': [], 'stress': [], 'sleep': [], 'vitality': []},
+    'patient_notes': {'note-1': {'note_id': 'note-1', 'note_title': 'Lunch', 'note_data': 'Ate well',
+                                 'note_date': '01-02-24', 'created_by': 'nurse@example.com', 'timestamp': '1'}},
+    'patient_signed_hc': {
+        '01-02-24': {'daily': [
+            {'signed_hc_id': 'hc-1', 'signed_hc_data': {'ok': True}, 'created_by': 'a', 'insert_ts': '1'},
+            # Not an object, stored wrapped in the row
+            {'signed_hc_id': 'hc-2', 'signed_hc_data': 'plain text', 'created_by': 'b', 'insert_ts': '2'},
+        ]},
+    },
+}
+
+
+def assemble(rows, field):
+    by_model = {}
+    for row in rows:
+        by_model.setdefault(type(row).__name__, []).append(row)
+    if field == 'patient_medicines':
+        return assemble_medicines(by_model.get('MedicationOrder', []), by_model.get('MedicationAdministration', []))
+    if field == 'patient_vitals':
+        return assemble_vitals(by_model.get('VitalReading', []))
+    if field == 'patient_notes':
+        return assemble_notes(by_model.get('PatientNote', []))
+    return assemble_signed_hc(by_model.get('SignedHCEntry', []))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PatientRecordsTests(TestCase):
+    def test_legacy_rows_round_trip(self):
+        for field in RECORD_FIELDS:
+            with self.subTest(field=field):
+                rows = legacy_rows(1, field, LEGACY_RECORDS[field])
+                self.assertTrue(rows)
+                self.assertEqual(assemble(rows, field), LEGACY_RECORDS[field])
+
+    def test_split_moves_the_records_once(self):
+        patient = make_patient(make_user(), **LEGACY_RECORDS)
+        self.assertTrue(split_patient_records(patient.pk))
+        self.assertFalse(split_patient_records(patient.pk))
+
+        stored = PatientData.objects.get(pk=patient.pk)
+        self.assertTrue(stored.records_split)
+        self.assertIsNone(stored.records_moving)
+        self.assertEqual(stored.version, patient.version)
+        for field in RECORD_FIELDS:
+            self.assertEqual(getattr(stored, field), {})
+        self.assertEqual(patient_records(stored), LEGACY_RECORDS)
+        self.assertEqual(SignedHCEntry.objects.filter(patient_pk=patient.pk).count(), 2)
+
+    def test_record_writes_are_refused_while_the_records_are_claimed(self):
+        patient = make_patient(make_user(), **LEGACY_RECORDS)
+        ensure_patient_records(patient)
+        self.assertIsNone(claim_patient_records(patient.pk, patient.version - 1))
+        claimed_at = claim_patient_records(patient.pk, patient.version)
+        self.assertIsNotNone(claimed_at)
+        self.assertIsNone(claim_patient_records(patient.pk, patient.version))
+        with self.assertRaises(RecordsMoving):
+            ensure_patient_records(patient)
+        with self.assertRaises(RecordsMoving):
+            bump_patient_version(patient.pk)
+
+        replace_patient_records(patient.pk, 'patient_notes', {})
+        self.assertEqual(release_patient_records(patient.pk, claimed_at), patient.version + 1)
+        ensure_patient_records(patient)
+        self.assertEqual(patient_records(PatientData.objects.get(pk=patient.pk), ['patient_notes']),
+                         {'patient_notes': {}})
+        self.assertEqual(bump_patient_version(patient.pk), patient.version + 2)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ChangeFeedVisibilityTests(TestCase):
+    def test_users_see_changes_of_their_patients_their_own_and_global_ones(self):
+        user, other = make_user(), make_user()
+        own_patient, other_patient = make_patient(user), make_patient(other)
+        shared_patient = make_patient(other)
+        shared_patient.allowed_users.add(user)
+
+        visible = [
+            record_change(PATIENT, own_patient.patient_id, patient_pk=own_patient.pk),
+            record_change(PATIENT, shared_patient.patient_id, patient_pk=shared_patient.pk),
+            record_change(FILE, 'file-1', user_pk=user.pk),
+            record_change('medicine', 'med-1'),
+            # Uploaded by someone else, for a patient the user can access
+            record_file_change('file-2', shared_patient.patient_id, user_pk=other.pk),
+        ]
+        hidden = [
+            record_change(PATIENT, other_patient.patient_id, patient_pk=other_patient.pk),
+            record_change(FILE, 'file-3', user_pk=other.pk),
+            record_file_change('file-4', other_patient.patient_id, user_pk=other.pk),
+        ]
+        events = ChangeEvent.objects.filter(pk__in=[event.pk for event in visible + hidden])
+
+        seen = set(visible_changes(user, accessible_patient_pks(user)).filter(pk__in=events.values_list('pk', flat=True))
+                   .values_list('pk', flat=True))
+        self.assertEqual(seen, {event.pk for event in visible})
+        self.assertEqual(visible[-1].patient_pk, shared_patient.pk)
+
+        staff = make_user(is_staff=True)
+        self.assertEqual(visible_changes(staff, accessible_patient_pks(staff)).filter(pk__in=events.values_list('pk', flat=True)).count(),
+                         len(visible + hidden))
+
+
+class RangeHeaderTests(TestCase):
+    def test_ranges(self):
+        self.assertEqual(parse_range_header('bytes=0-4', 10), (0, 5))
+        self.assertEqual(parse_range_header('bytes=5-', 10), (5, 10))
+        self.assertEqual(parse_range_header('bytes=-3', 10), (7, 10))
+        self.assertEqual(parse_range_header('bytes=8-20', 10), (8, 10))
+        # Invalid or multiple ranges are ignored
+        for header in ('bytes=5-2', 'bytes=0-1,4-5', 'items=0-1'):
+            with self.subTest(header=header):
+                self.assertIsNone(parse_range_header(header, 10))
+        for header, size in (('bytes=10-', 10), ('bytes=-0', 10), ('bytes=-5', 0)):
+            with self.subTest(header=header, size=size):
+                with self.assertRaises(RangeNotSatisfiable):
+                    parse_range_header(header, size)
+
+
+class _View:
+    required_permissions = {'GET': 'view_patients', 'PUT': {'add_note': ['edit_patient_notes', 'view_patients']}}
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PermissionTests(TestCase):
+    def request(self, method, user, codes, data=None):
+        user.permission_codes = codes
+        request = getattr(RequestFactory(), method.lower())('/', data or {}, content_type='application/json')
+        request.user = user
+        request.auth = tokens_for_user(user).access_token
+        request.query_params = request.GET
+        return request
+
+    def test_required_codes_by_method_and_type(self):
+        user = make_user()
+        permission = HasPermissionCodes()
+        self.assertTrue(permission.has_permission(self.request('GET', user, ['view_patients']), _View()))
+        self.assertFalse(permission.has_permission(self.request('GET', user, ['view_files']), _View()))
+        # Codes by type are left to the view
+        self.assertTrue(permission.has_permission(self.request('PUT', user, [], {'type': 'add_note'}), _View()))
+        self.assertFalse(has_type_permission(self.request('PUT', user, ['edit_patient_notes']), _View(), 'add_note'))
+        self.assertTrue(has_type_permission(
+            self.request('PUT', user, ['edit_patient_notes', 'view_patients']), _View(), 'add_note'))
+        # Types that are not listed need no code
+        self.assertTrue(has_type_permission(self.request('PUT', user, []), _View(), 'other'))
+
+    def test_type_codes_are_checked_on_a_body_over_the_upload_limit(self):
+        body = {'type': 'add_note', 'patient_id': 'missing', 'note_data': 'x' * (3 * 1024 * 1024)}
+        user = make_user(permission_codes=['view_patients'])
+        self.assertEqual(auth_client(user).put('/api/patients/', body, format='json').status_code, 403)
+        user = make_user(permission_codes=['view_patients', 'edit_patient_notes'])
+        self.assertEqual(auth_client(user).put('/api/patients/', body, format='json').status_code, 404)
+
+    def test_missing_code_is_forbidden(self):
+        user = make_user(permission_codes=['view_files'])
+        self.assertEqual(auth_client(user).get('/api/patients/').status_code, 403)
+
+    def test_token_of_an_older_auth_version_is_rejected(self):
+        user = make_user()
+        client = auth_client(user)
+        self.assertEqual(client.get('/api/patients/').status_code, 200)
+        user.auth_version += 1
+        user.save()
+        response = client.get('/api/patients/')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.data['code'], 'token_outdated')
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class TokenTests(TestCase):
+    def setUp(self):
+        self.user = make_user()
+        self.client = APIClient()
+        response = self.client.post('/api/login/', {'email': self.user.email, 'password': 'secret'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.tokens = response.data
+
+    def test_refresh_rotates_and_a_used_refresh_token_is_rejected(self):
+        response = self.client.post('/api/refresh/', {'refresh': self.tokens['refresh']}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.data['refresh'], self.tokens['refresh'])
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        self.assertEqual(self.client.get('/api/patients/').status_code, 200)
+
+        reused = self.client.post('/api/refresh/', {'refresh': self.tokens['refresh']}, format='json')
+        self.assertEqual(reused.status_code, 401)
+
+    def test_logout_revokes_the_access_and_refresh_token(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.tokens['access']}")
+        response = self.client.post('/api/logout/', {'refresh': self.tokens['refresh']}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get('/api/patients/').status_code, 401)
+        self.client.credentials()
+        self.assertEqual(self.client.post('/api/refresh/', {'refresh': self.tokens['refresh']},
+                                          format='json').status_code, 401)
+
+
+class BlobRefTests(TestCase):
+    def stored_info(self):
+        return {'section_4': {'mocaFile': {'blob_hash': BLOB_A, 'size': 10, 'content_type': 'application/pdf',
+                                           'original_hash': BLOB_B}}}
+
+    def test_unchanged_ref_is_replaced_by_the_stored_one(self):
+        info = {'section_4': {'mocaFile': {'blob_hash': BLOB_A, 'size': 999999, 'content_type': 'text/html'}}}
+        check_blob_refs(info, self.stored_info())
+        self.assertEqual(info, self.stored_info())
+
+    def test_ref_read_before_normalization_matches_by_original_hash(self):
+        info = {'section_4': {'mocaFile': {'blob_hash': BLOB_B}}}
+        check_blob_refs(info, self.stored_info())
+        self.assertEqual(info['section_4']['mocaFile']['blob_hash'], BLOB_A)
+
+    def test_refs_that_are_not_stored_at_the_field_are_rejected(self):
+        cases = [
+            ({'section_4': {'mocaFile': {'blob_hash': 'c' * 64}}}, self.stored_info()),
+            ({'section_4': {'miniCogFile': {'blob_hash': BLOB_A}}}, self.stored_info()),
+            ({'section_4': {'mocaFile': {'blob_hash': '../../etc/passwd'}}}, self.stored_info()),
+            ({'section_1': {'image': {'blob_hash': BLOB_A}}}, None),  # New patient
+        ]
+        for info, stored in cases:
+            with self.subTest(info=info):
+                with self.assertRaises(InvalidBlobRef):
+                    check_blob_refs(info, stored)
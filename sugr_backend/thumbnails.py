@@ -0,0 +1,125 @@
+import os
+import threading
+import uuid
+from io import BytesIO
+
+from django.conf import settings
+from PIL import Image, ImageOps
+
+from .storage import check_blob_hash
+
+THUMBNAIL_SIZES = {'64': 64, '256': 256}
+THUMBNAIL_CONTENT_TYPE = 'image/jpeg'
+
+
+def render_thumbnail(data, size):
+    """Resize image bytes to fit in a size x size box and return them as JPEG."""
+    image = Image.open(BytesIO(data))
+    # Let the JPEG decoder downscale while decoding instead of decoding full resolution
+    image.draft('RGB', (size * 2, size * 2))
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.thumbnail((size, size), Image.LANCZOS)
+    output = BytesIO()
+    image.save(output, format='JPEG', quality=85, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+class ThumbnailCache:
+    """Rendered thumbnails on disk, keyed by source hash and size.
+
+    Hits touch the file's mtime, and once the cache grows past max_bytes the least
+    recently used files are removed until it is back under 90% of the budget."""
+
+    def __init__(self, root, max_bytes):
+        self.root = str(root)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes = None
+
+    def _path(self, source_hash, size):
+        check_blob_hash(source_hash)  # Part of the path
+        return os.path.join(self.root, source_hash[:2], f'{source_hash}_{size}.jpg')
+
+    def get(self, source_hash, size):
+        """Return the bytes of a cached thumbnail, or None.
+
+        Read here rather than returning the path: eviction by another request may remove the
+        file at any time, and an open file stays readable."""
+        path = self._path(source_hash, size)
+        try:
+            with open(path, 'rb') as handle:
+                data = handle.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, source_hash, size, data):
+        path = self._path(source_hash, size)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as tmp:
+            tmp.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._scan_total()
+            else:
+                self._total_bytes += len(data)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.jpg'):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield stat.st_mtime, stat.st_size, path
+
+    def _scan_total(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        # Other workers share the directory, so recount from disk before evicting
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._total_bytes = total
+
+
+_thumbnail_cache = None
+
+
+def get_thumbnail_cache():
+    global _thumbnail_cache
+    if _thumbnail_cache is None:
+        config = getattr(settings, 'THUMBNAIL_CACHE', {})
+        _thumbnail_cache = ThumbnailCache(
+            config.get('root', os.path.join(settings.BASE_DIR, 'thumbnail_cache')),
+            config.get('max_bytes', 256 * 1024 * 1024),
+        )
+    return _thumbnail_cache
+
+
+def get_or_create_thumbnail(source_hash, size, load_source):
+    """Bytes of the cached thumbnail for source_hash, rendering it from load_source() on a miss."""
+    cache = get_thumbnail_cache()
+    data = cache.get(source_hash, size)
+    if data is None:
+        data = render_thumbnail(load_source(), size)
+        cache.put(source_hash, size, data)
+    return data
@@ -5,9 +5,23 @@ urlpatterns = [
     path('register/', views.RegisterUser.as_view(), name='register'),
     path('login/', views.LoginUser.as_view(), name='login'),
     path('verify/', views.CustomTokenVerifyView.as_view(), name='custom_token_verify'),
+    path('refresh/', views.TokenRefreshAPI.as_view(), name='token_refresh'),
+    path('logout/', views.LogoutUser.as_view(), name='logout'),
     path('patients/', views.PatientAPI.as_view(), name='patient-api'),
+    path('patients/roster/', views.PatientRosterAPI.as_view(), name='patient-roster'),
+    path('patients/search/', views.PatientSearchAPI.as_view(), name='patient-search'),
+    path('patients/export/', views.PatientBulkExportAPI.as_view(), name='patient-bulk-export'),
+    path('patients/<str:patient_id>/photo/', views.PatientPhotoAPI.as_view(), name='patient-photo'),
+    path('patients/<str:patient_id>/export/', views.PatientExportAPI.as_view(), name='patient-export'),
     path('medicines/', views.MedicineAPI.as_view(), name='medicine-api'),
+    path('changes/', views.ChangeFeedAPI.as_view(), name='change-feed'),
+    path('events/ticket/', views.EventStreamTicketAPI.as_view(), name='event-stream-ticket'),
     path('files/', views.FileAPI.as_view(), name='file-api'),
+    path('files/<str:file_id>/content/', views.FileContentAPI.as_view(), name='file-content'),
+    path('files/uploads/', views.FileUploadAPI.as_view(), name='file-upload'),
+    path('files/uploads/<str:upload_id>/', views.FileUploadDetailAPI.as_view(), name='file-upload-detail'),
+    path('files/uploads/<str:upload_id>/chunks/<int:index>/', views.FileUploadChunkAPI.as_view(), name='file-upload-chunk'),
+    path('files/uploads/<str:upload_id>/commit/', views.FileUploadCommitAPI.as_view(), name='file-upload-commit'),
     # Admin API (is_staff only)
     path('admin/users/', views.AdminUserList.as_view(), name='admin-user-list'),
     path('admin/users/<int:pk>/', views.AdminUserDetail.as_view(), name='admin-user-detail'),
@@ -13,7 +13,47 @@ from .serializers import (
     AdminPatientAccessSerializer,
     PatientDataSerializer, MedicineDataSerializer, FileDataSerializer,
 )
-from .models import FileData
+from .models import (
+    FileData, FileUpload, FileManifestEntry, PatientSummary, MedicationOrder, MedicationAdministration,
+    PatientNote, SignedHCEntry,
+)
+from .storage import BlobNotFound, get_blob_store, decode_base64_payload, read_base64, release_blob
+from .ingest import ingest_bytes, ingest_stored_blob
+from .pagination import encode_cursor, decode_cursor, parse_limit
+from .downloads import Base64Payload, streaming_file_response
+from .patient_files import (
+    PATIENT_FILE_FIELD_PATHS, InvalidBlobRef, is_blob_ref, externalize_patient_files, store_patient_file,
+    collect_blob_hashes, release_unreferenced, read_ref_base64, guess_content_type,
+    extract_files_from_patient_data, parse_patient_file_id, parse_uploaded_date, manifest_entry_to_dict,
+)
+from .thumbnails import THUMBNAIL_SIZES, THUMBNAIL_CONTENT_TYPE, get_or_create_thumbnail
+from .roster import (
+    ROSTER_SORTS, parse_roster_filters, filter_summaries, facet_counts, roster_fingerprint, summary_to_card,
+)
+from .search import SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT, search_patients
+from .mongo import get_collection
+from .patient_updates import apply_merge_patch, save_merge_patch
+from .patient_records import (
+    RECORD_FIELDS, VITAL_TYPES, GIVEN_PERIODS, administration_rows, split_medicine_data, vital_reading,
+    signed_hc_entry, create_rows, load_patient_records, attach_patient_records, patient_records,
+    replace_patient_records, ensure_patient_records, bump_patient_version, RecordsMoving,
+    claim_patient_records, release_patient_records,
+)
+from .conditional import compute_etag, not_modified_response, set_etag
+from .projection import PATIENT_JSON_FIELDS, split_param, build_patient_projection, find_projected_patients
+from .exports import zip_response, patient_export_entries, patient_folder_name
+from .access import accessible_patient_pks, get_accessible_patients_queryset
+from .authentication import (
+    StreamTicket, get_cached_user, renew_sliding_token, revoke_token, rotate_refresh_token, sliding_token_for_user,
+    stream_ticket_for, tokens_for_user,
+)
+from .passwords import PasswordHashingBusy, check_password, run_password_hashing
+from .permissions import AUTH_VERSION_CLAIM, HasPermissionCodes, has_type_permission
+from .changes import (
+    PATIENT, MEDICINE, USER, CREATED, DELETED, REVOKED, DEFAULT_CHANGES_LIMIT, MAX_CHANGES_LIMIT,
+    record_change, record_patient_change, record_file_change, latest_cursor, visible_changes, is_expired,
+    coalesce_changes, settled_before,
+)
 from django.contrib.auth import get_user_model
 from django.core import serializers
 
@@ -23,17 +63,29 @@ class RegisterUser(APIView):
     def post(self, request):
         serializer = UserSerializer(data=request.data)
         if serializer.is_valid():
-            serializer.save()
+            try:
+                run_password_hashing(serializer.save)
+            except PasswordHashingBusy as e:
+                return password_hashing_busy_response(e)
             return Response({"status": "success", "data": serializer.data}, status=status.HTTP_201_CREATED)
         else:
             return Response({"status": "error", "data": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
 
 
 from django.contrib.auth import authenticate
-from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken, SlidingToken
+
+
+def password_hashing_busy_response(busy):
+    return Response({"error": "Too many logins at once, please try again"},
+                    status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": str(busy.retry_after)})
 
 
 class LoginUser(APIView):
+    """Log in with email and password; with "sliding": true a single sliding token is returned
+    instead of an access/refresh pair. Clients renew either through refresh/, without the password."""
     permission_classes = [AllowAny]
 
     def post(self, request):
@@ -43,17 +95,74 @@ class LoginUser(APIView):
             user = get_user_model().objects.get(email=email)
         except get_user_model().DoesNotExist:
             return Response({"error": "Invalid credentials"}, status=status.HTTP_401_UNAUTHORIZED)
-        if not user.check_password(password):
+        try:
+            password_ok = check_password(user, password)
+        except PasswordHashingBusy as e:
+            return password_hashing_busy_response(e)
+        if not password_ok:
             return Response({"error": "Invalid credentials"}, status=status.HTTP_401_UNAUTHORIZED)
-        if user is not None:
-            refresh = RefreshToken.for_user(user)
-            user_data = UserReadSerializer(user).data
-            return Response({
-                'refresh': str(refresh),
-                'access': str(refresh.access_token),
-                'user': user_data,
-            })
-        return Response({"error": "Invalid credentials"}, status=status.HTTP_401_UNAUTHORIZED)
+        user_data = UserReadSerializer(user).data
+        if request.data.get('sliding'):
+            return Response({'token': str(sliding_token_for_user(user)), 'user': user_data})
+        refresh = tokens_for_user(user)
+        return Response({
+            'refresh': str(refresh),
+            'access': str(refresh.access_token),
+            'user': user_data,
+        })
+
+
+class EventStreamTicketAPI(APIView):
+    """POST: a ticket to open the event stream with (GET /api/events/?ticket=), valid once for 30 seconds."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        ticket = stream_ticket_for(request.user, request.auth)
+        return Response({"ticket": str(ticket), "expires_in": int(StreamTicket.lifetime.total_seconds())},
+                        status=status.HTTP_200_OK)
+
+
+class TokenRefreshAPI(APIView):
+    """Renew tokens without the password.
+
+    {"refresh": ...} returns a new access and refresh token; the refresh token sent is revoked,
+    so each one can be used once. {"token": ...} renews a sliding token. Both carry the current
+    permissions of the user."""
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
+    def post(self, request):
+        try:
+            if request.data.get('refresh'):
+                refresh, user = rotate_refresh_token(request.data['refresh'])
+                return Response({'refresh': str(refresh), 'access': str(refresh.access_token)})
+            if request.data.get('token'):
+                token, user = renew_sliding_token(request.data['token'])
+                return Response({'token': str(token)})
+        except (TokenError, AuthenticationFailed) as e:
+            return Response({"error": str(e)}, status=status.HTTP_401_UNAUTHORIZED)
+        return Response({"error": "refresh or token must be provided"}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class LogoutUser(APIView):
+    """Revoke the token of the request and the refresh (or sliding) token in the body."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        tokens = [request.auth] if request.auth is not None else []
+        try:
+            if request.data.get('refresh'):
+                tokens.append(RefreshToken(request.data['refresh']))
+            if request.data.get('token'):
+                tokens.append(SlidingToken(request.data['token']))
+        except TokenError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        for token in tokens:
+            if token.get(api_settings.USER_ID_CLAIM) != getattr(request.user, api_settings.USER_ID_FIELD):
+                return Response({"error": "Token belongs to another user"}, status=status.HTTP_400_BAD_REQUEST)
+        for token in tokens:
+            revoke_token(token)
+        return Response({"status": "success"}, status=status.HTTP_200_OK)
 
 
 from rest_framework.views import APIView
@@ -76,28 +185,28 @@ class CustomTokenVerifyView(APIView):
             user_id = untyped.get('user_id')
             if not user_id:
                 return Response({'success': False}, status=401)
-            user = get_user_model().objects.get(pk=user_id)
+            token_version = untyped.get(AUTH_VERSION_CLAIM)
+            user = get_cached_user(user_id, token_version)
+            if user is None or (token_version is not None and token_version < user.auth_version):
+                return Response({'success': False}, status=401)
             user_data = UserReadSerializer(user).data
             return Response({'success': True, 'user': user_data})
-        except (InvalidToken, TokenError, get_user_model().DoesNotExist):
+        except (InvalidToken, TokenError):
             return Response({'success': False}, status=401)
 
 
 from .models import PatientData, MedicineData, FileData
 from datetime import datetime
 from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from django.db import IntegrityError
 from django.db.models import Q
 from io import BytesIO
 from PIL import Image
 import base64
 
 
-def get_accessible_patients_queryset(user):
-    """Patients the user can access: own, allowed_users, or all if staff."""
-    if getattr(user, 'is_staff', False):
-        return PatientData.objects.all()
-    return PatientData.objects.filter(Q(user=user) | Q(allowed_users=user)).distinct()
-
 RESPONSE_TEMPLATE = {
     "Monday": {"drugs_data": [], "given_drugs": []},
     "Tuesday": {"drugs_data": [], "given_drugs": []},
@@ -147,16 +256,104 @@ def get_object_id(input_str):
     return hash_object.hexdigest()
 
 
+PATIENT_UPDATE_TYPES = {
+    "update_patient", "add_scheduled_medicine", "update_scheduled_medicine", "remove_scheduled_medicine",
+    "add_given_medicine", "add_prepared_medicine", "add_signed_hc", "update_signed_hc",
+    "add_vitals", "add_note", "update_note",
+}
+# Updates that only add entries; they never conflict with a concurrent write
+COMMUTATIVE_PATIENT_UPDATES = {
+    "add_given_medicine", "add_prepared_medicine", "add_signed_hc", "add_vitals", "add_note",
+}
+# Updates of the medicine, signed HC, vitals and note rows rather than of the PatientData document
+RECORD_UPDATE_TYPES = PATIENT_UPDATE_TYPES - {"update_patient"}
+PATIENT_UPDATE_RETRIES = 5
+
+
+class PatientUpdate:
+    """What a PatientAPI.put mutator did: the fields to save (None to save nothing) and the response."""
+
+    def __init__(self, respond, fields=None, on_saved=None, save=None, records=None):
+        self.respond = respond
+        self.fields = fields
+        self.on_saved = on_saved
+        self.save = save  # Custom compare-and-swap write, save(loaded_version) -> bool
+        self.records = records  # {record field: legacy JSON value} whose rows the update replaces
+
+
+def records_moving_response():
+    return Response({"status": "failed", "error": "Patient records are being updated, please retry"},
+                    status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": "1"})
+
+
+def requested_version(request, request_data):
+    """Patient version the client based its update on (If-Match header or "version" in the body), or None."""
+    value = request.META.get('HTTP_IF_MATCH')
+    if value:
+        value = value.strip()
+        if value.startswith('W/'):
+            value = value[2:]
+        # Without the projection suffix of a GET with ?fields=/?sections=
+        value = value.strip('"').split('-', 1)[0]
+    else:
+        value = request_data.pop("version", None)
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError("version must be an integer")
+
+
+def parse_client_date(value, output_format="%d-%m-%y"):
+    """Reformat a browser date string like "Tue Apr 23 2024 01:53:24 GMT+0300 (GMT+03:00)" """
+    return datetime.strptime(value.split(" GMT")[0], "%a %b %d %Y %H:%M:%S").strftime(output_format)
+
+
+def version_conflict_response(current_version):
+    return Response({"status": "failed", "error": "Patient was changed by someone else, reload and retry",
+                     "version": current_version}, status=status.HTTP_409_CONFLICT)
+
+
 class PatientAPI(APIView):
-    permission_classes = [IsAuthenticated]
+    permission_classes = [IsAuthenticated, HasPermissionCodes]
+    required_permissions = {
+        'GET': 'view_patients',
+        'POST': {'new': 'add_patient'},
+        'PUT': {
+            'update_patient': 'edit_patient',
+            'add_scheduled_medicine': 'edit_patient_medicines',
+            'update_scheduled_medicine': 'edit_patient_medicines',
+            'remove_scheduled_medicine': 'edit_patient_medicines',
+            'add_given_medicine': 'edit_patient_medicines',
+            'add_prepared_medicine': 'edit_patient_medicines',
+            'add_signed_hc': 'edit_patient_hc',
+            'update_signed_hc': 'edit_patient_hc',
+            'add_vitals': 'edit_patient_vitals',
+            'add_note': 'edit_patient_notes',
+            'update_note': 'edit_patient_notes',
+        },
+        'DELETE': {
+            'delete_patient': 'delete_patient',
+            'delete_medicines': 'edit_patient_medicines',
+            'delete_note': 'edit_patient_notes',
+            'delete_signed_hc': 'edit_patient_hc',
+        },
+    }
 
     def _user_email(self, request):
         return request.user.email if request.user and request.user.is_authenticated else None
 
+    def _check_type_permission(self, request, request_type):
+        """The codes for the request's type; HasPermissionCodes leaves them to the view."""
+        if not has_type_permission(request, self, request_type):
+            self.permission_denied(request, message=HasPermissionCodes.message)
+
     def post(self, request):
         request_data = dict(request.data)
         request_data.pop("email", None)
         request_type = request_data.pop("type")
+        self._check_type_permission(request, request_type)
         user = request.user
 
         if request_type == "new":
@@ -185,7 +382,13 @@ class PatientAPI(APIView):
 
             serializer = PatientDataSerializer(data=patient_data)
             if serializer.is_valid():
-                serializer.save()
+                # Keep attachments out of the patient document; only once it is valid, so no blobs are orphaned
+                try:
+                    externalize_patient_files(serializer.validated_data.get("patient_personal_info"))
+                except InvalidBlobRef as e:
+                    return Response({"status": "error", "data": {"patient_personal_info": [str(e)]}},
+                                    status=status.HTTP_400_BAD_REQUEST)
+                record_patient_change(serializer.save(), action=CREATED, user=user)
                 return Response({"status": "success", "data": serializer.data}, status=status.HTTP_201_CREATED)
             else:
                 return Response({"status": "error", "data": serializer.errors},
@@ -194,420 +397,470 @@ class PatientAPI(APIView):
             return Response({"status": "failed"}, status=status.HTTP_400_BAD_REQUEST)
 
     def get(self, request):
+        """?patient_id= or ?patient_ids=a,b for specific patients; ?fields=/?sections= to fetch only parts."""
         patient_id = request.query_params.get('patient_id')
+        patient_ids = split_param(request.query_params.get('patient_ids'))
+        if patient_id:
+            patient_ids.append(patient_id)
         user = request.user
         qs = get_accessible_patients_queryset(user)
 
-        if not patient_id:
+        try:
+            projection = build_patient_projection(request.query_params.get('fields'),
+                                                  request.query_params.get('sections'))
+        except ValueError as e:
+            return Response({"status": "error", "error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if not patient_ids:
             patient_data = qs
+        elif len(patient_ids) == 1:
+            patient_data = qs.filter(patient_id=patient_ids[0])
         else:
-            patient_data = qs.filter(patient_id=patient_id)
-
-        serializer = PatientDataSerializer(patient_data, many=True)
+            patient_data = qs.filter(patient_id__in=patient_ids)
+
+        # The versions alone decide the ETag, so an unchanged poll never loads the JSON fields
+        versions = list(patient_data.order_by('pk').values_list('pk', 'version'))
+        if patient_ids and len(versions) == 1:
+            # A single patient's ETag starts with its version, so it can be sent back in If-Match on PUT;
+            # a projection adds a suffix, since each one is a different representation
+            etag = str(versions[0][1])
+            if projection is not None:
+                etag = f"{etag}-{compute_etag(projection)[:16]}"
+        else:
+            etag = compute_etag(versions, projection)
+        response = not_modified_response(request, etag)
+        if response is not None:
+            return response
 
-        return Response({"status": "success", "data": serializer.data}, status=status.HTTP_200_OK)
+        if projection is not None:
+            data = find_projected_patients(qs, projection, patient_ids)
+        else:
+            data = PatientDataSerializer(attach_patient_records(list(patient_data)), many=True).data
+        return set_etag(Response({"status": "success", "data": data}, status=status.HTTP_200_OK), etag)
 
     def put(self, request):
+        """Apply one update type to a patient.
+
+        Medicine, vitals, note and signed HC updates (RECORD_UPDATE_TYPES) only write their own
+        rows (see patient_records.py), so they no longer race with each other. update_patient is a
+        compare-and-swap on PatientData.version, retried when it races with another write.
+        Except for the appending COMMUTATIVE_PATIENT_UPDATES, clients may send the version
+        they based the update on, in If-Match or as "version" in the body, and get 409 if the
+        patient changed since."""
         request_data = dict(request.data)
         request_data.pop("email", None)
         request_type = request_data.pop("type")
+        self._check_type_permission(request, request_type)
         user = request.user
-        email = user.email
 
-        if request_type == "update_patient":
-            try:
-                patient_data = get_accessible_patients_queryset(user).get(patient_id=request_data["patient_id"])
-                
-                def clean_none_values(obj):
-                    """Recursively remove None values from dict/list structures, replacing with empty dict"""
-                    if isinstance(obj, dict):
-                        cleaned = {}
-                        for key, value in obj.items():
-                            if value is None:
-                                cleaned[key] = {}
-                            elif isinstance(value, (dict, list)):
-                                cleaned[key] = clean_none_values(value)
-                            else:
-                                cleaned[key] = value
-                        return cleaned
-                    elif isinstance(obj, list):
-                        cleaned = []
-                        for item in obj:
-                            if item is None:
-                                cleaned.append({})
-                            elif isinstance(item, (dict, list)):
-                                cleaned.append(clean_none_values(item))
-                            else:
-                                cleaned.append(item)
-                        return cleaned
-                    return obj
-                
-                # Update patient_personal_info if provided
-                if "patient_personal_info" in request_data:
-                    # Make a copy to avoid modifying the original request data
-                    personal_info = copy.deepcopy(request_data["patient_personal_info"])
-                    # Ensure patient_id is set in section_1
-                    if "section_1" in personal_info:
-                        personal_info["section_1"]["patient_id"] = patient_data.patient_id
-                    
-                    # Add metadata for file updates in section_1 (image)
-                    if "section_1" in personal_info:
-                        section_1 = personal_info["section_1"]
-                        if "image" in section_1 and section_1["image"]:
-                            if "_file_metadata" not in section_1:
-                                section_1["_file_metadata"] = {}
-                            if "image" not in section_1["_file_metadata"]:
-                                section_1["_file_metadata"]["image"] = {}
-                            section_1["_file_metadata"]["image"]["last_updated_by"] = email
-                            section_1["_file_metadata"]["image"]["last_updated_date"] = timezone.now().isoformat()
-                    
-                    # Add metadata for file updates in section_4
-                    if "section_4" in personal_info:
-                        section_4 = personal_info["section_4"]
-                        file_fields = [
-                            'psychiatricMedPrescriptionFile',
-                            'depressionScaleFile',
-                            'mocaFile',
-                            'miniCogFile',
-                            'socialReportFile'
-                        ]
-                        
-                        if "_file_metadata" not in section_4:
-                            section_4["_file_metadata"] = {}
-                        
-                        for file_field in file_fields:
-                            if file_field in section_4 and section_4[file_field]:
-                                if file_field not in section_4["_file_metadata"]:
-                                    section_4["_file_metadata"][file_field] = {}
-                                section_4["_file_metadata"][file_field]["last_updated_by"] = email
-                                section_4["_file_metadata"][file_field]["last_updated_date"] = timezone.now().isoformat()
-                    
-                    patient_data.patient_personal_info = personal_info
-                
-                # Update patient_medicines if provided
-                if "patient_medicines" in request_data:
-                    patient_data.patient_medicines = request_data["patient_medicines"]
-                else:
-                    # Clean existing patient_medicines to remove None values
-                    if patient_data.patient_medicines:
-                        patient_data.patient_medicines = clean_none_values(patient_data.patient_medicines)
-                
-                # Update patient_signed_hc if provided
-                if "patient_signed_hc" in request_data:
-                    patient_data.patient_signed_hc = request_data["patient_signed_hc"]
-                else:
-                    # Clean existing patient_signed_hc to remove None values
-                    if patient_data.patient_signed_hc:
-                        patient_data.patient_signed_hc = clean_none_values(patient_data.patient_signed_hc)
-                
-                # Update patient_vitals if provided
-                if "patient_vitals" in request_data:
-                    patient_data.patient_vitals = request_data["patient_vitals"]
-                else:
-                    # Clean existing patient_vitals to remove None values
-                    if patient_data.patient_vitals:
-                        patient_data.patient_vitals = clean_none_values(patient_data.patient_vitals)
-                
-                # Update patient_notes if provided
-                if "patient_notes" in request_data:
-                    patient_data.patient_notes = request_data["patient_notes"]
-                else:
-                    # Clean existing patient_notes to remove None values
-                    if patient_data.patient_notes:
-                        patient_data.patient_notes = clean_none_values(patient_data.patient_notes)
-                
-                # Ensure exit_info is not None (it can be None due to null=True, but JSONField doesn't accept None)
-                if patient_data.exit_info is None:
-                    patient_data.exit_info = {}
-                elif patient_data.exit_info:
-                    patient_data.exit_info = clean_none_values(patient_data.exit_info)
+        mutator = getattr(self, f"_{request_type}", None) if request_type in PATIENT_UPDATE_TYPES else None
+        if mutator is None:
+            return Response({"status": "failed"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            expected_version = requested_version(request, request_data)
+        except ValueError as e:
+            return Response({"status": "error", "error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if request_type in COMMUTATIVE_PATIENT_UPDATES:
+            expected_version = None
+
+        patch = request_data.get("patch") if request_type == "update_patient" else None
+        if patch is not None and (not isinstance(patch, dict) or set(patch) - set(PATIENT_JSON_FIELDS)):
+            return Response({"status": "error", "message": f"patch must be an object with keys from {PATIENT_JSON_FIELDS}"},
+                            status=status.HTTP_400_BAD_REQUEST)
 
-                patient_data.save()
-                
-                # Serialize the response
-                serializer = PatientDataSerializer(patient_data)
-                return Response({"status": "success", "data": serializer.data}, status=status.HTTP_200_OK)
-            except PatientData.DoesNotExist:
+        queryset = get_accessible_patients_queryset(user)
+        patient_data = queryset.filter(patient_id=request_data.get("patient_id")) \
+            .only('pk', 'patient_id', 'version', 'records_split').first()
+        if not patient_data:
+            if request_type == "update_patient":
                 return Response({"status": "error", "message": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
-            except Exception as e:
-                print(f"Error updating patient: {str(e)}")
-                return Response({"status": "error", "message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
-        elif request_type == "add_scheduled_medicine":
-            patient_data = get_accessible_patients_queryset(user).filter(patient_id=request_data["patient_id"]).first()
+            return Response({"status": "failed", "error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            ensure_patient_records(patient_data)
+        except RecordsMoving:
+            return records_moving_response()
+
+        if request_type in RECORD_UPDATE_TYPES:
+            # Checked before the write; the version is bumped once, by _records_response, after it succeeded
+            if expected_version is not None:
+                current = PatientData.objects.filter(pk=patient_data.pk).values_list('version', flat=True).first()
+                if current != expected_version:
+                    return version_conflict_response(current)
+            return mutator(patient_data, request_data, user)
+
+        for _ in range(PATIENT_UPDATE_RETRIES):
+            patients = queryset.filter(patient_id=request_data.get("patient_id"))
+            if patch is not None:
+                # A merge patch only needs the fields it touches
+                patients = patients.only('pk', 'patient_id', 'user', 'version', 'records_split',
+                                         *[field for field in patch if field not in RECORD_FIELDS])
+            patient_data = patients.first()
             if not patient_data:
-                return Response({"status": "failed", "error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
-            medicine_id = get_object_id(str(request_data["patient_id"]) + str(request_data["medicine_data"]))
-            request_data["medicine_data"]["prepared_dates"] = {}
-            request_data["medicine_data"]["given_dates"] = {"morning": {}, "noon": {}, "evening": {}}
-
-            medicine = {
-                "medicine_id": medicine_id,
-                "medicine_data": request_data["medicine_data"],
-            }
-            if medicine_id in patient_data.patient_medicines:
-                return Response({"status": "failed"}, status=status.HTTP_400_BAD_REQUEST)
+                return Response({"status": "error", "message": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
+            if expected_version is not None and patient_data.version != expected_version:
+                return version_conflict_response(patient_data.version)
+
+            loaded_version = patient_data.version
+            update = mutator(patient_data, request_data, user)
+            if update.fields is None:
+                return update.respond()
+            # Replaced rows are claimed at the loaded version first, so no record write lands in between
+            claimed_at = claim_patient_records(patient_data.pk, loaded_version) if update.records else None
+            if update.records and claimed_at is None:
+                if PatientData.objects.filter(pk=patient_data.pk, version=loaded_version).exists():
+                    # Unchanged, but another request is moving or replacing the records
+                    return records_moving_response()
+                saved = False
+            elif update.save:
+                saved = update.save(loaded_version)
+            else:
+                saved = patient_data.save_if_version(loaded_version, update.fields)
+            if saved:
+                if claimed_at is not None:
+                    self._replace_records(patient_data, update.records, claimed_at)
+                if update.on_saved:
+                    update.on_saved()
+                return update.respond()
+            if claimed_at is not None:
+                release_patient_records(patient_data.pk, claimed_at, changed=False)
+            if expected_version is not None:
+                current = PatientData.objects.filter(pk=patient_data.pk).values_list('version', flat=True).first()
+                return version_conflict_response(current)
+        return version_conflict_response(None)
+
+    def _replace_records(self, patient_data, record_values, claimed_at):
+        """Write the medicine/signed HC/vitals/notes values of an update_patient, after its save, and release the claim."""
+        try:
+            for field, value in record_values.items():
+                replace_patient_records(patient_data.pk, field, value)
+        finally:
+            patient_data.version = release_patient_records(patient_data.pk, claimed_at) or patient_data.version
 
+    def _records_response(self, patient_data, field, user, keys=(), response_status=status.HTTP_200_OK):
+        """Bump the patient version after its rows of field (under keys) changed and answer with the whole field."""
+        try:
+            patient_data.version = bump_patient_version(patient_data.pk)
+        except RecordsMoving:
+            return records_moving_response()
+        record_patient_change(patient_data, [f"{field}.{key}" for key in keys] or [field], user=user)
+        data = load_patient_records([patient_data.pk], [field])[patient_data.pk][field]
+        return Response({"status": "success", "data": data}, status=response_status)
+
+    def _update_patient(self, patient_data, request_data, user):
+        if request_data.get("patch") is not None:
+            return self._merge_patch_patient(patient_data, request_data, user)
+        email = user.email
+        try:
+            def clean_none_values(obj):
+                """Recursively remove None values from dict/list structures, replacing with empty dict"""
+                if isinstance(obj, dict):
+                    cleaned = {}
+                    for key, value in obj.items():
+                        if value is None:
+                            cleaned[key] = {}
+                        elif isinstance(value, (dict, list)):
+                            cleaned[key] = clean_none_values(value)
+                        else:
+                            cleaned[key] = value
+                    return cleaned
+                elif isinstance(obj, list):
+                    cleaned = []
+                    for item in obj:
+                        if item is None:
+                            cleaned.append({})
+                        elif isinstance(item, (dict, list)):
+                            cleaned.append(clean_none_values(item))
+                        else:
+                            cleaned.append(item)
+                    return cleaned
+                return obj
+
+            # Update patient_personal_info if provided
+            released_hashes = None
+            if "patient_personal_info" in request_data:
+                # Make a copy to avoid modifying the original request data
+                personal_info = copy.deepcopy(request_data["patient_personal_info"])
+                # Ensure patient_id is set in section_1
+                if "section_1" in personal_info:
+                    personal_info["section_1"]["patient_id"] = patient_data.patient_id
+
+                # Move newly uploaded files to the blob store; unchanged files arrive as references
+                changed_file_paths = externalize_patient_files(personal_info, patient_data.patient_personal_info)
+
+                # Add metadata for file updates in section_1 (image) and section_4
+                for field_path in changed_file_paths:
+                    section_name, file_field = field_path.split('.')
+                    section = personal_info[section_name]
+                    if "_file_metadata" not in section:
+                        section["_file_metadata"] = {}
+                    if file_field not in section["_file_metadata"]:
+                        section["_file_metadata"][file_field] = {}
+                    section["_file_metadata"][file_field]["last_updated_by"] = email
+                    section["_file_metadata"][file_field]["last_updated_date"] = timezone.now().isoformat()
+
+                released_hashes = collect_blob_hashes(patient_data.patient_personal_info)
+                patient_data.patient_personal_info = personal_info
+
+            # patient_medicines, patient_signed_hc, patient_vitals and patient_notes replace their rows if provided
+            record_values = {field: request_data[field] for field in RECORD_FIELDS if field in request_data}
+
+            # Ensure exit_info is not None (it can be None due to null=True, but JSONField doesn't accept None)
+            if patient_data.exit_info is None:
+                patient_data.exit_info = {}
+            elif patient_data.exit_info:
+                patient_data.exit_info = clean_none_values(patient_data.exit_info)
+        except Exception as e:
+            print(f"Error updating patient: {str(e)}")
+            # e is unbound once the except block ends, before respond() runs
+            message = str(e)
+            return PatientUpdate(lambda: Response({"status": "error", "message": message},
+                                                  status=status.HTTP_400_BAD_REQUEST))
+
+        def on_saved():
+            changed = list(record_values) + ["exit_info"]
+            if "patient_personal_info" in request_data:
+                changed.append("patient_personal_info")
+            record_patient_change(patient_data, changed, user=user)
+            if released_hashes:
+                release_unreferenced(released_hashes, collect_blob_hashes(patient_data.patient_personal_info))
+
+        # Serialize the response
+        return PatientUpdate(
+            lambda: Response({"status": "success", "data": PatientDataSerializer(patient_data).data},
+                             status=status.HTTP_200_OK),
+            fields=['patient_personal_info', 'exit_info'], on_saved=on_saved, records=record_values)
+
+    def _merge_patch_patient(self, patient_data, request_data, user):
+        """update_patient with "patch": an RFC 7396 merge patch of the patient's JSON fields.
+
+        Only the paths the patch changes are written ($set/$unset), nothing else is re-saved.
+        Patched record fields (patient_records.py) have their rows replaced."""
+        patch = request_data["patch"]
+        record_fields = [field for field in patch if field in RECORD_FIELDS]
+        document = {field: getattr(patient_data, field) for field in patch if field not in RECORD_FIELDS}
+        document.update(patient_records(patient_data, record_fields))
+        merged, set_paths, unset_paths = apply_merge_patch(document, patch)
+        set_paths = {path for path in set_paths if path[0] not in RECORD_FIELDS}
+        unset_paths = {path for path in unset_paths if path[0] not in RECORD_FIELDS}
+
+        released_hashes = set()
+        if "patient_personal_info" in patch:
+            personal_info = merged["patient_personal_info"]
+            released_hashes = collect_blob_hashes(document["patient_personal_info"])
             try:
-                patient_data.patient_medicines[medicine_id] = medicine
-            except Exception:
-                patient_data.patient_medicines = {medicine_id: medicine}
-
-            patient_data.save()
-            return Response({"status": "success", "data": patient_data.patient_medicines}, status=status.HTTP_200_OK)
-        elif request_type == "update_scheduled_medicine":
-            patient_data = get_accessible_patients_queryset(user).filter(patient_id=request_data["patient_id"]).first()
-            if not patient_data:
-                return Response({"status": "failed", "error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
-            medicine_id = request_data.get("medicine_id")
-            
-            if not medicine_id or medicine_id not in patient_data.patient_medicines:
-                return Response({"status": "failed", "error": "Medicine not found"}, status=status.HTTP_404_NOT_FOUND)
-            
-            # Get existing medicine to preserve prepared_dates and given_dates
-            existing_medicine = patient_data.patient_medicines[medicine_id]
-            updated_medicine_data = request_data["medicine_data"]
-            
-            # Preserve existing prepared_dates and given_dates if not provided
-            if "prepared_dates" not in updated_medicine_data:
-                updated_medicine_data["prepared_dates"] = existing_medicine["medicine_data"].get("prepared_dates", {})
-            if "given_dates" not in updated_medicine_data:
-                updated_medicine_data["given_dates"] = existing_medicine["medicine_data"].get("given_dates", {"morning": {}, "noon": {}, "evening": {}})
-            # Handle end_date: remove if empty string, preserve if not provided
-            if "end_date" in updated_medicine_data:
-                if not updated_medicine_data["end_date"]:  # Empty string or None
-                    updated_medicine_data.pop("end_date", None)  # Remove it
-            elif "end_date" in existing_medicine["medicine_data"]:
-                # Preserve existing end_date if not provided in update
-                updated_medicine_data["end_date"] = existing_medicine["medicine_data"].get("end_date")
-            
-            # Update the medicine
-            updated_medicine = {
-                "medicine_id": medicine_id,
-                "medicine_data": updated_medicine_data
-            }
-            
-            try:
-                patient_data.patient_medicines[medicine_id] = updated_medicine
-                patient_data.save()
-                return Response({"status": "success", "data": patient_data.patient_medicines}, status=status.HTTP_200_OK)
-            except Exception as e:
-                print(f"Error updating medicine: {str(e)}")
-                return Response({"status": "failed", "error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
-        elif request_type == "remove_scheduled_medicine":
-            return Response({"status": "failed"}, status=status.HTTP_400_BAD_REQUEST)
-        elif request_type == "add_given_medicine":
-            patient_data = get_accessible_patients_queryset(user).filter(patient_id=request_data["patient_id"]).first()
-            if not patient_data:
-                return Response({"status": "failed", "error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
-
-            medicine_id = request_data["medicine_id"]
-            given_period = request_data["period"]
-            given_dates = patient_data.patient_medicines[medicine_id]["medicine_data"]["given_dates"][given_period]
-
-            # medicine = {
-            #     "medicine_id": medicine_id,
-            #     "given_date": request_data["today_date"],
-            #     "given": request_data["given"],
-            #     "medicine_data": medicine_data,
-            # }
-
-            date_obj = datetime.strptime(request_data["today_date"].split(" GMT")[0],
-                                         "%a %b %d %Y %H:%M:%S").strftime("%d-%m-%y")
-            # "Tue Apr 23 2024 01:53:24 GMT+0300 (GMT+03:00)"
-            try:
-                # Store timestamp object instead of just boolean
-                given_dates[date_obj] = {
-                    "timestamp": request_data["today_date"],
-                    "given": True
+                changed_file_paths = externalize_patient_files(personal_info, document["patient_personal_info"])
+            except InvalidBlobRef as e:
+                message = str(e)
+                return PatientUpdate(lambda: Response({"status": "error", "message": message},
+                                                      status=status.HTTP_400_BAD_REQUEST))
+            for field_path in changed_file_paths:
+                section_name, file_field = field_path.split('.')
+                section = personal_info[section_name]
+                section.setdefault("_file_metadata", {})[file_field] = {
+                    "last_updated_by": user.email,
+                    "last_updated_date": timezone.now().isoformat(),
                 }
-                patient_data.patient_medicines[medicine_id]["medicine_data"]["given_dates"][given_period] = given_dates
-            except Exception:
-                return Response({"status": "failed"}, status=status.HTTP_400_BAD_REQUEST)
-            patient_data.save()
-
-            return Response({"status": "success", "data": patient_data.patient_medicines},
-                            status=status.HTTP_200_OK)
-        elif request_type == "add_prepared_medicine":
-            patient_data = get_accessible_patients_queryset(user).filter(patient_id=request_data["patient_id"]).first()
-            if not patient_data:
-                return Response({"status": "failed", "error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
-
-            medicine_id = request_data["medicine_id"]
-            med_prepared_dates = patient_data.patient_medicines[medicine_id]["medicine_data"]["prepared_dates"]
-            for each_date in request_data["prepared_dates"]:
-                date_obj = datetime.strptime(each_date.split(" GMT")[0],
-                                             "%a %b %d %Y %H:%M:%S").strftime("%d-%m-%y")
-                # "Tue Apr 23 2024 01:53:24 GMT+0300 (GMT+03:00)"
-                med_prepared_dates[date_obj] = True
-
-            try:
-                patient_data.patient_medicines[medicine_id]["medicine_data"]["prepared_dates"] = med_prepared_dates
-            except Exception:
-                return Response({"status": "failed"}, status=status.HTTP_400_BAD_REQUEST)
-
-            patient_data.save()
-
-            return Response({"status": "success", "data": patient_data.patient_medicines},
-                            status=status.HTTP_200_OK)
-        elif request_type == "add_signed_hc":
-            patient_data = get_accessible_patients_queryset(user).filter(patient_id=request_data["patient_id"]).first()
-            if not patient_data:
-                return Response({"status": "failed", "error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
+                set_paths.add(("patient_personal_info", section_name, file_field))
+                set_paths.add(("patient_personal_info", section_name, "_file_metadata", file_field))
+
+        def save(loaded_version):
+            document_values = {field: value for field, value in merged.items() if field not in RECORD_FIELDS}
+            return save_merge_patch(patient_data, loaded_version, document_values, set_paths, unset_paths)
+
+        def on_saved():
+            record_patient_change(patient_data, ['.'.join(path) for path in set_paths | unset_paths] + record_fields,
+                                  user=user)
+            if released_hashes:
+                release_unreferenced(released_hashes, collect_blob_hashes(merged["patient_personal_info"]))
+
+        def respond():
+            data = {"patient_id": patient_data.patient_id, "version": patient_data.version}
+            data.update({field: merged[field] for field in patch})
+            return Response({"status": "success", "data": data}, status=status.HTTP_200_OK)
 
-            date_obj = datetime.strptime(request_data["today_date"].split(" GMT")[0],
-                                         "%a %b %d %Y %H:%M:%S").strftime("%d-%m-%y")
+        return PatientUpdate(respond, fields=list(patch), on_saved=on_saved, save=save,
+                             records={field: merged[field] for field in record_fields})
 
-            signed_hc_id = get_object_id(str(request_data["patient_id"]) + str(request_data["signed_hc_data"]))
-            signed_hc_type = request_data["signed_hc_type"]
+    def _add_scheduled_medicine(self, patient_data, request_data, user):
+        medicine_id = get_object_id(str(request_data["patient_id"]) + str(request_data["medicine_data"]))
+        # A new medicine starts without prepared or given dates
+        medicine_data, _, _ = split_medicine_data(copy.deepcopy(request_data["medicine_data"]))
 
-            signed_hc = {
-                "signed_hc_id": signed_hc_id,
-                "signed_hc_data": request_data["signed_hc_data"],
-                "created_by": email,
-                "insert_ts": request_data["today_date"]
-            }
-
-            if date_obj not in patient_data.patient_signed_hc:
-                patient_data.patient_signed_hc[date_obj] = {signed_hc_type: [signed_hc, ]}
-                patient_data.save()
-                return Response({"status": "success", "data": patient_data.patient_signed_hc},
-                                status=status.HTTP_201_CREATED)
-            else:
-                if signed_hc_type not in patient_data.patient_signed_hc[date_obj]:
-                    patient_data.patient_signed_hc[date_obj][signed_hc_type] = [signed_hc, ]
-                    patient_data.save()
-                    return Response({"status": "success", "data": patient_data.patient_signed_hc},
-                                    status=status.HTTP_201_CREATED)
-                else:
-                    return Response({"status": "failed"}, status=status.HTTP_400_BAD_REQUEST)
-
-        elif request_type == "update_signed_hc":
-            patient_data = get_accessible_patients_queryset(user).filter(patient_id=request_data["patient_id"]).first()
-            if not patient_data:
-                return Response({"status": "failed", "error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
+        orders = MedicationOrder.objects.filter(patient_pk=patient_data.pk, medicine_id=medicine_id)
+        if orders.exists():
+            return Response({"status": "failed"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            MedicationOrder.objects.create(patient_pk=patient_data.pk, medicine_id=medicine_id,
+                                           medicine_data=medicine_data)
+        except IntegrityError:
+            return Response({"status": "failed"}, status=status.HTTP_400_BAD_REQUEST)
+        return self._records_response(patient_data, 'patient_medicines', user, [medicine_id])
+
+    def _update_scheduled_medicine(self, patient_data, request_data, user):
+        medicine_id = request_data.get("medicine_id")
+        order = MedicationOrder.objects.filter(patient_pk=patient_data.pk, medicine_id=medicine_id).first() \
+            if medicine_id else None
+        if order is None:
+            return Response({"status": "failed", "error": "Medicine not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        medicine_data, prepared_dates, given_dates = split_medicine_data(copy.deepcopy(request_data["medicine_data"]))
+        # Handle end_date: remove if empty string, preserve if not provided
+        if "end_date" in medicine_data:
+            if not medicine_data["end_date"]:  # Empty string or None
+                medicine_data.pop("end_date", None)  # Remove it
+        elif "end_date" in order.medicine_data:
+            # Preserve existing end_date if not provided in update
+            medicine_data["end_date"] = order.medicine_data.get("end_date")
+        order.medicine_data = medicine_data
+        order.save(update_fields=['medicine_data', 'updated_at'])
+
+        # Existing prepared_dates and given_dates are kept unless provided
+        administrations = MedicationAdministration.objects.filter(patient_pk=patient_data.pk, medicine_id=medicine_id)
+        if prepared_dates is not None:
+            administrations.filter(kind=MedicationAdministration.PREPARED).delete()
+            create_rows(administration_rows(patient_data.pk, medicine_id, prepared_dates=prepared_dates))
+        if given_dates is not None:
+            administrations.filter(kind=MedicationAdministration.GIVEN).delete()
+            create_rows(administration_rows(patient_data.pk, medicine_id, given_dates=given_dates))
+        return self._records_response(patient_data, 'patient_medicines', user, [medicine_id])
+
+    def _remove_scheduled_medicine(self, patient_data, request_data, user):
+        return Response({"status": "failed"}, status=status.HTTP_400_BAD_REQUEST)
+
+    def _add_given_medicine(self, patient_data, request_data, user):
+        medicine_id = request_data["medicine_id"]
+        given_period = request_data["period"]
+        if given_period not in GIVEN_PERIODS:
+            return Response({"status": "failed"}, status=status.HTTP_400_BAD_REQUEST)
+        if not MedicationOrder.objects.filter(patient_pk=patient_data.pk, medicine_id=medicine_id).exists():
+            return Response({"status": "failed", "error": "Medicine not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        MedicationAdministration.objects.update_or_create(
+            patient_pk=patient_data.pk, medicine_id=medicine_id, kind=MedicationAdministration.GIVEN,
+            period=given_period, date_key=parse_client_date(request_data["today_date"]),
+            defaults={"given": True, "timestamp": request_data["today_date"]})
+        return self._records_response(patient_data, 'patient_medicines', user, [medicine_id])
+
+    def _add_prepared_medicine(self, patient_data, request_data, user):
+        medicine_id = request_data["medicine_id"]
+        if not MedicationOrder.objects.filter(patient_pk=patient_data.pk, medicine_id=medicine_id).exists():
+            return Response({"status": "failed", "error": "Medicine not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        for date_key in {parse_client_date(each_date) for each_date in request_data["prepared_dates"]}:
+            MedicationAdministration.objects.get_or_create(
+                patient_pk=patient_data.pk, medicine_id=medicine_id, kind=MedicationAdministration.PREPARED,
+                period='', date_key=date_key)
+        return self._records_response(patient_data, 'patient_medicines', user, [medicine_id])
+
+    def _new_signed_hc(self, request_data, user):
+        signed_hc_id = get_object_id(str(request_data["patient_id"]) + str(request_data["signed_hc_data"]))
+        return {
+            "signed_hc_id": signed_hc_id,
+            "signed_hc_data": request_data["signed_hc_data"],
+            "created_by": user.email,
+            "insert_ts": request_data["today_date"]
+        }
 
-            date_obj = datetime.strptime(request_data["today_date"].split(" GMT")[0],
-                                         "%a %b %d %Y %H:%M:%S").strftime("%d-%m-%y")
+    def _add_signed_hc(self, patient_data, request_data, user):
+        date_obj = parse_client_date(request_data["today_date"])
+        signed_hc_type = request_data["signed_hc_type"]
+        entries = SignedHCEntry.objects.filter(patient_pk=patient_data.pk, date_key=date_obj, hc_type=signed_hc_type)
+        if entries.exists():
+            return Response({"status": "failed"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            signed_hc_entry(patient_data.pk, date_obj, signed_hc_type, 0,
+                            self._new_signed_hc(request_data, user)).save()
+        except IntegrityError:
+            # Signed by someone else at the same time
+            return Response({"status": "failed"}, status=status.HTTP_400_BAD_REQUEST)
+        return self._records_response(patient_data, 'patient_signed_hc', user, [date_obj],
+                                     status.HTTP_201_CREATED)
 
-            signed_hc_type = request_data["signed_hc_type"]
+    def _update_signed_hc(self, patient_data, request_data, user):
+        date_obj = parse_client_date(request_data["today_date"])
 
-            signed_hc = {
-                "signed_hc_id": request_data["signed_hc_id"],
-                "signed_hc_data": request_data["signed_hc_data"],
-                "created_by": email,
-                "insert_ts": request_data["today_date"]
-            }
+        signed_hc_type = request_data["signed_hc_type"]
 
-            latest_hc_updates = patient_data.patient_signed_hc[date_obj][signed_hc_type]
-            latest_hc_updates.append(signed_hc)
-            patient_data.patient_signed_hc[date_obj][signed_hc_type] = latest_hc_updates
+        signed_hc = {
+            "signed_hc_id": request_data["signed_hc_id"],
+            "signed_hc_data": request_data["signed_hc_data"],
+            "created_by": user.email,
+            "insert_ts": request_data["today_date"]
+        }
 
-            patient_data.save()
-            return Response({"status": "success", "data": patient_data.patient_signed_hc}, status=status.HTTP_200_OK)
-        elif request_type == "add_vitals":
-            patient_data = get_accessible_patients_queryset(user).filter(patient_id=request_data["patient_id"]).first()
-            if not patient_data:
-                return Response({"status": "failed", "error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
-            
-            # Initialize patient_vitals if it doesn't exist
-            if not patient_data.patient_vitals:
-                patient_data.patient_vitals = {}
-            
-            # Store vitals as arrays of values, with each entry having a timestamp
-            vitals_data = request_data.get("vitals_data", {})
-            today_date = request_data.get("today_date", datetime.now().strftime("%a %b %d %Y %H:%M:%S"))
-            date_obj = datetime.strptime(today_date.split(" GMT")[0], "%a %b %d %Y %H:%M:%S").strftime("%d-%m-%y")
-            
-            # Initialize each vital type if it doesn't exist
-            vital_types = ["heart_beat", "oxygen", "stress", "sleep", "vitality"]
-            for vital_type in vital_types:
-                if vital_type not in patient_data.patient_vitals:
-                    patient_data.patient_vitals[vital_type] = []
-            
-            # Add new vital values
-            if "heart_beat" in vitals_data and vitals_data["heart_beat"]:
-                patient_data.patient_vitals["heart_beat"].append({
-                    "value": float(vitals_data["heart_beat"]),
-                    "date": date_obj,
-                    "timestamp": today_date
-                })
-            if "oxygen" in vitals_data and vitals_data["oxygen"]:
-                patient_data.patient_vitals["oxygen"].append({
-                    "value": float(vitals_data["oxygen"]),
-                    "date": date_obj,
-                    "timestamp": today_date
-                })
-            if "stress" in vitals_data and vitals_data["stress"]:
-                patient_data.patient_vitals["stress"].append({
-                    "value": float(vitals_data["stress"]),
-                    "date": date_obj,
-                    "timestamp": today_date
-                })
-            if "sleep" in vitals_data and vitals_data["sleep"]:
-                patient_data.patient_vitals["sleep"].append({
-                    "value": float(vitals_data["sleep"]),
-                    "date": date_obj,
-                    "timestamp": today_date
-                })
-            if "vitality" in vitals_data and vitals_data["vitality"]:
-                patient_data.patient_vitals["vitality"].append({
-                    "value": float(vitals_data["vitality"]),
+        entries = SignedHCEntry.objects.filter(patient_pk=patient_data.pk, date_key=date_obj, hc_type=signed_hc_type)
+        for _ in range(PATIENT_UPDATE_RETRIES):
+            # After the last one; positions have gaps once entries were deleted
+            last_position = entries.order_by('-position').values_list('position', flat=True).first()
+            if last_position is None:
+                return Response({"status": "failed", "error": "Signed HC not found"}, status=status.HTTP_404_NOT_FOUND)
+            position = last_position + 1
+            try:
+                signed_hc_entry(patient_data.pk, date_obj, signed_hc_type, position, signed_hc).save()
+                break
+            except IntegrityError:
+                # Another update took this position, append after it
+                continue
+        else:
+            return version_conflict_response(None)
+        return self._records_response(patient_data, 'patient_signed_hc', user, [date_obj])
+
+    def _new_vital_readings(self, request_data):
+        """New readings per vital type (an empty list for types without a value)"""
+        # Store vitals as arrays of values, with each entry having a timestamp
+        vitals_data = request_data.get("vitals_data", {})
+        today_date = request_data.get("today_date", datetime.now().strftime("%a %b %d %Y %H:%M:%S"))
+        date_obj = parse_client_date(today_date)
+        readings = {}
+        for vital_type in VITAL_TYPES:
+            readings[vital_type] = []
+            if vital_type in vitals_data and vitals_data[vital_type]:
+                readings[vital_type].append({
+                    "value": float(vitals_data[vital_type]),
                     "date": date_obj,
                     "timestamp": today_date
                 })
-            
-            patient_data.save()
-            return Response({"status": "success", "data": patient_data.patient_vitals}, status=status.HTTP_200_OK)
-        elif request_type == "add_note":
-            patient_data = get_accessible_patients_queryset(user).filter(patient_id=request_data["patient_id"]).first()
-            if not patient_data:
-                return Response({"status": "failed", "error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
-            
-            # Initialize patient_notes if it doesn't exist
-            if not patient_data.patient_notes:
-                patient_data.patient_notes = {}
-            
-            # Generate note ID
-            note_id = get_object_id(str(request_data["patient_id"]) + str(request_data["note_title"]) + str(request_data["note_data"]) + str(request_data.get("today_date", datetime.now().strftime("%a %b %d %Y %H:%M:%S"))))
-            
-            today_date = request_data.get("today_date", datetime.now().strftime("%a %b %d %Y %H:%M:%S"))
-            date_obj = datetime.strptime(today_date.split(" GMT")[0], "%a %b %d %Y %H:%M:%S").strftime("%d-%m-%y %H:%M:%S")
-            
-            note = {
-                "note_id": note_id,
-                "note_title": request_data["note_title"],
-                "note_data": request_data["note_data"],
-                "note_date": date_obj,
-                "created_by": email,
-                "timestamp": today_date
-            }
-            
-            patient_data.patient_notes[note_id] = note
-            patient_data.save()
-            
-            return Response({"status": "success", "data": patient_data.patient_notes}, status=status.HTTP_200_OK)
-        elif request_type == "update_note":
-            patient_data = get_accessible_patients_queryset(user).filter(patient_id=request_data["patient_id"]).first()
-            if not patient_data:
-                return Response({"status": "failed", "error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
-            
-            note_id = request_data.get("note_id")
-            date_obj = request_data.get("note_date")
-
-            if not patient_data.patient_notes or note_id not in patient_data.patient_notes:
-                return Response({"status": "failed", "error": "Note not found"}, status=status.HTTP_404_NOT_FOUND)
-            
-            today_date = request_data.get("today_date", datetime.now().strftime("%a %b %d %Y %H:%M:%S"))
-            updated_date_obj = datetime.strptime(today_date.split(" GMT")[0], "%a %b %d %Y %H:%M:%S").strftime("%d-%m-%y %H:%M:%S")
-
-            # Update note
-            patient_data.patient_notes[note_id]["note_title"] = request_data.get("note_title", patient_data.patient_notes[note_id]["note_title"])
-            patient_data.patient_notes[note_id]["note_data"] = request_data.get("note_data", patient_data.patient_notes[note_id]["note_data"])
-            patient_data.patient_notes[note_id]["note_date"] = updated_date_obj
-            patient_data.patient_notes[note_id]["updated_at"] = today_date
+        return readings
+
+    def _add_vitals(self, patient_data, request_data, user):
+        create_rows([vital_reading(patient_data.pk, vital_type, entry)
+                     for vital_type, entries in self._new_vital_readings(request_data).items() for entry in entries])
+        return self._records_response(patient_data, 'patient_vitals', user)
+
+    def _new_note(self, request_data, user):
+        today_date = request_data.get("today_date", datetime.now().strftime("%a %b %d %Y %H:%M:%S"))
+        # Generate note ID
+        note_id = get_object_id(str(request_data["patient_id"]) + str(request_data["note_title"]) + str(request_data["note_data"]) + str(today_date))
+        return {
+            "note_id": note_id,
+            "note_title": request_data["note_title"],
+            "note_data": request_data["note_data"],
+            "note_date": parse_client_date(today_date, "%d-%m-%y %H:%M:%S"),
+            "created_by": user.email,
+            "timestamp": today_date
+        }
 
-            patient_data.save()
-            return Response({"status": "success", "data": patient_data.patient_notes}, status=status.HTTP_200_OK)
+    def _add_note(self, patient_data, request_data, user):
+        note = self._new_note(request_data, user)
+        note_id = note.pop("note_id")
+        PatientNote.objects.update_or_create(patient_pk=patient_data.pk, note_id=note_id, defaults=note)
+        return self._records_response(patient_data, 'patient_notes', user, [note_id])
+
+    def _update_note(self, patient_data, request_data, user):
+        note_id = request_data.get("note_id")
+        note = PatientNote.objects.filter(patient_pk=patient_data.pk, note_id=note_id).first() if note_id else None
+        if note is None:
+            return Response({"status": "failed", "error": "Note not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        today_date = request_data.get("today_date", datetime.now().strftime("%a %b %d %Y %H:%M:%S"))
+        updated_date_obj = parse_client_date(today_date, "%d-%m-%y %H:%M:%S")
+
+        # Update note
+        note.note_title = request_data.get("note_title", note.note_title)
+        note.note_data = request_data.get("note_data", note.note_data)
+        note.note_date = updated_date_obj
+        note.updated_at = today_date
+        note.save()
+        return self._records_response(patient_data, 'patient_notes', user, [note_id])
 
     def delete(self, request):
         # Try to get data from request body first (JSON), fall back to GET params
@@ -624,6 +877,7 @@ class PatientAPI(APIView):
                             status=status.HTTP_400_BAD_REQUEST)
 
         request_type = request_data.get("type")
+        self._check_type_permission(request, request_type)
         patient_id = request_data.get("patient_id")
         if not patient_id:
             return Response({"error": "Patient ID must be provided."},
@@ -635,6 +889,11 @@ class PatientAPI(APIView):
             return Response({"status": "failed", "error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
         
         patient_data = patient_data_list[0]
+        if request_type in ("delete_medicines", "delete_note", "delete_signed_hc"):
+            try:
+                ensure_patient_records(patient_data)
+            except RecordsMoving:
+                return records_moving_response()
 
         if request_type == "delete_patient":
             # Save exit information before deleting
@@ -645,70 +904,57 @@ class PatientAPI(APIView):
                     "exit_type": exit_type,
                     "exit_reason": exit_reason
                 }
-                patient_data.save()
+                patient_data.save(update_fields=['exit_info'])
             
             patient_personal_info = patient_data.patient_personal_info
+            released_hashes = collect_blob_hashes(patient_personal_info)
+            exited_patient_id, owner_pk = patient_data.patient_id, patient_data.user_id
             patient_personal_info["section_1"] = None
             patient_personal_info["section_2"] = None
             patient_data.patient_personal_info = patient_personal_info
             patient_data.patient_id = uuid.uuid4()
             patient_data.user = None
-            patient_data.save()
+            # Only these fields: the row was loaded earlier and its records may have been moved since
+            patient_data.save(update_fields=['patient_personal_info', 'patient_id', 'user'])
+            # The owner loses access with the deletion, so the event names them explicitly
+            record_change(PATIENT, exited_patient_id, DELETED, patient_pk=patient_data.pk, user_pk=owner_pk,
+                          version=patient_data.version, changed_by=user.email)
+            release_unreferenced(released_hashes, collect_blob_hashes(patient_personal_info))
             return Response({"status": "success", "data": patient_data.patient_id}, status=status.HTTP_200_OK)
         elif request_type == "delete_medicines":
-            patient_data = get_accessible_patients_queryset(user).filter(patient_id=request_data["patient_id"]).first()
-            if not patient_data:
-                return Response({"status": "failed", "error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
-
             medicine_ids = request_data.get("medicine_ids", [])
             if not medicine_ids:
                 return Response({"error": "medicine_ids must be provided."},
                                 status=status.HTTP_400_BAD_REQUEST)
 
-            patient_medicines = patient_data.patient_medicines
-            for medicine_id in medicine_ids:
-                if medicine_id in patient_medicines:
-                    del patient_medicines[medicine_id]
-            try:
-                patient_data.patient_medicines = patient_medicines
-            except Exception:
-                return Response({"status": "failed"}, status=status.HTTP_400_BAD_REQUEST)
-
-            patient_data.save()
-            return Response({"status": "success", "data": patient_data.patient_medicines}, status=status.HTTP_200_OK)
+            MedicationOrder.objects.filter(patient_pk=patient_data.pk, medicine_id__in=medicine_ids).delete()
+            MedicationAdministration.objects.filter(patient_pk=patient_data.pk, medicine_id__in=medicine_ids).delete()
+            return self._records_response(patient_data, 'patient_medicines', user, medicine_ids)
 
         elif request_type == "delete_note":
-            patient_data = get_accessible_patients_queryset(user).filter(patient_id=request_data["patient_id"]).first()
-            if not patient_data:
-                return Response({"status": "failed", "error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
-            
             note_id = request_data.get("note_id")
-            
-            if not patient_data.patient_notes or note_id not in patient_data.patient_notes:
+
+            notes = PatientNote.objects.filter(patient_pk=patient_data.pk, note_id=note_id)
+            if not note_id or not notes.exists():
                 return Response({"status": "failed", "error": "Note not found"}, status=status.HTTP_404_NOT_FOUND)
-            
-            del patient_data.patient_notes[note_id]
-            
-            patient_data.save()
-            return Response({"status": "success", "data": patient_data.patient_notes}, status=status.HTTP_200_OK)
-        elif request_type == "delete_signed_hc":
-            signed_hc = patient_data["signed_hc"]
 
+            notes.delete()
+            return self._records_response(patient_data, 'patient_notes', user, [note_id])
+        elif request_type == "delete_signed_hc":
             signed_hc_id = request.query_params.get('signed_hc_id', False)
 
             if not signed_hc_id:
                 return Response({"error": "Note ID must be provided."},
                                 status=status.HTTP_400_BAD_REQUEST)
 
-            del signed_hc[signed_hc_id]
-            patient_data.patient_signed_hc = signed_hc
-            patient_data.save()
-            return Response({"status": "success", "data": patient_data.patient_signed_hc},
-                            status=status.HTTP_201_CREATED)
+            SignedHCEntry.objects.filter(patient_pk=patient_data.pk, signed_hc_id=signed_hc_id).delete()
+            return self._records_response(patient_data, 'patient_signed_hc', user,
+                                          response_status=status.HTTP_201_CREATED)
 
 
 class MedicineAPI(APIView):
-    permission_classes = [IsAuthenticated]
+    permission_classes = [IsAuthenticated, HasPermissionCodes]
+    required_permissions = {'GET': 'view_drugs'}
 
     def post(self, request):
         request_data = dict(request.data)
@@ -726,6 +972,7 @@ class MedicineAPI(APIView):
             serializer = MedicineDataSerializer(data=medicine_data)
             if serializer.is_valid():
                 serializer.save()
+                record_change(MEDICINE, medicine_data["medicine_id"], CREATED, changed_by=user.email)
                 return Response({"status": "success", "data": serializer.data}, status=status.HTTP_201_CREATED)
             else:
                 print(serializer.errors)
@@ -735,173 +982,57 @@ class MedicineAPI(APIView):
             return Response({"status": "failed"}, status=status.HTTP_400_BAD_REQUEST)
 
     def get(self, request):
+        # Any insert, update or delete changes the row count or the latest updated_at
+        stats = next(get_collection(MedicineData).aggregate([
+            {'$group': {'_id': None, 'count': {'$sum': 1}, 'latest': {'$max': '$updated_at'}}},
+        ]), {})
+        etag = compute_etag(stats.get('count', 0), stats.get('latest'))
+        response = not_modified_response(request, etag)
+        if response is not None:
+            return response
         medicine_data = MedicineData.objects.all()
         serializer = MedicineDataSerializer(medicine_data, many=True)
-        return Response({"status": "success", "data": serializer.data}, status=status.HTTP_200_OK)
-
-
-def extract_files_from_patient_data(patient_data, user_email):
-    """Extract files from PatientData and normalize them"""
-    files = []
-    patient_id = patient_data.patient_id
-    personal_info = patient_data.patient_personal_info or {}
-    section_1 = personal_info.get('section_1', {})
-    section_2 = personal_info.get('section_2', {})
-    section_3 = personal_info.get('section_3', {})
-    section_4 = personal_info.get('section_4', {})
-    
-    patient_firstname = section_1.get('firstname', '')
-    patient_lastname = section_1.get('lastname', '')
-    
-    # Helper to get uploaded_by from metadata or fallback to user_email
-    def get_uploaded_by(section, field_name):
-        metadata = section.get('_file_metadata', {})
-        field_metadata = metadata.get(field_name, {})
-        return field_metadata.get('last_updated_by', user_email)
-    
-    def extract_file_data(file_value):
-        """Helper to extract file data from various formats"""
-        if not file_value:
-            return None, None
-        
-        # Handle dict format: {data: "...", filename: "..."}
-        if isinstance(file_value, dict):
-            file_data = file_value.get('data', '')
-            filename = file_value.get('filename', '')
-            print(f"    extract_file_data: dict format, data type: {type(file_data)}, data length: {len(str(file_data)) if file_data else 0}")
-            if file_data and isinstance(file_data, str):
-                cleaned_data = file_data.strip()
-                if cleaned_data:  # Only return if not empty after strip
-                    print(f"    extract_file_data: returning dict data, length: {len(cleaned_data)}")
-                    return cleaned_data, filename
-            print(f"    extract_file_data: dict format but no valid data")
-            return None, None
-        
-        # Handle string format (direct base64 string)
-        if isinstance(file_value, str):
-            cleaned_data = file_value.strip()
-            print(f"    extract_file_data: string format, length: {len(cleaned_data)}")
-            if cleaned_data:  # Only return if not empty after strip
-                print(f"    extract_file_data: returning string data, length: {len(cleaned_data)}")
-                return cleaned_data, None
-            print(f"    extract_file_data: string format but empty after strip")
-            return None, None
-        
-        print(f"    extract_file_data: unknown format, type: {type(file_value)}")
-        return None, None
-    
-    def is_base64_string(s):
-        """Check if string looks like base64 data"""
-        if not isinstance(s, str):
-            return False
-        # Remove whitespace
-        s = s.strip()
-        if len(s) < 50:  # Reduced minimum length
-            return False
-        # Base64 strings are typically long and contain only base64 characters
-        import re
-        base64_pattern = re.compile(r'^[A-Za-z0-9+/=\s]+$')
-        # Allow some whitespace and check if it's mostly base64
-        cleaned = re.sub(r'\s+', '', s)
-        if len(cleaned) < 50:
-            return False
-        return base64_pattern.match(cleaned) is not None
-    
-    # Extract image from section_1
-    image_data = section_1.get('image')
-    file_data, _ = extract_file_data(image_data)
-    if file_data and len(file_data) >= 50:  # Relaxed validation for images too
-        # Get uploaded_by from metadata if available
-        section_1_metadata = section_1.get('_file_metadata', {})
-        image_metadata = section_1_metadata.get('image', {})
-        uploaded_by = image_metadata.get('last_updated_by', user_email)
-        uploaded_date = image_metadata.get('last_updated_date')
-        
-        files.append({
-            "file_id": f"patient_{patient_id}_image",
-            "source": "patient_data",
-            "source_id": patient_id,
-            "field_path": "section_1.image",
-            "patient_id": patient_id,
-            "patient_firstname": patient_firstname,
-            "patient_lastname": patient_lastname,
-            "file_name": f"{patient_firstname}_{patient_lastname}_photo.jpg",
-            "file_category": "Özlük Dokümanları",
-            "file_size": len(file_data) * 3 // 4,  # Approximate base64 size
-            "uploaded_by": uploaded_by,
-            "uploaded_date": uploaded_date,
-            "file_data": file_data,
-            "file_type": "image/jpeg"
-        })
-    
-    # Extract files from section_4 - all known file fields
-    file_fields = [
-        ('psychiatricMedPrescriptionFile', 'psychiatricMedPrescriptionFileName', 'Sağlık Dosyaları'),
-        ('depressionScaleFile', 'depressionScaleFileName', 'Sağlık Dosyaları'),
-        ('mocaFile', 'mocaFileName', 'Sağlık Dosyaları'),
-        ('miniCogFile', 'miniCogFileName', 'Sağlık Dosyaları'),
-        ('socialReportFile', 'socialReportFileName', 'Sağlık Dosyaları'),
-    ]
-    
-    for file_field, filename_field, category in file_fields:
-        file_value = section_4.get(file_field)
-        
-        # Debug: Log what we're getting
-        if file_value:
-            print(f"Found {file_field} for patient {patient_id}, type: {type(file_value)}, length: {len(str(file_value)) if isinstance(file_value, str) else 'N/A'}")
-        
-        file_data, filename_from_dict = extract_file_data(file_value)
-        
-        # Add file if we have data (relaxed validation - trust that if it's in the field, it's valid)
-        if file_data:
-            print(f"Extracting {file_field} for patient {patient_id}, data length: {len(file_data)}")
-            
-            # Get filename - prefer from dict, then from filename_field, then default
-            if filename_from_dict:
-                filename = filename_from_dict
-            else:
-                filename = section_4.get(filename_field, '')
-            
-            if not filename:
-                filename = f"{file_field}.pdf"
-            
-            # Accept any non-empty data (very relaxed validation)
-            # Only log warning if data seems suspiciously short
-            if len(file_data) < 50:
-                print(f"Warning: File {file_field} for patient {patient_id} is very short ({len(file_data)} chars), but adding anyway")
-            
-            # Get uploaded_by from metadata if available
-            section_4_metadata = section_4.get('_file_metadata', {})
-            field_metadata = section_4_metadata.get(file_field, {})
-            uploaded_by = field_metadata.get('last_updated_by', user_email)
-            uploaded_date = field_metadata.get('last_updated_date')
-            
-            files.append({
-                "file_id": f"patient_{patient_id}_{file_field}",
-                "source": "patient_data",
-                "source_id": patient_id,
-                "field_path": f"section_4.{file_field}",
-                "patient_id": patient_id,
-                "patient_firstname": patient_firstname,
-                "patient_lastname": patient_lastname,
-                "file_name": filename,
-                "file_category": category,
-                "file_size": len(file_data) * 3 // 4,  # Approximate base64 size
-                "uploaded_by": uploaded_by,
-                "uploaded_date": uploaded_date,
-                "file_data": file_data,
-                "file_type": "application/pdf"  # Default to PDF
-            })
-        else:
-            print(f"No valid file data found for {file_field} in patient {patient_id}")
-    
-    return files
+        return set_etag(Response({"status": "success", "data": serializer.data}, status=status.HTTP_200_OK), etag)
+
+
+def file_data_to_dict(file_data, include_data=True):
+    """Normalize a FileData row to the same shape as extract_files_from_patient_data entries"""
+    file_dict = {
+        "file_id": file_data.file_id,
+        "source": "file_data",
+        "source_id": file_data.file_id,
+        "field_path": None,
+        "patient_id": file_data.patient_id,
+        "patient_firstname": file_data.patient_firstname,
+        "patient_lastname": file_data.patient_lastname,
+        "file_name": file_data.file_name,
+        "file_category": file_data.file_category,
+        "file_size": file_data.file_size,
+        "uploaded_by": file_data.uploaded_by,
+        "uploaded_date": file_data.uploaded_date.isoformat() if file_data.uploaded_date else None,
+        "file_type": file_data.file_type
+    }
+    if include_data:
+        try:
+            file_dict["file_data"] = read_base64(file_data.blob_hash)
+        except BlobNotFound:
+            print(f"Blob {file_data.blob_hash} missing for file {file_data.file_id}")
+            file_dict["file_data"] = ""
+    return file_dict
 
 
 class FileAPI(APIView):
-    permission_classes = [IsAuthenticated]
+    permission_classes = [IsAuthenticated, HasPermissionCodes]
+    required_permissions = {'GET': 'view_files', 'POST': 'add_file', 'PUT': 'edit_file', 'DELETE': 'delete_file'}
 
     def get(self, request):
+        # ?file_id=... returns a single file with its bytes; ?mode=metadata returns a
+        # paginated listing without bytes. Without either, the full legacy listing is returned.
+        if request.query_params.get('file_id'):
+            return self._get_file(request, request.query_params['file_id'])
+        if request.query_params.get('mode') == 'metadata':
+            return self._list_metadata(request)
+
         user = request.user
         email = user.email
         all_files = []
@@ -953,25 +1084,57 @@ class FileAPI(APIView):
         # Get files from FileData - only this user's files
         file_data_list = FileData.objects.filter(user=user)
         for file_data in file_data_list:
-            all_files.append({
-                "file_id": file_data.file_id,
-                "source": "file_data",
-                "source_id": file_data.file_id,
-                "field_path": None,
-                "patient_id": file_data.patient_id,
-                "patient_firstname": file_data.patient_firstname,
-                "patient_lastname": file_data.patient_lastname,
-                "file_name": file_data.file_name,
-                "file_category": file_data.file_category,
-                "file_size": file_data.file_size,
-                "uploaded_by": file_data.uploaded_by,
-                "uploaded_date": file_data.uploaded_date.isoformat() if file_data.uploaded_date else None,
-                "file_data": file_data.file_data,
-                "file_type": file_data.file_type
-            })
+            all_files.append(file_data_to_dict(file_data))
         
         return Response({"status": "success", "data": all_files}, status=status.HTTP_200_OK)
 
+    def _get_file(self, request, file_id):
+        user = request.user
+        patient_id, _ = parse_patient_file_id(file_id)
+        if patient_id is not None:
+            patient_data = get_accessible_patients_queryset(user).filter(patient_id=patient_id).first()
+            if patient_data:
+                owner_email = patient_data.user.email if patient_data.user else user.email
+                for file_dict in extract_files_from_patient_data(patient_data, owner_email):
+                    if file_dict["file_id"] == file_id:
+                        return Response({"status": "success", "data": file_dict}, status=status.HTTP_200_OK)
+        else:
+            file_data = FileData.objects.filter(file_id=file_id, user=user).first()
+            if file_data:
+                return Response({"status": "success", "data": file_data_to_dict(file_data)},
+                                status=status.HTTP_200_OK)
+        return Response({"status": "error", "error": "File not found"}, status=status.HTTP_404_NOT_FOUND)
+
+    def _list_metadata(self, request):
+        user = request.user
+        patient_id = request.query_params.get('patient_id')
+        category = request.query_params.get('category')
+        try:
+            position = decode_cursor(request.query_params.get('cursor'))
+            limit = parse_limit(request.query_params.get('limit'))
+        except ValueError as e:
+            return Response({"status": "error", "error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        after_id = position.get("file_id") if position else None
+
+        # Embedded files of accessible patients plus this user's uploads, from the file manifest
+        if getattr(user, 'is_staff', False):
+            patient_files = Q(source="patient_data")
+        else:
+            accessible_pks = accessible_patient_pks(user)
+            patient_files = Q(source="patient_data", patient_pk__in=accessible_pks)
+        entries = FileManifestEntry.objects.filter(patient_files | Q(source="file_data", user=user))
+        if patient_id:
+            entries = entries.filter(patient_id=patient_id)
+        if category:
+            entries = entries.filter(file_category=category)
+        if after_id:
+            entries = entries.filter(file_id__gt=after_id)
+        entries = list(entries.order_by('file_id')[:limit + 1])
+
+        page = [manifest_entry_to_dict(entry) for entry in entries[:limit]]
+        next_cursor = encode_cursor({"file_id": page[-1]["file_id"]}) if len(entries) > limit else None
+        return Response({"status": "success", "data": page, "next_cursor": next_cursor}, status=status.HTTP_200_OK)
+
     def post(self, request):
         request_data = dict(request.data)
         request_data.pop("email", None)
@@ -979,6 +1142,16 @@ class FileAPI(APIView):
         email = user.email
         
         file_id = f"file_{uuid.uuid4().hex}"
+
+        if not request_data.get("file_data"):
+            return Response({"status": "error", "data": {"file_data": ["This field may not be blank."]}},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            data = decode_base64_payload(request_data["file_data"])
+        except ValueError as e:
+            return Response({"status": "error", "data": {"file_data": [str(e)]}}, status=status.HTTP_400_BAD_REQUEST)
+        blob_hash, file_size, file_type, original_size = ingest_bytes(
+            data, request_data.get("file_type", "application/octet-stream"))
         
         file_data = {
             "file_id": file_id,
@@ -988,17 +1161,20 @@ class FileAPI(APIView):
             "patient_lastname": request_data.get("patient_lastname", ""),
             "file_name": request_data.get("file_name", ""),
             "file_category": request_data.get("file_category", ""),
-            "file_size": request_data.get("file_size", 0),
+            "file_size": file_size,
+            "original_size": original_size,
             "uploaded_by": email,
-            "file_data": request_data.get("file_data", ""),
-            "file_type": request_data.get("file_type", "application/octet-stream")
+            "blob_hash": blob_hash,
+            "file_type": file_type
         }
         
         serializer = FileDataSerializer(data=file_data)
         if serializer.is_valid():
             serializer.save()
+            record_file_change(file_id, file_data["patient_id"], CREATED, user_pk=user.pk, changed_by=email)
             return Response({"status": "success", "data": serializer.data}, status=status.HTTP_201_CREATED)
         else:
+            release_blob(blob_hash)
             return Response({"status": "error", "data": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
 
     def put(self, request):
@@ -1024,7 +1200,13 @@ class FileAPI(APIView):
                         if section not in personal_info:
                             personal_info[section] = {}
                         
-                        personal_info[section][field] = request_data.get("file_data", "")
+                        released_hashes = collect_blob_hashes(personal_info)
+                        file_ref = store_patient_file(request_data.get("file_data", ""), section,
+                                                      request_data.get("file_name"))
+                        if request_data.get("file_data") and not file_ref:
+                            return Response({"status": "error", "error": "Invalid file data"},
+                                            status=status.HTTP_400_BAD_REQUEST)
+                        personal_info[section][field] = file_ref or ""
                         
                         # Update filename if provided
                         if field.endswith("File") and "file_name" in request_data:
@@ -1043,7 +1225,9 @@ class FileAPI(APIView):
                         personal_info[section]["_file_metadata"][field]["last_updated_date"] = timezone.now().isoformat()
                         
                         patient_data.patient_personal_info = personal_info
-                        patient_data.save()
+                        patient_data.save(update_fields=['patient_personal_info'])
+                        record_patient_change(patient_data, [f"patient_personal_info.{section}"], user=request.user)
+                        release_unreferenced(released_hashes, collect_blob_hashes(personal_info))
                         
                         return Response({"status": "success"}, status=status.HTTP_200_OK)
             except PatientData.DoesNotExist:
@@ -1052,14 +1236,23 @@ class FileAPI(APIView):
             # Update file in FileData (only if file belongs to user)
             try:
                 file_data = FileData.objects.get(file_id=file_id, user=request.user)
+                old_blob_hash = file_data.blob_hash
                 file_data.file_name = request_data.get("file_name", file_data.file_name)
-                file_data.file_size = request_data.get("file_size", file_data.file_size)
-                file_data.file_data = request_data.get("file_data", file_data.file_data)
                 file_data.file_type = request_data.get("file_type", file_data.file_type)
+                if request_data.get("file_data"):
+                    try:
+                        data = decode_base64_payload(request_data["file_data"])
+                    except ValueError as e:
+                        return Response({"status": "error", "error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+                    (file_data.blob_hash, file_data.file_size,
+                     file_data.file_type, file_data.original_size) = ingest_bytes(data, file_data.file_type)
                 # Update uploaded_by to the user who is updating the file
                 file_data.uploaded_by = email
                 file_data.uploaded_date = timezone.now()
                 file_data.save()
+                record_file_change(file_id, file_data.patient_id, user_pk=request.user.pk, changed_by=email)
+                if old_blob_hash != file_data.blob_hash:
+                    release_blob(old_blob_hash)
                 
                 return Response({"status": "success"}, status=status.HTTP_200_OK)
             except FileData.DoesNotExist:
@@ -1086,6 +1279,7 @@ class FileAPI(APIView):
                         field = path_parts[1]
                         
                         if section in personal_info and field in personal_info[section]:
+                            released_hashes = collect_blob_hashes(personal_info)
                             personal_info[section][field] = ""
                             
                             # Also clear filename if it exists
@@ -1095,7 +1289,10 @@ class FileAPI(APIView):
                                     personal_info[section][filename_field] = ""
                             
                             patient_data.patient_personal_info = personal_info
-                            patient_data.save()
+                            patient_data.save(update_fields=['patient_personal_info'])
+                            record_patient_change(patient_data, [f"patient_personal_info.{section}"],
+                                                  user=request.user)
+                            release_unreferenced(released_hashes, collect_blob_hashes(personal_info))
                             
                             return Response({"status": "success"}, status=status.HTTP_200_OK)
             except PatientData.DoesNotExist:
@@ -1104,6 +1301,9 @@ class FileAPI(APIView):
             try:
                 file_data = FileData.objects.get(file_id=file_id, user=request.user)
                 file_data.delete()
+                record_file_change(file_id, file_data.patient_id, DELETED, user_pk=request.user.pk,
+                                   changed_by=request.user.email)
+                release_blob(file_data.blob_hash)
                 return Response({"status": "success"}, status=status.HTTP_200_OK)
             except FileData.DoesNotExist:
                 return Response({"status": "error", "error": "File not found"}, status=status.HTTP_404_NOT_FOUND)
@@ -1111,6 +1311,458 @@ class FileAPI(APIView):
         return Response({"status": "error", "error": "Invalid source"}, status=status.HTTP_400_BAD_REQUEST)
 
 
+def blob_file_response(request, blob_hash, content_type, last_modified=None, filename=None):
+    """Stream a blob from the blob store; the content hash doubles as a strong ETag"""
+    store = get_blob_store()
+    try:
+        size = store.size(blob_hash)
+    except BlobNotFound:
+        return Response({"status": "error", "error": "File content missing"}, status=status.HTTP_404_NOT_FOUND)
+    return streaming_file_response(
+        request, size, lambda start, end: store.iter_chunks(blob_hash, start, end),
+        content_type, etag=blob_hash, last_modified=last_modified, filename=filename)
+
+
+class FileContentAPI(APIView):
+    """Raw file bytes as a streaming response, with Range and ETag/Last-Modified support."""
+    permission_classes = [IsAuthenticated, HasPermissionCodes]
+    required_permissions = {'GET': 'view_files'}
+
+    def get(self, request, file_id):
+        user = request.user
+        patient_id, _ = parse_patient_file_id(file_id)
+        if patient_id is not None:
+            patient_data = get_accessible_patients_queryset(user).filter(patient_id=patient_id).first()
+            if not patient_data:
+                return Response({"status": "error", "error": "File not found"}, status=status.HTTP_404_NOT_FOUND)
+            file_dict = next((f for f in extract_files_from_patient_data(patient_data, user.email, include_data=False)
+                              if f["file_id"] == file_id), None)
+            if not file_dict:
+                return Response({"status": "error", "error": "File not found"}, status=status.HTTP_404_NOT_FOUND)
+            uploaded_date = parse_uploaded_date(file_dict["uploaded_date"])
+            if file_dict.get("blob_hash"):
+                return blob_file_response(request, file_dict["blob_hash"], file_dict["file_type"],
+                                          uploaded_date, file_dict["file_name"])
+            # Not yet moved to the blob store: decode the inline base64 slice by slice
+            file_dict = next(f for f in extract_files_from_patient_data(patient_data, user.email)
+                             if f["file_id"] == file_id)
+            try:
+                payload = Base64Payload(file_dict["file_data"])
+            except ValueError as e:
+                return Response({"status": "error", "error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            return streaming_file_response(
+                request, payload.size, payload.iter_chunks, file_dict["file_type"],
+                etag=payload.etag(), last_modified=uploaded_date, filename=file_dict["file_name"])
+
+        file_data = FileData.objects.filter(file_id=file_id, user=user).first()
+        if not file_data:
+            return Response({"status": "error", "error": "File not found"}, status=status.HTTP_404_NOT_FOUND)
+        return blob_file_response(request, file_data.blob_hash, file_data.file_type,
+                                  file_data.uploaded_date, file_data.file_name)
+
+
+class PatientPhotoAPI(APIView):
+    """Patient photo (section_1.image) at ?size=64, 256 or original.
+
+    Resized copies are rendered once per source hash and size and then served from the
+    thumbnail cache. With ?v=<source hash> (as returned in blob references) the response
+    is cacheable for a year, since a new photo gets a new hash."""
+    permission_classes = [IsAuthenticated, HasPermissionCodes]
+    required_permissions = {'GET': 'view_patients'}
+
+    def get(self, request, patient_id):
+        size = request.query_params.get('size', '256')
+        if size != 'original' and size not in THUMBNAIL_SIZES:
+            return Response({"status": "error", "error": "size must be one of 64, 256, original"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        patient_data = get_accessible_patients_queryset(request.user).filter(patient_id=patient_id) \
+            .only('patient_id', 'patient_personal_info').first()
+        if not patient_data:
+            return Response({"status": "error", "error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        image = ((patient_data.patient_personal_info or {}).get('section_1') or {}).get('image')
+        if is_blob_ref(image):
+            source_hash = image['blob_hash']
+            content_type = image.get('content_type', 'image/jpeg')
+            load_source = lambda: get_blob_store().read(source_hash)
+        else:
+            try:
+                data = decode_base64_payload(image.get('data') if isinstance(image, dict) else image)
+            except ValueError:
+                data = None
+            if not data:
+                return Response({"status": "error", "error": "Photo not found"}, status=status.HTTP_404_NOT_FOUND)
+            source_hash = hashlib.sha256(data).hexdigest()
+            content_type = guess_content_type(data, 'image/jpeg')
+            load_source = lambda: data
+
+        if size == 'original':
+            if is_blob_ref(image):
+                response = blob_file_response(request, source_hash, content_type)
+            else:
+                response = streaming_file_response(request, len(data), lambda start, end: iter([data[start:end]]),
+                                                   content_type, etag=source_hash)
+        else:
+            etag = f"{source_hash}-{size}"
+            response = get_conditional_response(request, etag=quote_etag(etag))
+            if response is None:
+                try:
+                    thumbnail = get_or_create_thumbnail(source_hash, THUMBNAIL_SIZES[size], load_source)
+                except (BlobNotFound, OSError, Image.DecompressionBombError) as e:
+                    print(f"Could not render photo of patient {patient_id}: {str(e)}")
+                    return Response({"status": "error", "error": "Photo could not be resized"},
+                                    status=status.HTTP_404_NOT_FOUND)
+                response = streaming_file_response(request, len(thumbnail),
+                                                   lambda start, end: iter([thumbnail[start:end]]),
+                                                   THUMBNAIL_CONTENT_TYPE, etag=etag)
+            else:
+                response['ETag'] = quote_etag(etag)
+        if response.status_code in (200, 206, 304) and request.query_params.get('v') == source_hash:
+            response['Cache-Control'] = 'private, max-age=31536000, immutable'
+        return response
+
+
+class PatientRosterAPI(APIView):
+    """GET: compact patient cards from PatientSummary, keyset-paginated.
+
+    ?sort=name|-name|room|-room, ?status=active|exited|all (default active), ?limit=, ?cursor=
+    Filters: ?gender=, ?care_type=, ?insurance=, ?blood_type= (repeatable), ?room_min=, ?room_max=.
+    With ?facets=1 the response also has per-value counts of every filter and the total."""
+    permission_classes = [IsAuthenticated, HasPermissionCodes]
+    required_permissions = {'GET': 'view_patients'}
+
+    def get(self, request):
+        user = request.user
+        sort = request.query_params.get('sort', 'name')
+        descending = sort.startswith('-')
+        sort_field = ROSTER_SORTS.get(sort.lstrip('-'))
+        if not sort_field:
+            return Response({"status": "error", "error": "sort must be one of name, room (optionally with -)"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            position = decode_cursor(request.query_params.get('cursor'))
+            limit = parse_limit(request.query_params.get('limit'))
+        except ValueError as e:
+            return Response({"status": "error", "error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            filters = parse_roster_filters(request.query_params)
+        except ValueError as e:
+            return Response({"status": "error", "error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        summaries = PatientSummary.objects.all()
+        accessible_pks = accessible_patient_pks(user)
+        if accessible_pks is not None:
+            summaries = summaries.filter(patient_pk__in=accessible_pks)
+        summaries = filter_summaries(summaries, filters)
+
+        etag = compute_etag(roster_fingerprint(accessible_pks), accessible_pks, sorted(request.query_params.lists()))
+        response = not_modified_response(request, etag)
+        if response is not None:
+            return response
+
+        # Keyset pagination on (sort value, patient_pk), so pages stay stable while patients are added
+        if position:
+            if position.get("sort") != sort or "value" not in position or "pk" not in position:
+                return Response({"status": "error", "error": "Invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+            lookup = 'lt' if descending else 'gt'
+            summaries = summaries.filter(
+                Q(**{f'{sort_field}__{lookup}': position["value"]})
+                | Q(**{sort_field: position["value"], f'patient_pk__{lookup}': position["pk"]}))
+        prefix = '-' if descending else ''
+        summaries = list(summaries.order_by(f'{prefix}{sort_field}', f'{prefix}patient_pk')[:limit + 1])
+
+        page = summaries[:limit]
+        next_cursor = None
+        if len(summaries) > limit:
+            last = page[-1]
+            next_cursor = encode_cursor({"sort": sort, "value": getattr(last, sort_field), "pk": last.patient_pk})
+        response_data = {"status": "success", "data": [summary_to_card(summary) for summary in page],
+                         "next_cursor": next_cursor}
+        if request.query_params.get('facets') in ('1', 'true'):
+            response_data["facets"], response_data["total"] = facet_counts(filters, accessible_pks)
+        return set_etag(Response(response_data, status=status.HTTP_200_OK), etag)
+
+
+class PatientSearchAPI(APIView):
+    """GET ?q=: accessible patients by name (prefix or close spelling), citizen ID or room number, best first."""
+    permission_classes = [IsAuthenticated, HasPermissionCodes]
+    required_permissions = {'GET': 'view_patients'}
+
+    def get(self, request):
+        user = request.user
+        query = request.query_params.get('q', '')
+        try:
+            limit = parse_limit(request.query_params.get('limit'), SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT)
+        except ValueError as e:
+            return Response({"status": "error", "error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if not query.strip():
+            return Response({"status": "success", "data": []}, status=status.HTTP_200_OK)
+
+        accessible_pks = accessible_patient_pks(user)
+        results = []
+        for summary in search_patients(query, accessible_pks, limit):
+            card = summary_to_card(summary)
+            card["score"] = summary.score
+            results.append(card)
+        return Response({"status": "success", "data": results}, status=status.HTTP_200_OK)
+
+
+class PatientExportAPI(APIView):
+    """GET: ZIP of all documents of one patient, streamed as it is built."""
+    permission_classes = [IsAuthenticated, HasPermissionCodes]
+    required_permissions = {'GET': 'view_patient_detail'}
+
+    def get(self, request, patient_id):
+        patient_data = get_accessible_patients_queryset(request.user).filter(patient_id=patient_id).first()
+        if not patient_data:
+            return Response({"status": "error", "error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
+        filename = f"{patient_folder_name(patient_data)}.zip"
+        return zip_response(patient_export_entries(patient_data, request.user), filename)
+
+
+class PatientBulkExportAPI(APIView):
+    """GET: ZIP of the documents of several patients (?patient_ids=a,b), one folder per patient.
+
+    Without patient_ids every accessible patient is exported."""
+    permission_classes = [IsAuthenticated, HasPermissionCodes]
+    required_permissions = {'GET': 'export_medications'}
+
+    def get(self, request):
+        user = request.user
+        patients = get_accessible_patients_queryset(user)
+        patient_ids = [pid for pid in request.query_params.get("patient_ids", "").split(",") if pid.strip()]
+        if patient_ids:
+            patients = patients.filter(patient_id__in=[pid.strip() for pid in patient_ids])
+        if patient_ids and not patients.exists():
+            return Response({"status": "error", "error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        def entries():
+            for patient_data in patients.order_by('patient_id'):
+                yield from patient_export_entries(patient_data, user, f"{patient_folder_name(patient_data)}/")
+
+        filename = f"patient_documents_{timezone.now().strftime('%Y%m%d_%H%M%S')}.zip"
+        return zip_response(entries(), filename)
+
+
+class ChangeFeedAPI(APIView):
+    """GET ?since=<cursor>: the entities changed after cursor, with their changed paths.
+
+    Each change is {"entity", "id", "action", "paths", "version", "changed_at"}; empty paths
+    mean the whole entity should be reloaded. Without since only the current cursor is
+    returned, to start following after a full load. 410 when since is older than the journal
+    retention; the client then reloads everything."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        user = request.user
+        try:
+            limit = parse_limit(request.query_params.get('limit'), DEFAULT_CHANGES_LIMIT, MAX_CHANGES_LIMIT)
+        except ValueError as e:
+            return Response({"status": "error", "error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        since = request.query_params.get('since')
+        if since in (None, ''):
+            return Response({"status": "success", "data": [], "cursor": latest_cursor(settled_before()),
+                             "has_more": False}, status=status.HTTP_200_OK)
+        try:
+            since = int(since)
+        except ValueError:
+            return Response({"status": "error", "error": "since must be a cursor from a previous response"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if is_expired(since):
+            return Response({"status": "failed", "error": "Cursor expired, reload everything",
+                             "cursor": latest_cursor(settled_before())}, status=status.HTTP_410_GONE)
+
+        accessible_pks = accessible_patient_pks(user)
+        cutoff = settled_before()
+        events = list(visible_changes(user, accessible_pks).filter(pk__gt=since, created_at__lte=cutoff)
+                      .order_by('pk')[:limit + 1])
+        has_more = len(events) > limit
+        events = events[:limit]
+        # Without more visible events, skip past the ones this user cannot see as well
+        cursor = events[-1].pk if has_more else max(since, latest_cursor(cutoff))
+        return Response({"status": "success", "data": coalesce_changes(events), "cursor": cursor,
+                         "has_more": has_more}, status=status.HTTP_200_OK)
+
+
+UPLOAD_DEFAULT_CHUNK_SIZE = 1024 * 1024
+UPLOAD_MIN_CHUNK_SIZE = 64 * 1024
+UPLOAD_MAX_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_MAX_FILE_SIZE = 200 * 1024 * 1024
+REQUEST_READ_SIZE = 64 * 1024
+
+
+def iter_request_body(request):
+    """Read the raw request body in small pieces instead of loading request.body/request.data"""
+    stream = request.stream
+    if stream is None:
+        return
+    while True:
+        data = stream.read(REQUEST_READ_SIZE)
+        if not data:
+            break
+        yield data
+
+
+def file_upload_to_dict(upload):
+    staged = get_blob_store().staged_chunks(upload.upload_id)
+    return {
+        "upload_id": upload.upload_id,
+        "patient_id": upload.patient_id,
+        "file_name": upload.file_name,
+        "file_category": upload.file_category,
+        "file_type": upload.file_type,
+        "file_size": upload.file_size,
+        "chunk_size": upload.chunk_size,
+        "chunk_count": upload.chunk_count,
+        "received_chunks": sorted(index for index, size in staged.items()
+                                  if index < upload.chunk_count and size == upload.expected_chunk_size(index)),
+    }
+
+
+class FileUploadAPI(APIView):
+    """Resumable chunked uploads: POST here to start, PUT each chunk, then POST commit.
+
+    Chunks go straight from the request stream into the blob store's staging area, so the
+    worker never holds more than one read buffer of the file in memory."""
+    permission_classes = [IsAuthenticated, HasPermissionCodes]
+    required_permissions = {'POST': 'add_file'}
+
+    def post(self, request):
+        request_data = request.data
+        try:
+            file_size = int(request_data.get("file_size"))
+            chunk_size = int(request_data.get("chunk_size") or UPLOAD_DEFAULT_CHUNK_SIZE)
+        except (TypeError, ValueError):
+            return Response({"status": "error", "error": "file_size and chunk_size must be integers"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if file_size < 0 or file_size > UPLOAD_MAX_FILE_SIZE:
+            return Response({"status": "error", "error": "Invalid file_size"}, status=status.HTTP_400_BAD_REQUEST)
+        if not request_data.get("file_name"):
+            return Response({"status": "error", "data": {"file_name": ["This field may not be blank."]}},
+                            status=status.HTTP_400_BAD_REQUEST)
+        chunk_size = min(max(chunk_size, UPLOAD_MIN_CHUNK_SIZE), UPLOAD_MAX_CHUNK_SIZE)
+
+        upload = FileUpload.objects.create(
+            upload_id=f"upload_{uuid.uuid4().hex}",
+            user=request.user,
+            patient_id=request_data.get("patient_id", ""),
+            patient_firstname=request_data.get("patient_firstname", ""),
+            patient_lastname=request_data.get("patient_lastname", ""),
+            file_name=request_data["file_name"],
+            file_category=request_data.get("file_category", ""),
+            file_type=request_data.get("file_type", "application/octet-stream"),
+            file_size=file_size,
+            chunk_size=chunk_size,
+        )
+        return Response({"status": "success", "data": file_upload_to_dict(upload)}, status=status.HTTP_201_CREATED)
+
+
+class FileUploadDetailAPI(APIView):
+    """GET: which chunks have been received (to resume). DELETE: abort the upload."""
+    permission_classes = [IsAuthenticated, HasPermissionCodes]
+    required_permissions = {'GET': 'add_file', 'DELETE': 'add_file'}
+
+    def get(self, request, upload_id):
+        upload = FileUpload.objects.filter(upload_id=upload_id, user=request.user).first()
+        if not upload:
+            return Response({"status": "error", "error": "Upload not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response({"status": "success", "data": file_upload_to_dict(upload)}, status=status.HTTP_200_OK)
+
+    def delete(self, request, upload_id):
+        upload = FileUpload.objects.filter(upload_id=upload_id, user=request.user).first()
+        if not upload:
+            return Response({"status": "error", "error": "Upload not found"}, status=status.HTTP_404_NOT_FOUND)
+        get_blob_store().discard_staged(upload.upload_id)
+        upload.delete()
+        return Response({"status": "success"}, status=status.HTTP_200_OK)
+
+
+class FileUploadChunkAPI(APIView):
+    """PUT the raw bytes of chunk number <index> (application/octet-stream body).
+
+    An optional X-Chunk-SHA256 header is checked against the streamed hash of the chunk.
+    Re-sending a chunk replaces it, so a client can retry any chunk after a dropped connection."""
+    permission_classes = [IsAuthenticated, HasPermissionCodes]
+    required_permissions = {'PUT': 'add_file'}
+
+    def put(self, request, upload_id, index):
+        upload = FileUpload.objects.filter(upload_id=upload_id, user=request.user).first()
+        if not upload:
+            return Response({"status": "error", "error": "Upload not found"}, status=status.HTTP_404_NOT_FOUND)
+        if index >= upload.chunk_count:
+            return Response({"status": "error", "error": "Chunk index out of range"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        expected_size = upload.expected_chunk_size(index)
+        content_length = request.META.get('CONTENT_LENGTH')
+        if content_length and content_length.isdigit() and int(content_length) != expected_size:
+            return Response({"status": "error", "error": f"Chunk {index} must be {expected_size} bytes"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        store = get_blob_store()
+        size, digest = store.stage_chunk(upload.upload_id, index, iter_request_body(request))
+        checksum = request.META.get('HTTP_X_CHUNK_SHA256')
+        if size != expected_size or (checksum and checksum.lower() != digest):
+            store.discard_staged(upload.upload_id, [index])
+            return Response({"status": "error", "error": f"Chunk {index} is incomplete or corrupted"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response({"status": "success", "data": {"index": index, "size": size, "sha256": digest}},
+                        status=status.HTTP_200_OK)
+
+
+class FileUploadCommitAPI(APIView):
+    """POST: assemble the staged chunks into a blob and create the FileData row."""
+    permission_classes = [IsAuthenticated, HasPermissionCodes]
+    required_permissions = {'POST': 'add_file'}
+
+    def post(self, request, upload_id):
+        upload = FileUpload.objects.filter(upload_id=upload_id, user=request.user).first()
+        if not upload:
+            return Response({"status": "error", "error": "Upload not found"}, status=status.HTTP_404_NOT_FOUND)
+        store = get_blob_store()
+        staged = store.staged_chunks(upload.upload_id)
+        missing = [index for index in range(upload.chunk_count)
+                   if staged.get(index) != upload.expected_chunk_size(index)]
+        if missing:
+            return Response({"status": "error", "error": "Missing chunks", "missing_chunks": missing},
+                            status=status.HTTP_409_CONFLICT)
+
+        # The whole-file hash is computed while streaming the chunks into the blob store
+        blob_hash, file_size = store.put_stream(store.iter_staged(upload.upload_id, range(upload.chunk_count)))
+        expected_hash = request.data.get("sha256")
+        if expected_hash and expected_hash.lower() != blob_hash:
+            release_blob(blob_hash)
+            store.discard_staged(upload.upload_id)
+            return Response({"status": "error", "error": "Checksum mismatch, upload the chunks again"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        blob_hash, stored_size, file_type, original_size = ingest_stored_blob(blob_hash, file_size, upload.file_type)
+
+        file_data = {
+            "file_id": f"file_{uuid.uuid4().hex}",
+            "user": str(request.user.pk),
+            "patient_id": upload.patient_id,
+            "patient_firstname": upload.patient_firstname,
+            "patient_lastname": upload.patient_lastname,
+            "file_name": upload.file_name,
+            "file_category": upload.file_category,
+            "file_size": stored_size,
+            "original_size": original_size,
+            "uploaded_by": request.user.email,
+            "blob_hash": blob_hash,
+            "file_type": file_type
+        }
+        serializer = FileDataSerializer(data=file_data)
+        if not serializer.is_valid():
+            release_blob(blob_hash)
+            return Response({"status": "error", "data": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+        serializer.save()
+        record_file_change(file_data["file_id"], file_data["patient_id"], CREATED, user_pk=request.user.pk,
+                           changed_by=request.user.email)
+        store.discard_staged(upload.upload_id)
+        upload.delete()
+        return Response({"status": "success", "data": serializer.data}, status=status.HTTP_201_CREATED)
+
+
 # --- Admin API (is_staff only) ---
 from rest_framework.permissions import IsAdminUser
 
@@ -1142,7 +1794,13 @@ class AdminUserDetail(APIView):
             return Response({"error": "User not found"}, status=status.HTTP_404_NOT_FOUND)
         serializer = AdminUserUpdateSerializer(user, data=request.data, partial=True)
         if serializer.is_valid():
-            serializer.save()
+            if {'permission_codes', 'is_staff'} & set(serializer.validated_data):
+                # Cached users (and tokens) of the previous version are reloaded
+                serializer.save(auth_version=user.auth_version + 1)
+            else:
+                serializer.save()
+            record_change(USER, user.pk, paths=list(serializer.validated_data), user_pk=user.pk,
+                          changed_by=request.user.email)
             user.refresh_from_db()
             data = AdminUserReadSerializer(user).data
             return Response({"status": "success", "data": data}, status=status.HTTP_200_OK)
@@ -1188,6 +1846,12 @@ class AdminPatientAccessDetail(APIView):
         users = User.objects.filter(pk__in=user_ids)
         if users.count() != len(user_ids):
             return Response({"status": "error", "data": "Invalid user_ids"}, status=status.HTTP_400_BAD_REQUEST)
+        revoked_pks = set(patient.allowed_users.values_list('pk', flat=True)) - {user.pk for user in users}
         patient.allowed_users.set(users)
+        patient.save(update_fields=['version'])  # allowed_users is part of the patient representation
+        record_patient_change(patient, ["allowed_users"], user=request.user)
+        for user_pk in revoked_pks:
+            # Only visible to the user that lost access, so the client can drop the patient
+            record_change(PATIENT, patient.patient_id, REVOKED, user_pk=user_pk, changed_by=request.user.email)
         data = AdminPatientAccessSerializer(patient).data
         return Response({"status": "success", "data": data}, status=status.HTTP_200_OK)